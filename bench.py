@@ -0,0 +1,352 @@
+"""Micro-benchmarks for the bot's hot paths.
+
+Runs outside the bot against the code in main.py:
+
+    python bench.py                 # every benchmark
+    python bench.py keys 5000       # one benchmark, custom iteration count
+"""
+import os
+import sys
+import tempfile
+
+# main.py refuses to import without a token; nothing here talks to Telegram
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.gettempdir(), "apkbot-bench.jsonl"))
+
+import asyncio
+import json
+import re
+import time
+
+from telegram import Update
+from telegram.ext import ExtBot
+
+import main
+
+SAMPLE_CAPTION = (
+    "🔥 <b>New Mod Released</b> 🔥\n"
+    "✅ Premium Unlocked\n"
+    "✅ No Ads\n"
+    "Key -\n"
+    "📢 Join @example_channel for more"
+)
+
+SAMPLE_KEYS = [
+    {"caption": "🔥 Mod Menu v2.1\nKey - ABC123XYZ\nJoin @example_channel", "entities": []},
+    {"caption": "🚀 Loader Ready 🚀\n👉 QWERTY-778", "entities": [{"type": "code", "offset": 22, "length": 10}]},
+    {"caption": "Password: hidden42", "entities": [{"type": "spoiler", "offset": 10, "length": 8}]},
+    {"caption": "No key in this post", "entities": []}
+]
+
+def _iterations(args, default: int) -> int:
+    return int(args[0]) if args and args[0].isdigit() else default
+
+def _bench_loop(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def bench_captions(args) -> str:
+    iterations = _iterations(args, 20000)
+    template = SAMPLE_CAPTION
+
+    def legacy(i):
+        key = f"KEY{i}"
+        for idx in range(1, 4):
+            if idx == 3:
+                template.replace("Key -", f"<blockquote>Key - <code>{key}</code></blockquote>")
+            else:
+                f"<blockquote>Key - <code>{key}</code></blockquote>"
+
+    def engine(i):
+        main.render_session_captions(template, f"KEY{i}", "quote", 3, "spread")
+
+    legacy_us = _bench_loop(legacy, iterations)
+    main.CAPTION_CACHE.pop(template, None)
+    engine_us = _bench_loop(engine, iterations)
+
+    return (
+        f"Caption engine\n"
+        f"  Iterations : {iterations} × 3 APKs\n"
+        f"  str.replace: {legacy_us:.2f} µs/session\n"
+        f"  Engine     : {engine_us:.2f} µs/session\n"
+        f"  Speedup    : {legacy_us / engine_us if engine_us else 0:.2f}x"
+    )
+
+def bench_keys(args) -> str:
+    iterations = _iterations(args, 2000)
+    corpus = SAMPLE_KEYS
+
+    def legacy(i):
+        for sample in corpus:
+            caption = sample["caption"]
+            match = re.search(r'Key\s*-\s*(\S+)', caption)
+            if match:
+                continue
+            for entity in sample["entities"]:
+                if entity["type"] == "code":
+                    caption[entity["offset"]:entity["offset"] + entity["length"]]
+                    break
+
+    def engine(i):
+        for sample in corpus:
+            main.extract_key(sample["caption"], sample["entities"])
+
+    legacy_us = _bench_loop(legacy, iterations) / len(corpus)
+    engine_us = _bench_loop(engine, iterations) / len(corpus)
+
+    hits = {
+        name: sum(1 for sample in corpus if main.extract_key(sample["caption"], sample["entities"], [name]))
+        for name in main.KEY_RULES
+    }
+    found = sum(1 for sample in corpus if main.extract_key(sample["caption"], sample["entities"], list(main.KEY_RULES)))
+    hit_lines = "\n".join(f"    {name:<11}: {count}" for name, count in hits.items())
+
+    return (
+        f"Key extraction\n"
+        f"  Corpus     : {len(corpus)} sample captions\n"
+        f"  Legacy     : {legacy_us:.2f} µs/caption\n"
+        f"  Engine     : {engine_us:.2f} µs/caption\n"
+        f"  Rule hits  :\n{hit_lines}\n"
+        f"  All rules  : {found}/{len(corpus)} keys found"
+    )
+
+async def bench_actors(args) -> str:
+    users = _iterations(args, 20)
+    per_user = 5
+    work = 0.01
+    seen = {}
+
+    class FakeUser:
+        def __init__(self, uid):
+            self.id = uid
+
+    async def handler(update, context):
+        await asyncio.sleep(work)
+        seen.setdefault(update.effective_user.id, []).append(update.update_id)
+
+    def make_updates():
+        updates = []
+        for n in range(per_user):
+            for uid in range(users):
+                update = Update(update_id=n * users + uid)
+                update._effective_user = FakeUser(-1 - uid)
+                updates.append(update)
+        return updates
+
+    # Baseline: one global lock, i.e. the old sequential processing
+    global_lock = asyncio.Lock()
+    async def sequential(update, context):
+        async with global_lock:
+            await handler(update, context)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(sequential(u, None) for u in make_updates()))
+    sequential_s = time.perf_counter() - start
+
+    seen.clear()
+    main.STATE_READY.set()
+    wrapped = main.serialized(handler)
+    start = time.perf_counter()
+    await asyncio.gather(*(wrapped(u, None) for u in make_updates()))
+    actor_s = time.perf_counter() - start
+
+    ordered = all(ids == sorted(ids) for ids in seen.values())
+    total = users * per_user
+    return (
+        f"Update actors\n"
+        f"  Updates    : {total} ({users} users × {per_user}, {int(work * 1000)}ms each)\n"
+        f"  Sequential : {sequential_s:.2f}s ({total / sequential_s:.0f} upd/s)\n"
+        f"  Per-user   : {actor_s:.2f}s ({total / actor_s:.0f} upd/s)\n"
+        f"  Speedup    : {sequential_s / actor_s:.1f}x\n"
+        f"  Ordered    : {'yes' if ordered else 'NO'}\n"
+        f"  Contended  : {main.ACTOR_STATS['contended']} | max queue {main.ACTOR_STATS['max_queue']}"
+    )
+
+def bench_callbacks(args) -> str:
+    iterations = _iterations(args, 20000)
+    samples = ["method2_yes", "setsource2", "auto3_menu", "delete_apk_5", "automated1", "bogus"]
+    lookup_us = _bench_loop(lambda i: main.parse_callback_data(samples[i % len(samples)]), iterations)
+    texts = ["waiting_channel", "waiting_source2", "waiting_caption3", "method2_key", "normal"]
+    text_us = _bench_loop(lambda i: main.route_lookup(main.TEXT_STATES, texts[i % len(texts)]), iterations)
+
+    return (
+        f"Update routers\n"
+        f"  Routes     : {len(main.CALLBACK_ROUTES)}\n"
+        f"  Lookup     : {lookup_us:.2f} µs/callback\n"
+        f"  Text state : {text_us:.2f} µs/message"
+    )
+
+def bench_ratelimit(args) -> str:
+    iterations = _iterations(args, 20000)
+    take_us = _bench_loop(lambda i: main.rate_limit_take("callback", -1 - i % 500), iterations)
+
+    # One user hammering a button 50 times within a second
+    start = time.monotonic() + main.RATE_PRUNE_INTERVAL
+    passed = sum(main.rate_limit_take("callback", -1, start + n * 0.02) for n in range(50))
+
+    limit_lines = "\n".join(
+        f"    {kind:<9}: burst {limits['burst']}, {limits['rate']}/s" for kind, limits in main.RATE_LIMITS.items()
+    )
+    return (
+        f"Rate limiter\n"
+        f"  Check      : {take_us:.2f} µs\n"
+        f"  50 clicks/s: {passed} passed, {50 - passed} dropped\n"
+        f"  Limits     :\n{limit_lines}"
+    )
+
+async def bench_webhook(args) -> str:
+    count = _iterations(args, 500)
+
+    # Stands in for the Application: the server only needs a queue and a bot
+    class FakeApp:
+        update_queue = asyncio.Queue()
+        bot = None
+
+    server = await main.start_http_server(FakeApp, "127.0.0.1", 0, main.WEBHOOK_ROUTES)
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+    async def request(method, path, body=b"", secret=main.WEBHOOK_SECRET):
+        writer.write(
+            f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        status = int((await reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line == b"\r\n":
+                break
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":")[1])
+        await reader.readexactly(length)
+        return status
+
+    try:
+        latencies = []
+        for n in range(count):
+            body = json.dumps({
+                "update_id": n,
+                "message": {"message_id": n, "date": int(time.time()), "chat": {"id": -1, "type": "private"}, "text": "ping"}
+            }).encode()
+            start = time.perf_counter()
+            await request("POST", main.WEBHOOK_PATH, body)
+            latencies.append((time.perf_counter() - start) * 1000)
+        forged = await request("POST", main.WEBHOOK_PATH, b"{}", secret="wrong")
+        health = await request("GET", "/healthz")
+        queued = FakeApp.update_queue.qsize()
+    finally:
+        writer.close()
+        await writer.wait_closed()
+        server.close()
+        await server.wait_closed()
+
+    latencies.sort()
+    return (
+        f"Webhook server\n"
+        f"  Updates    : {count} over one keep-alive connection\n"
+        f"  Throughput : {count / (sum(latencies) / 1000):.0f} upd/s\n"
+        f"  Latency    : p50 {latencies[len(latencies) // 2]:.2f}ms | p99 {latencies[int(len(latencies) * 0.99)]:.2f}ms\n"
+        f"  Queued     : {queued}/{count}\n"
+        f"  Bad secret : HTTP {forged} | health HTTP {health}"
+    )
+
+async def bench_startup(args) -> str:
+    phases = "\n".join(
+        f"    {phase:<13}: {seconds * 1000:8.1f} ms"
+        for phase, seconds in sorted(main.STARTUP_MARKS.items(), key=lambda item: item[1])
+    )
+
+    size_kb = os.path.getsize(main.STATE_FILE) / 1024 if os.path.exists(main.STATE_FILE) else 0
+    start = time.perf_counter()
+    await asyncio.to_thread(main.read_state_file)
+    parse_ms = (time.perf_counter() - start) * 1000
+
+    return (
+        f"Startup\n"
+        f"  Since boot :\n{phases}\n"
+        f"  state.json : {size_kb:.0f} KB, parsed in {parse_ms:.1f} ms off the loop"
+    )
+
+async def bench_http(args) -> str:
+    count = _iterations(args, 100)
+    delay = 0.02  # simulated Bot API latency per request
+
+    # Stand-in Bot API: answers every method with a bot user after `delay`
+    me = json.dumps({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "stub", "username": "stub_bot"}}).encode()
+    connections = []
+
+    async def serve(reader, writer):
+        connections.append(1)
+        try:
+            while True:
+                if not await reader.readline():
+                    break
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":")[1])
+                await reader.readexactly(length)
+                await asyncio.sleep(delay)
+                writer.write(main._http_response(200, "application/json", me, True))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(serve, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    rows = []
+    try:
+        for pool_size in sorted({1, 16, main.HTTP_CLIENT["pool_size"]}):
+            connections.clear()
+            bot = ExtBot(main.BOT_TOKEN, base_url=f"http://127.0.0.1:{port}/bot", request=main.build_http_request(pool_size))
+            async with bot:
+                start = time.perf_counter()
+                results = await asyncio.gather(*(bot.get_me() for _ in range(count)), return_exceptions=True)
+                elapsed = time.perf_counter() - start
+            errors = sum(isinstance(result, Exception) for result in results)
+            rows.append(f"    {pool_size:>5} {count / elapsed:>9.0f} {elapsed * 1000:>9.0f} {len(connections):>6} {errors:>6}")
+    finally:
+        server.close()
+        await server.wait_closed()
+
+    return (
+        f"Bot API HTTP pool\n"
+        f"  Requests   : {count} concurrent getMe, {delay * 1000:.0f} ms stub latency\n"
+        f"  Timeouts   : connect {main.HTTP_CLIENT['connect_timeout']}s | read {main.HTTP_CLIENT['read_timeout']}s | "
+        f"pool {main.HTTP_CLIENT['pool_timeout']}s | keep-alive {main.HTTP_CLIENT['keepalive_expiry']}s\n"
+        f"    {'pool':>5} {'req/s':>9} {'total ms':>9} {'conns':>6} {'errors':>6}\n"
+        + "\n".join(rows)
+    )
+
+BENCHMARKS = {
+    "captions": bench_captions,
+    "keys": bench_keys,
+    "actors": bench_actors,
+    "callbacks": bench_callbacks,
+    "ratelimit": bench_ratelimit,
+    "webhook": bench_webhook,
+    "startup": bench_startup,
+    "http": bench_http
+}
+
+async def run(names, args):
+    for name in names:
+        result = BENCHMARKS[name](args)
+        if asyncio.iscoroutine(result):
+            result = await result
+        print(result, end="\n\n")
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if argv and argv[0] not in BENCHMARKS:
+        sys.exit(f"Usage: python bench.py [{'|'.join(BENCHMARKS)}] [iterations]")
+    asyncio.run(run([argv[0]] if argv else list(BENCHMARKS), argv[1:]))
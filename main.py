@@ -1,49 +1,131 @@
-import json
 import time
-import random
+# Taken before the heavy imports so the startup marks cover them too
+BOOT_CLOCK = time.perf_counter()
+
+import json
 import os
 import re
 import sys
 import traceback
 import asyncio
 import zipfile
-import inspect
+import functools
+import hashlib
+import hmac
+import signal
+import threading
+import bisect
+import contextvars
+from collections import deque
 import shutil
+import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from html import escape
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from telegram.error import BadRequest, Forbidden
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.constants import ParseMode
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InputMediaDocument
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ContextTypes, ApplicationBuilder
+from telegram import Update, Document, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InputMediaDocument
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ContextTypes, ApplicationBuilder, CallbackContext, ExtBot
+from telegram.request import HTTPXRequest
+import httpx
 
 # Load bot token from Railway environment
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable not set")
 
+# === EVENT LOG ===
+# Operational events go to per-subsystem loggers under "apkbot" (apkbot.state,
+# apkbot.auto, ...). Callers only put records on a queue; a listener thread
+# writes them to LOG_FILE as JSON lines, rotated by size, and echoes the ones
+# at LOG_STDOUT_LEVEL or above to stdout. Routine per-event chatter is DEBUG,
+# so it lands in the file without flooding the Railway console.
+LOG_FILE = os.getenv("LOG_FILE", "logs/events.jsonl")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+LOG_STDOUT_LEVEL = os.getenv("LOG_STDOUT_LEVEL", "INFO").upper()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "3"))
+LOG_LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+EVENT_LOG = {"listener": None}
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        event = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **getattr(record, "fields", {})
+        }
+        return json.dumps(event, default=str, ensure_ascii=False)
+
+class ConsoleFormatter(logging.Formatter):
+    # Same "[SUBSYSTEM] message" shape the bot always printed
+    def format(self, record):
+        level = f" {record.levelname}" if record.levelno >= logging.WARNING else ""
+        fields = "".join(f" {key}={value}" for key, value in getattr(record, "fields", {}).items())
+        return f"[{record.name.rpartition('.')[2].upper()}]{level} {record.getMessage()}{fields}"
+
+def setup_event_log():
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(LOG_STDOUT_LEVEL)
+    console.setFormatter(ConsoleFormatter())
+    handlers = [console]
+
+    if LOG_FILE:
+        try:
+            os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+            file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8")
+            file_handler.setLevel(LOG_LEVEL)
+            file_handler.setFormatter(JsonLinesFormatter())
+            handlers.append(file_handler)
+        except OSError as e:
+            print(f"[LOG] Event log file unavailable, using stdout only: {e}")
+
+    events = queue.SimpleQueue()
+    root = logging.getLogger("apkbot")
+    root.setLevel(min(handler.level for handler in handlers))
+    root.propagate = False
+    root.addHandler(QueueHandler(events))
+    listener = QueueListener(events, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    EVENT_LOG["listener"] = listener
+
+def log_event(subsystem: str, level: str, message: str, **fields):
+    logging.getLogger(f"apkbot.{subsystem}").log(LOG_LEVELS[level], message, extra={"fields": fields})
+
+setup_event_log()
+
 # === GLOBAL CONSTANTS AND DEFAULTS ===
 STATE_FILE = "state.json"
 START_TIME = time.time()
 UPDATE_DATE = datetime.fromtimestamp(START_TIME, ZoneInfo("Asia/Kolkata")).strftime("%d-%m-%Y")
-LAST_ERROR_TIME = 0
-ERROR_COOLDOWN = 30
 BROADCAST_SESSION = {}
 state_lock = asyncio.Lock()
+STATE_READY = asyncio.Event()
 
 # === DEFAULT GLOBAL DICTS ===
 USER_STATE = {}
+# Auto 4 batches: each window collects APKs until it is sealed, then gets
+# processed on its own task. Batch ids are strings so they survive JSON.
+AUTO4_WINDOW = 20
 AUTO4_STATE = {
-    "pending_apks": [],
-    "timer": None,
-    "waiting_since": None,
-    "countdown_msg_id": None,
-    "setup_mode": 1
+    "batches": {},
+    "open_batch": None,
+    "next_batch_id": 1
 }
+AUTO4_TASKS = {}
 AUTO_SETUP = {}
 USER_DATA = {}
 
 # === Load config.json ===
+# Read synchronously on purpose: owner id, rate limits and the HTTP pool
+# settings are needed before the Application is built, and the file is a
+# few KB (tens of microseconds). Only state.json is deferred to STATE_READY.
 with open("config.json") as f:
     config = json.load(f)
 
@@ -99,45 +181,131 @@ CENTRAL_AUTHORITY_BTN = InlineKeyboardMarkup([
 ])
 
 # === Load saved state.json ===
+# At startup state.json is parsed in a worker thread while the bot is already
+# polling; handlers wait on STATE_READY until it has been applied.
+def keep_bad_state_file():
+    # The next save replaces state.json, so keep the unreadable copy for recovery
+    try:
+        shutil.copy(STATE_FILE, STATE_FILE + ".bad")
+    except OSError as e:
+        log_event("state", "error", "Could not keep a copy of state.json", error=str(e))
+
+def read_state_file() -> dict:
+    if not os.path.exists(STATE_FILE):
+        return {}
+    try:
+        with open(STATE_FILE, "r") as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError(f"expected an object, got {type(data).__name__}")
+        return data
+    except Exception as e:
+        log_event("state", "error", "Failed to load state.json", error=str(e))
+        keep_bad_state_file()
+        return {}
+
+def apply_state(data: dict):
+    # Handlers wait on STATE_READY, so it is set even when the state is bad
+    try:
+        # Safely load user state
+        restored_users = data.get("user_state", {})
+        for uid, udata in restored_users.items():
+            USER_STATE[int(uid)] = udata  # Convert to int for consistency
+        restore_auto4_state(data.get("auto4_state", {}))
+        AUTO_SETUP.update(data.get("auto_setup", {}))
+        USER_DATA.update(data.get("user_data", {}))
+        DEDUP_INDEX.update(data.get("dedup_index", {}))
+        DEDUP_STATS.update(data.get("dedup_stats", {}))
+        # Older builds stored whole captions here; those samples are dropped
+        KEY_CORPUS[:] = [s for s in data.get("key_corpus", []) if isinstance(s, dict) and "rules" in s][-KEY_CORPUS_MAX:]
+        BACKFILL_JOBS.update(data.get("backfill_jobs", {}))
+        AUTO_HOLDS.update(data.get("auto_holds", {}))
+        BROADCAST_JOB.update(data.get("broadcast_job", {}))
+    except Exception as e:
+        log_event("state", "error", "Failed to apply state.json", error=str(e))
+        keep_bad_state_file()
+    finally:
+        STATE_READY.set()
+
 def load_state():
-    global USER_STATE, AUTO4_STATE, AUTO_SETUP, USER_DATA, ALLOWED_USERS
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, "r") as f:
-                data = json.load(f)
-                # Safely load user state
-                restored_users = data.get("user_state", {})
-                for uid, udata in restored_users.items():
-                    USER_STATE[int(uid)] = udata  # Convert to int for consistency
-                AUTO4_STATE.update(data.get("auto4_state", {}))
-                AUTO_SETUP.update(data.get("auto_setup", {}))
-                USER_DATA.update(data.get("user_data", {}))
-        except json.JSONDecodeError as e:
-            print(f"[ERROR] Failed to load state.json: {e}")
+    # Synchronous reload of both files, used after a backup restore
+    global ALLOWED_USERS
+    apply_state(read_state_file())
 
     if os.path.exists("config.json"):
         with open("config.json") as f:
-            config = json.load(f)
-            ALLOWED_USERS = set(config.get("allowed_users", []))
+            ALLOWED_USERS = set(json.load(f).get("allowed_users", []))
+
+async def load_state_async():
+    try:
+        data = await asyncio.to_thread(read_state_file)
+    except Exception as e:
+        log_event("state", "error", "Failed to read state.json", error=str(e))
+        data = {}
+    apply_state(data)
+
+# === STARTUP ===
+# Seconds since BOOT_CLOCK at which each startup phase was first reached.
+STARTUP_MARKS = {}
+
+def mark_startup(phase: str) -> bool:
+    if phase in STARTUP_MARKS:
+        return False
+    STARTUP_MARKS[phase] = time.perf_counter() - BOOT_CLOCK
+    return True
+
+def restore_auto4_state(saved: dict):
+    AUTO4_STATE["batches"] = {str(bid): batch for bid, batch in saved.get("batches", {}).items()}
+    AUTO4_STATE["open_batch"] = saved.get("open_batch")
+    AUTO4_STATE["next_batch_id"] = saved.get("next_batch_id", 1)
+
+    # Older state files kept one flat pending list; turn it into a batch
+    if saved.get("pending_apks"):
+        batch_id = str(AUTO4_STATE["next_batch_id"])
+        AUTO4_STATE["next_batch_id"] += 1
+        AUTO4_STATE["batches"][batch_id] = {
+            "id": batch_id,
+            "apks": saved["pending_apks"],
+            "opened_at": saved.get("waiting_since") or time.time(),
+            "sealed": False
+        }
+
+def _json_skip(value):
+    # Tasks and telegram objects live in the state dicts but are not persisted
+    return None
 
 def save_state():
+    if not STATE_READY.is_set():
+        # Writing now would replace state.json with a half-empty snapshot
+        log_event("state", "warning", "state.json not loaded yet; skipping save")
+        return
     try:
         # Ensure keys are saved as strings for JSON compatibility
         serializable_user_state = {
             str(user_id): data for user_id, data in USER_STATE.items()
         }
 
-        with open(STATE_FILE, "w") as f:
+        started = time.perf_counter()
+        tmp_file = f"{STATE_FILE}.tmp"
+        with open(tmp_file, "w") as f:
             json.dump({
                 "user_state": serializable_user_state,
                 "auto4_state": AUTO4_STATE,
                 "auto_setup": AUTO_SETUP,
-                "user_data": USER_DATA
-            }, f, indent=4)
-
-        print("[STATE] Saved state.json successfully.")
+                "user_data": USER_DATA,
+                "dedup_index": DEDUP_INDEX,
+                "dedup_stats": DEDUP_STATS,
+                "key_corpus": KEY_CORPUS,
+                "backfill_jobs": BACKFILL_JOBS,
+                "auto_holds": AUTO_HOLDS,
+                "broadcast_job": BROADCAST_JOB
+            }, f, indent=4, default=_json_skip)
+        os.replace(tmp_file, STATE_FILE)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        record_latency(PERSIST_METRICS, "state", elapsed_ms)
+        log_event("state", "debug", "Saved state.json", ms=round(elapsed_ms, 1))
     except Exception as e:
-        print(f"[ERROR] Failed to save state.json: {e}")
+        log_event("state", "error", "Failed to save state.json", error=str(e))
 
 def update_user_stats(user_id: int, method: str, apks: int = 0, keys: int = 0):
     if user_id not in USER_STATE:
@@ -157,6 +325,7 @@ def update_user_stats(user_id: int, method: str, apks: int = 0, keys: int = 0):
         USER_STATE[user_id][f"{scope}_{method}_keys"] = USER_STATE[user_id].get(f"{scope}_{method}_keys", 0) + keys
 
 def save_config():
+    started = time.perf_counter()
     with open("config.json", "w") as f:
         json.dump({
             "owner_id": OWNER_ID,
@@ -164,8 +333,12 @@ def save_config():
             "user_data": USER_DATA,
             "auto_setup": AUTO_SETUP,
             "bot_active": BOT_ACTIVE,
-            "bot_admin_link": BOT_ADMIN_LINK
+            "bot_admin_link": BOT_ADMIN_LINK,
+            "scratch_chat_id": SCRATCH_CHAT_ID,
+            "rate_limits": RATE_LIMITS,
+            "http": HTTP_CLIENT
         }, f, indent=4)
+    record_latency(PERSIST_METRICS, "config", (time.perf_counter() - started) * 1000)
 
 def save_auto_setup():
     if os.path.exists("config.json"):
@@ -176,7 +349,957 @@ def save_auto_setup():
             with open("config.json", "w") as f:
                 json.dump(data, f, indent=4)
         except Exception as e:
-            print(f"[ERROR] save_auto_setup failed: {e}")
+            log_event("config", "error", "save_auto_setup failed", error=str(e))
+
+# === DUPLICATE APK INDEX ===
+# Entries are "file_unique_id|destination|key" -> last post time. Dict order is
+# insertion order, so the oldest entries always sit at the front.
+DEDUP_TTL = 7 * 86400
+DEDUP_MAX_ENTRIES = 5000
+DEDUP_INDEX = {}
+DEDUP_STATS = {"hits": 0, "misses": 0}
+
+def dedup_entry_key(file_unique_id, dest, key=None) -> str:
+    return f"{file_unique_id}|{dest}|{key or ''}"
+
+def dedup_prune(now=None):
+    now = now or time.time()
+    for entry_key in list(DEDUP_INDEX):
+        if now - DEDUP_INDEX[entry_key] < DEDUP_TTL:
+            break
+        del DEDUP_INDEX[entry_key]
+
+    while len(DEDUP_INDEX) > DEDUP_MAX_ENTRIES:
+        del DEDUP_INDEX[next(iter(DEDUP_INDEX))]
+
+def dedup_is_duplicate(file_unique_id, dest, key=None) -> bool:
+    if not file_unique_id or not dest:
+        return False
+
+    seen_at = DEDUP_INDEX.get(dedup_entry_key(file_unique_id, dest, key))
+    if seen_at and time.time() - seen_at < DEDUP_TTL:
+        DEDUP_STATS["hits"] += 1
+        return True
+
+    DEDUP_STATS["misses"] += 1
+    return False
+
+def dedup_remember(file_unique_id, dest, key=None):
+    if not file_unique_id or not dest:
+        return None
+
+    entry_key = dedup_entry_key(file_unique_id, dest, key)
+    DEDUP_INDEX.pop(entry_key, None)  # re-insert at the end
+    DEDUP_INDEX[entry_key] = time.time()
+    dedup_prune()
+    return entry_key
+
+def dedup_forget(entry_key):
+    if entry_key:
+        DEDUP_INDEX.pop(entry_key, None)
+
+# === SOURCE MESSAGE VERIFICATION ===
+# A source post is probed by forwarding it silently into the scratch chat
+# (config.json "scratch_chat_id", a private group or channel only the bot
+# posts in, set with /setscratch) and deleting the copy straight away. Until
+# one is set the probes go to the owner's chat like the original check, and
+# the owner is told so at startup. Results are cached per
+# message id so the Auto 1-3 hold and the Auto 4 batches share them. Only
+# Telegram's "message not found" counts as deleted, and that result is final.
+# Any other error (flood waits, timeouts, missing rights) leaves the post unverified:
+# it is treated as alive and nothing is cached.
+SCRATCH_CHAT_ID = config.get("scratch_chat_id")
+VERIFY_ALIVE_TTL = 5
+VERIFY_CACHE_MAX = 2000
+VERIFY_CONCURRENCY = 5
+VERIFY_CACHE = {}
+VERIFY_STATS = {"probes": 0, "cache_hits": 0, "deleted": 0, "unverified": 0}
+VERIFY_SLOTS = {"semaphore": None}
+
+def _verify_cache_key(chat_id, message_id) -> str:
+    return f"{chat_id}:{message_id}"
+
+def mark_message_alive(chat_id, message_id):
+    VERIFY_CACHE[_verify_cache_key(chat_id, message_id)] = (True, time.time())
+
+def is_message_missing(error: Exception) -> bool:
+    text = str(error).lower()
+    return isinstance(error, BadRequest) and ("message to forward not found" in text or "message not found" in text)
+
+def probe_chat_id():
+    return SCRATCH_CHAT_ID or OWNER_ID
+
+async def _delete_probe_copies(bot, message_ids):
+    await asyncio.gather(
+        *(bot.delete_message(chat_id=probe_chat_id(), message_id=mid) for mid in message_ids),
+        return_exceptions=True
+    )
+
+async def _probe_message(bot, chat_id, message_id):
+    # True/False when Telegram answered, None when the probe said nothing
+    semaphore = VERIFY_SLOTS["semaphore"]
+    if semaphore is None:
+        semaphore = VERIFY_SLOTS["semaphore"] = asyncio.Semaphore(VERIFY_CONCURRENCY)
+    async with semaphore:
+        try:
+            probe = await bot.forward_message(
+                chat_id=probe_chat_id(),
+                from_chat_id=chat_id,
+                message_id=message_id,
+                disable_notification=True
+            )
+        except BadRequest as e:
+            if is_message_missing(e):
+                return False
+            log_event("verify", "warning", "Probe failed", chat_id=chat_id, message_id=message_id, error=str(e))
+            return None
+        except TelegramError as e:
+            # Flood waits, timeouts, missing rights, migrated chats...
+            log_event("verify", "warning", "Probe failed", chat_id=chat_id, message_id=message_id, error=str(e))
+            return None
+
+    await _delete_probe_copies(bot, [probe.message_id])
+    return True
+
+async def verify_messages_exist(bot, chat_id, message_ids) -> dict:
+    now = time.time()
+    results = {}
+    pending = []
+
+    for mid in message_ids:
+        cached = VERIFY_CACHE.get(_verify_cache_key(chat_id, mid))
+        if cached and (not cached[0] or now - cached[1] < VERIFY_ALIVE_TTL):
+            VERIFY_STATS["cache_hits"] += 1
+            results[mid] = cached[0]
+        else:
+            pending.append(mid)
+
+    if not pending:
+        return results
+
+    VERIFY_STATS["probes"] += len(pending)
+    probed = await asyncio.gather(*(_probe_message(bot, chat_id, mid) for mid in pending), return_exceptions=True)
+
+    for mid, exists in zip(pending, probed):
+        if isinstance(exists, Exception):
+            log_event("verify", "error", "Probe crashed", chat_id=chat_id, message_id=mid, error=str(exists))
+            exists = None
+        if exists is None:
+            VERIFY_STATS["unverified"] += 1
+            results[mid] = True
+            continue
+        cache_key = _verify_cache_key(chat_id, mid)
+        VERIFY_CACHE.pop(cache_key, None)
+        VERIFY_CACHE[cache_key] = (exists, now)
+        results[mid] = exists
+        if not exists:
+            VERIFY_STATS["deleted"] += 1
+
+    while len(VERIFY_CACHE) > VERIFY_CACHE_MAX:
+        del VERIFY_CACHE[next(iter(VERIFY_CACHE))]
+
+    return results
+
+# === CHANNEL PUBLISHING ===
+MEDIA_GROUP_LIMIT = 10
+
+def build_post_link(channel_id, message_id) -> str:
+    channel = str(channel_id).strip()
+    if channel.startswith("@"):
+        return f"https://t.me/{channel[1:]}/{message_id}"
+    if channel.startswith("-100"):
+        return f"https://t.me/c/{channel[4:]}/{message_id}"
+    if re.fullmatch(r"[A-Za-z][A-Za-z0-9_]{4,31}", channel):
+        # Public username saved without the "@"
+        return f"https://t.me/{channel}/{message_id}"
+    return "Unknown"
+
+async def publish_documents(bot, chat_id, items, disable_notification=False) -> list:
+    # items: [(file_id, caption_or_None)]. Batches go out as albums so each
+    # chunk of up to 10 files is one API call and appears in the channel at once
+    sent = []
+    for start in range(0, len(items), MEDIA_GROUP_LIMIT):
+        chunk = items[start:start + MEDIA_GROUP_LIMIT]
+        if len(chunk) == 1:
+            file_id, caption = chunk[0]
+            msg = await bot.send_document(
+                chat_id=chat_id,
+                document=file_id,
+                caption=caption,
+                parse_mode="HTML" if caption else None,
+                disable_notification=disable_notification
+            )
+            sent.append(msg)
+            continue
+
+        media = [
+            InputMediaDocument(media=file_id, caption=caption, parse_mode="HTML")
+            if caption else InputMediaDocument(media=file_id)
+            for file_id, caption in chunk
+        ]
+        sent.extend(await bot.send_media_group(
+            chat_id=chat_id,
+            media=media,
+            disable_notification=disable_notification
+        ))
+    return sent
+
+async def _edit_caption(bot, chat_id, message_id, caption) -> bool:
+    try:
+        await bot.edit_message_caption(
+            chat_id=chat_id,
+            message_id=message_id,
+            caption=caption or None,
+            parse_mode="HTML" if caption else None
+        )
+        return True
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return True
+        log_event("publish", "warning", "Caption edit failed", message_id=message_id, error=str(e))
+        return False
+    except Exception as e:
+        log_event("publish", "warning", "Caption edit failed", message_id=message_id, error=str(e))
+        return False
+
+async def rewrite_captions(bot, chat_id, message_ids, file_ids, captions) -> list:
+    # Edit the posted album in place; repost only if any edit is impossible
+    if message_ids and len(message_ids) == len(file_ids):
+        results = await asyncio.gather(*(
+            _edit_caption(bot, chat_id, mid, caption)
+            for mid, caption in zip(message_ids, captions)
+        ))
+        if all(results):
+            return list(message_ids)
+
+    new_posts = await publish_documents(bot, chat_id, list(zip(file_ids, captions)))
+    await asyncio.gather(
+        *(bot.delete_message(chat_id=chat_id, message_id=mid) for mid in message_ids),
+        return_exceptions=True
+    )
+    return [msg.message_id for msg in new_posts]
+
+# === CAPTION ENGINE ===
+# Templates are split on the "Key -" placeholder once and cached by their
+# text, so editing a caption simply produces a new cache entry.
+KEY_PLACEHOLDER = "Key -"
+CAPTION_CACHE_MAX = 256
+CAPTION_CACHE = {}
+
+KEY_LINE_FORMATS = {
+    "quote": lambda key: f"<blockquote>Key - <code>{key}</code></blockquote>",
+    "mono": lambda key: f"Key - <code>{key}</code>",
+    "normal": lambda key: f"Key - {key}"
+}
+BARE_KEY_FORMATS = {
+    "quote": lambda key: f"<blockquote><code>{key}</code></blockquote>",
+    "mono": lambda key: f"<code>{key}</code>",
+    "normal": lambda key: f"{key}"
+}
+
+# layout -> (position of the last APK, position of the others)
+CAPTION_LAYOUTS = {
+    "spread": ("full", "key_line"),
+    "last_full": ("full", None),
+    "last_key": ("key_line", None),
+    "last_bare": ("bare_key", None),
+    "last_top": ("key_top", None)
+}
+
+def compile_caption(template: str) -> tuple:
+    compiled = CAPTION_CACHE.get(template)
+    if compiled is None:
+        parts = tuple(template.split(KEY_PLACEHOLDER))
+        compiled = (parts, "".join(parts).strip())
+        CAPTION_CACHE[template] = compiled
+        while len(CAPTION_CACHE) > CAPTION_CACHE_MAX:
+            del CAPTION_CACHE[next(iter(CAPTION_CACHE))]
+    return compiled
+
+def render_caption(template: str, key: str, style: str = "mono", position: str = "full", key_line: str = None):
+    if position is None:
+        return None
+    if position == "bare_key":
+        return BARE_KEY_FORMATS.get(style, BARE_KEY_FORMATS["normal"])(key)
+    if position == "key_top":
+        return f"{BARE_KEY_FORMATS.get(style, BARE_KEY_FORMATS['normal'])(key)}\n{compile_caption(template or '')[1]}"
+
+    key_line = key_line or KEY_LINE_FORMATS.get(style, KEY_LINE_FORMATS["normal"])(key)
+    if position == "key_line":
+        return key_line
+    parts = compile_caption(template or "")[0]
+    return key_line.join(parts) if len(parts) > 1 else parts[0]
+
+def render_session_captions(template: str, key: str, style: str, count: int, layout: str = "spread") -> list:
+    last_position, other_position = CAPTION_LAYOUTS[layout]
+    key_line = KEY_LINE_FORMATS.get(style, KEY_LINE_FORMATS["normal"])(key)
+    last = render_caption(template, key, style, last_position, key_line)
+    if count == 1:
+        return [last]
+    other = render_caption(template, key, style, other_position, key_line)
+    return [other] * (count - 1) + [last]
+
+# === KEY EXTRACTION ===
+KEY_LABEL_PATTERN = re.compile(r'Key\s*-\s*(\S+)')
+KEY_LINE_PATTERN = re.compile(r'^[^\w\n]*(?:key|pass(?:word)?)\s*[:=\-–]\s*(\S+)', re.I | re.M)
+
+DEFAULT_KEY_RULES = ["regex", "code"]
+MANUAL_KEY_RULES = ["regex"]
+
+KEY_CORPUS_MAX = 200
+KEY_CORPUS = []
+
+def utf16_slice(text: str, offset: int, length: int) -> str:
+    # Entity offsets count UTF-16 code units; only astral chars (emoji) differ
+    if text.isascii():
+        return text[offset:offset + length]
+    encoded = text.encode("utf-16-le")
+    return encoded[offset * 2:(offset + length) * 2].decode("utf-16-le", errors="ignore")
+
+def _entity_text(caption, entities, entity_type):
+    for entity in entities or []:
+        if isinstance(entity, dict):
+            etype, offset, length = entity.get("type"), entity.get("offset", 0), entity.get("length", 0)
+        else:
+            etype, offset, length = entity.type, entity.offset, entity.length
+        if etype == entity_type:
+            text = utf16_slice(caption, offset, length).strip()
+            if text:
+                return text
+    return None
+
+def _key_from_pattern(pattern):
+    search = pattern.search
+    def rule(caption, entities):
+        match = search(caption)
+        return match.group(1) if match else None
+    return rule
+
+def _key_from_entity(entity_type):
+    def rule(caption, entities):
+        return _entity_text(caption, entities, entity_type) if entities else None
+    return rule
+
+KEY_RULES = {
+    "regex": _key_from_pattern(KEY_LABEL_PATTERN),
+    "code": _key_from_entity("code"),
+    "pre": _key_from_entity("pre"),
+    "label_line": _key_from_pattern(KEY_LINE_PATTERN),
+    "spoiler": _key_from_entity("spoiler")
+}
+
+def key_rules_for(setup: dict) -> list:
+    rules = setup.get("key_rules")
+    if rules:
+        return rules
+    return MANUAL_KEY_RULES if setup.get("key_mode") == "manual" else DEFAULT_KEY_RULES
+
+KEY_RULE_CHAINS = {}
+
+def _rule_chain(rules) -> tuple:
+    names = tuple(rules or DEFAULT_KEY_RULES)
+    chain = KEY_RULE_CHAINS.get(names)
+    if chain is None:
+        chain = tuple(KEY_RULES[name] for name in names if name in KEY_RULES)
+        KEY_RULE_CHAINS[names] = chain
+    return chain
+
+def extract_key(caption, entities=None, rules=None):
+    if not caption:
+        return None
+    for rule in _rule_chain(rules):
+        key = rule(caption, entities)
+        if key:
+            return key
+    return None
+
+def record_key_sample(caption, entities, key):
+    # Which rules find a key in live captions; the caption text is never kept
+    if not caption:
+        return
+    KEY_CORPUS.append({
+        "key": hashlib.sha256(key.encode()).hexdigest()[:16] if key else None,
+        "rules": [name for name, rule in KEY_RULES.items() if rule(caption, entities)]
+    })
+    del KEY_CORPUS[:-KEY_CORPUS_MAX]
+
+def key_rule_summary() -> str:
+    if not KEY_CORPUS:
+        return "no captions yet"
+    hits = {name: sum(1 for sample in KEY_CORPUS if name in sample["rules"]) for name in KEY_RULES}
+    missed = sum(1 for sample in KEY_CORPUS if not sample["key"])
+    return ", ".join(f"{name} {count}" for name, count in hits.items()) + f"; no key {missed}/{len(KEY_CORPUS)}"
+
+# === FILE METADATA CACHE ===
+# Captured from the Document when an upload arrives, so previews and the
+# countdown never need a getFile round trip. get_file is only the fallback
+# (e.g. sessions restored from state.json after a restart).
+FILE_META_MAX = 1000
+FILE_META = {}
+
+def _store_file_meta(file_id, meta):
+    FILE_META.pop(file_id, None)
+    FILE_META[file_id] = meta
+    while len(FILE_META) > FILE_META_MAX:
+        del FILE_META[next(iter(FILE_META))]
+    return meta
+
+def remember_file_meta(doc) -> dict:
+    return _store_file_meta(doc.file_id, {
+        "size": doc.file_size,
+        "name": doc.file_name or "",
+        "unique_id": doc.file_unique_id
+    })
+
+def file_meta(file_id) -> dict:
+    return FILE_META.get(file_id) or {}
+
+async def _fetch_file_meta(bot, file_id):
+    try:
+        info = await bot.get_file(file_id)
+    except Exception as e:
+        log_event("files", "warning", "get_file failed", file_id=file_id, error=str(e))
+        return {}
+    return _store_file_meta(file_id, {
+        "size": info.file_size,
+        "name": "",
+        "unique_id": info.file_unique_id
+    })
+
+async def resolve_file_meta(bot, file_ids) -> list:
+    missing = [fid for fid in file_ids if not file_meta(fid).get("size")]
+    if missing:
+        await asyncio.gather(*(_fetch_file_meta(bot, fid) for fid in missing))
+    return [file_meta(fid) for fid in file_ids]
+
+def file_size_mb(meta):
+    size = meta.get("size")
+    return round(size / (1024 * 1024), 2) if size else None
+
+# === RATE LIMITING ===
+# One token bucket per (kind, user): `burst` clicks/messages at once, refilled
+# at `rate` per second. A bucket idle long enough to be full again carries no
+# information, so it is dropped. Limits can be overridden per kind in
+# config.json under "rate_limits".
+RATE_LIMIT_DEFAULTS = {
+    "callback": {"rate": 1.0, "burst": 5},
+    "text": {"rate": 1.0, "burst": 5},
+    "upload": {"rate": 2.0, "burst": 20}
+}
+RATE_LIMITS = {
+    kind: {**limits, **config.get("rate_limits", {}).get(kind, {})}
+    for kind, limits in RATE_LIMIT_DEFAULTS.items()
+}
+RATE_BUCKETS = {}
+RATE_STATS = {"allowed": 0, "dropped": 0, "last_prune": 0.0}
+RATE_PRUNE_INTERVAL = 60
+
+def rate_limit_kind(update):
+    if update.callback_query:
+        return "callback"
+    message = update.message
+    if message and message.chat.type == "private":
+        if message.document:
+            return "upload"
+        if message.text:
+            return "text"
+    return None
+
+def rate_limit_prune(now: float):
+    RATE_STATS["last_prune"] = now
+    for key, (tokens, last) in list(RATE_BUCKETS.items()):
+        limits = RATE_LIMITS[key[0]]
+        if tokens + (now - last) * limits["rate"] >= limits["burst"]:
+            del RATE_BUCKETS[key]
+
+def rate_limit_take(kind: str, user_id: int, now=None) -> bool:
+    limits = RATE_LIMITS.get(kind)
+    if not limits or user_id == OWNER_ID:
+        return True
+
+    now = now or time.monotonic()
+    if now - RATE_STATS["last_prune"] >= RATE_PRUNE_INTERVAL:
+        rate_limit_prune(now)
+
+    key = (kind, user_id)
+    bucket = RATE_BUCKETS.get(key)
+    tokens = limits["burst"] if bucket is None else min(limits["burst"], bucket[0] + (now - bucket[1]) * limits["rate"])
+
+    if tokens < 1:
+        RATE_BUCKETS[key] = [tokens, now]
+        RATE_STATS["dropped"] += 1
+        return False
+
+    RATE_BUCKETS[key] = [tokens - 1, now]
+    RATE_STATS["allowed"] += 1
+    return True
+
+# === METRICS ===
+# Every handler and every Bot API call lands in a fixed-size histogram, so
+# memory stays flat no matter how long the bot runs. Buckets are upper bounds
+# in ms; percentiles report the bound of the bucket the rank falls into.
+METRIC_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+HANDLER_METRICS = {}
+API_METRICS = {}
+API_STATS = {
+    "last_poll": 0.0, "flood_waits": 0, "flood_wait_s": 0.0, "retries": 0,
+    "dropped": 0, "coalesced": 0, "throttled_s": 0.0, "last_prune": 0.0
+}
+PERSIST_METRICS = {}
+BROADCAST_STATS = {"sent": 0, "failed": 0}
+RECENT_HANDLER_MS = deque(maxlen=512)
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_MS = deque(maxlen=120)
+HANDLER_RUN = contextvars.ContextVar("handler_run", default=None)
+
+def new_histogram() -> dict:
+    return {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "buckets": [0] * (len(METRIC_BUCKETS_MS) + 1)}
+
+def record_latency(table: dict, name: str, elapsed_ms: float, error: bool = False):
+    hist = table.get(name)
+    if hist is None:
+        hist = table[name] = new_histogram()
+    hist["count"] += 1
+    hist["errors"] += error
+    hist["total_ms"] += elapsed_ms
+    hist["max_ms"] = max(hist["max_ms"], elapsed_ms)
+    hist["buckets"][bisect.bisect_left(METRIC_BUCKETS_MS, elapsed_ms)] += 1
+
+def histogram_percentile(hist: dict, q: float) -> float:
+    if not hist["count"]:
+        return 0.0
+    rank = q * hist["count"]
+    seen = 0
+    for index, hits in enumerate(hist["buckets"]):
+        seen += hits
+        if seen >= rank:
+            return METRIC_BUCKETS_MS[index] if index < len(METRIC_BUCKETS_MS) else hist["max_ms"]
+    return hist["max_ms"]
+
+def recent_percentile(samples, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def monitor_loop_lag():
+    # How late a short sleep wakes up is how long the loop was blocked
+    try:
+        while True:
+            started = WATCHDOG["heartbeat"] = time.perf_counter()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            LOOP_LAG_MS.append(max(0.0, (time.perf_counter() - started - LOOP_LAG_INTERVAL) * 1000))
+    finally:
+        # A stopped monitor is not a stalled loop
+        WATCHDOG["heartbeat"] = 0.0
+
+def format_metrics_table(table: dict, limit: int = 10) -> str:
+    rows = sorted(table.items(), key=lambda item: item[1]["total_ms"], reverse=True)[:limit]
+    if not rows:
+        return "  (nothing yet)\n"
+    lines = [f"  {'name':<18} {'count':>6} {'err%':>5} {'p50':>6} {'p95':>6} {'p99':>6}"]
+    for name, hist in rows:
+        lines.append(
+            f"  {name[:18]:<18} {hist['count']:>6} {100 * hist['errors'] / hist['count']:>5.1f} "
+            f"{histogram_percentile(hist, 0.50):>6g} {histogram_percentile(hist, 0.95):>6g} "
+            f"{histogram_percentile(hist, 0.99):>6g}"
+        )
+    return "\n".join(lines) + "\n"
+
+def instrumented(callback):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        # notify_owner_on_error flips "failed" for errors the handler swallows
+        run = {"failed": False}
+        token = HANDLER_RUN.set(run)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            run["failed"] = True
+            raise
+        finally:
+            HANDLER_RUN.reset(token)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            RECENT_HANDLER_MS.append(elapsed_ms)
+            record_latency(HANDLER_METRICS, name, elapsed_ms, run["failed"])
+
+    return wrapper
+
+def instrument_handlers(application: Application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrumented(handler.callback)
+
+# === HTTP CLIENT ===
+# Bot API requests go over two httpx pools: a large one for outgoing calls and
+# a small one reserved for getUpdates, so a broadcast can never starve polling.
+# Everything can be overridden in config.json under "http"; method_timeouts
+# (seconds, keys connect/read/write/pool) replace the default timeouts for
+# that Bot API method only.
+HTTP_CLIENT_DEFAULTS = {
+    "pool_size": 256,
+    "updates_pool_size": 1,
+    "connect_timeout": 5.0,
+    "read_timeout": 5.0,
+    "write_timeout": 5.0,
+    "pool_timeout": 5.0,
+    "keepalive_expiry": 30.0,
+    "method_timeouts": {
+        "sendDocument": {"read": 30, "write": 60},
+        "sendMediaGroup": {"read": 30, "write": 60},
+        "getFile": {"read": 15}
+    }
+}
+HTTP_TIMEOUT_KINDS = ("connect", "read", "write", "pool")
+
+def _positive(value, integer=False) -> bool:
+    if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)):
+        return False
+    return value > 0
+
+def load_http_client(raw) -> dict:
+    # A bad entry is logged and replaced by its default; startup never fails on it
+    if not isinstance(raw, dict):
+        log_event("config", "warning", f"Ignoring http={raw!r}; expected an object")
+        raw = {}
+    settings = dict(HTTP_CLIENT_DEFAULTS)
+    for name, value in raw.items():
+        if name == "method_timeouts" or name not in HTTP_CLIENT_DEFAULTS:
+            continue
+        if _positive(value, integer=name.endswith("pool_size")):
+            settings[name] = value
+        else:
+            log_event("config", "warning", f"Ignoring http.{name}={value!r}; using {HTTP_CLIENT_DEFAULTS[name]}")
+
+    method_timeouts = {method: dict(t) for method, t in HTTP_CLIENT_DEFAULTS["method_timeouts"].items()}
+    raw_methods = raw.get("method_timeouts", {})
+    if not isinstance(raw_methods, dict):
+        log_event("config", "warning", f"Ignoring http.method_timeouts={raw_methods!r}; expected an object")
+        raw_methods = {}
+    for method, timeouts in raw_methods.items():
+        if not isinstance(timeouts, dict):
+            log_event("config", "warning", f"Ignoring http.method_timeouts.{method}={timeouts!r}; expected an object")
+            continue
+        valid = {kind: value for kind, value in timeouts.items() if kind in HTTP_TIMEOUT_KINDS and _positive(value)}
+        if len(valid) != len(timeouts):
+            log_event("config", "warning", f"Ignoring invalid http.method_timeouts.{method} entries")
+        method_timeouts[method] = {**method_timeouts.get(method, {}), **valid}
+    settings["method_timeouts"] = method_timeouts
+    return settings
+
+HTTP_CLIENT = load_http_client(config.get("http", {}))
+
+class BotHttpRequest(HTTPXRequest):
+    # HTTPXRequest with a configurable keep-alive expiry for idle connections.
+    # PTB 20.6 (pinned in requirements.txt) has no public way to pass httpx
+    # limits, so this hooks its _build_client; recheck it when upgrading PTB.
+    def __init__(self, pool_size: int, keepalive_expiry: float, **timeouts):
+        self._keepalive_expiry = keepalive_expiry
+        super().__init__(connection_pool_size=pool_size, **timeouts)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = self._client_kwargs["limits"]
+        self._client_kwargs["limits"] = httpx.Limits(
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=self._keepalive_expiry
+        )
+        return super()._build_client()
+
+def build_http_request(pool_size: int) -> BotHttpRequest:
+    return BotHttpRequest(
+        pool_size,
+        HTTP_CLIENT["keepalive_expiry"],
+        connect_timeout=HTTP_CLIENT["connect_timeout"],
+        read_timeout=HTTP_CLIENT["read_timeout"],
+        write_timeout=HTTP_CLIENT["write_timeout"],
+        pool_timeout=HTTP_CLIENT["pool_timeout"]
+    )
+
+# === BOT API CLIENT ===
+# Every Bot API request goes through BotApiClient._do_post. Sends and edits are
+# paced by a global and a per-chat token bucket (Telegram allows ~30 msg/s in
+# total, ~1/s per private chat, ~20/min per group or channel). A RetryAfter
+# pauses that chat (or everything, when no chat is known) and the call is
+# retried. Edits of a message that arrive while an earlier edit of it is still
+# waiting are folded into that one, so only the latest content is sent; in
+# private chats they skip the per-chat bucket so per-second countdowns keep
+# time. The scratch chat only holds probe copies that are deleted at once, so
+# it has its own, larger budget; RetryAfter remains the backstop for both.
+API_LIMITS = {
+    "global": {"rate": 30.0, "burst": 30},
+    "private": {"rate": 1.0, "burst": 3},
+    "group": {"rate": 20 / 60, "burst": 10},
+    "scratch": {"rate": 1.0, "burst": 20}
+}
+API_PACED_PREFIXES = ("send", "edit", "copyMessage", "forwardMessage")
+API_MAX_RETRIES = 3
+API_MAX_RETRY_WAIT = 60
+API_BUCKETS = {}
+API_PAUSED_UNTIL = {}
+API_EDITS = {}
+
+def api_chat_kind(chat_id) -> str:
+    if SCRATCH_CHAT_ID and str(chat_id) == str(SCRATCH_CHAT_ID):
+        return "scratch"
+    try:
+        return "private" if int(chat_id) > 0 else "group"
+    except (TypeError, ValueError):
+        return "group"  # @username of a channel or group
+
+def api_bucket_delay(key, limits: dict, now: float) -> float:
+    # Takes a token now; a negative balance is the queue of callers ahead
+    bucket = API_BUCKETS.get(key)
+    tokens = limits["burst"] if bucket is None else min(limits["burst"], bucket[0] + (now - bucket[1]) * limits["rate"])
+    API_BUCKETS[key] = [tokens - 1, now]
+    return 0.0 if tokens >= 1 else (1 - tokens) / limits["rate"]
+
+def api_prune(now: float):
+    API_STATS["last_prune"] = now
+    for key, (tokens, last) in list(API_BUCKETS.items()):
+        limits = API_LIMITS["global"] if key == "global" else API_LIMITS[api_chat_kind(key)]
+        if tokens + (now - last) * limits["rate"] >= limits["burst"]:
+            del API_BUCKETS[key]
+    for key, until in list(API_PAUSED_UNTIL.items()):
+        if until <= now:
+            del API_PAUSED_UNTIL[key]
+
+async def api_pace(chat_id, edit=False):
+    now = time.monotonic()
+    if now - API_STATS["last_prune"] > RATE_PRUNE_INTERVAL:
+        api_prune(now)
+
+    wait = max(API_PAUSED_UNTIL.get(None, 0), API_PAUSED_UNTIL.get(chat_id, 0)) - now
+    wait = max(wait, api_bucket_delay("global", API_LIMITS["global"], now))
+    kind = api_chat_kind(chat_id) if chat_id is not None else None
+    if kind is not None and not (edit and kind == "private"):
+        wait = max(wait, api_bucket_delay(chat_id, API_LIMITS[kind], now))
+    if wait > 0:
+        API_STATS["throttled_s"] += wait
+        await asyncio.sleep(wait)
+
+class BotApiClient(ExtBot):
+    async def _do_post(self, endpoint, data, *args, **kwargs):
+        paced = endpoint.startswith(API_PACED_PREFIXES)
+        chat_id = data.get("chat_id") if paced else None
+        edit = edit_key = None
+        if endpoint.startswith("edit") and chat_id is not None and "message_id" in data:
+            edit_key = (endpoint, chat_id, data["message_id"])
+            edit = API_EDITS.get(edit_key)
+            if edit is not None:
+                # That edit hasn't been sent yet: it goes out with our content
+                # and we share its result
+                edit["data"] = data
+                API_STATS["coalesced"] += 1
+                if edit["future"] is None:
+                    edit["future"] = asyncio.get_running_loop().create_future()
+                return await asyncio.shield(edit["future"])
+            edit = API_EDITS[edit_key] = {"data": data, "future": None}
+
+        outcome = None
+        try:
+            for attempt in range(API_MAX_RETRIES + 1):
+                if paced:
+                    await api_pace(chat_id, edit=edit is not None)
+                if edit is not None and API_EDITS.get(edit_key) is edit:
+                    # From here on a new edit must be sent after this one
+                    data = API_EDITS.pop(edit_key)["data"]
+
+                try:
+                    outcome = await self._timed_post(endpoint, data, *args, **kwargs)
+                    return outcome
+                except RetryAfter as e:
+                    wait = float(e.retry_after)
+                    API_STATS["flood_waits"] += 1
+                    API_STATS["flood_wait_s"] += wait
+                    if not paced:
+                        raise
+                    API_PAUSED_UNTIL[chat_id] = max(API_PAUSED_UNTIL.get(chat_id, 0), time.monotonic() + wait)
+                    if attempt == API_MAX_RETRIES or wait > API_MAX_RETRY_WAIT:
+                        API_STATS["dropped"] += 1
+                        log_event("api", "warning", "Dropped after RetryAfter", method=endpoint, chat_id=chat_id, retry_after=wait)
+                        raise
+                    API_STATS["retries"] += 1
+        except Exception as e:
+            outcome = e
+            raise
+        finally:
+            if edit is not None:
+                if API_EDITS.get(edit_key) is edit:
+                    del API_EDITS[edit_key]
+                future = edit["future"]
+                if future is not None and not future.done():
+                    if isinstance(outcome, Exception):
+                        future.set_exception(outcome)
+                    elif outcome is None:
+                        future.cancel()
+                    else:
+                        future.set_result(outcome)
+
+    async def _timed_post(self, endpoint, data, *args, **kwargs):
+        # Times every Bot API request by method name
+        timeouts = HTTP_CLIENT["method_timeouts"].get(endpoint)
+        if timeouts:
+            kwargs.update({f"{kind}_timeout": value for kind, value in timeouts.items()})
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await super()._do_post(endpoint, data, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            record_latency(API_METRICS, endpoint, (time.perf_counter() - started) * 1000, failed)
+            if endpoint == "getUpdates" and not failed:
+                API_STATS["last_poll"] = time.time()
+
+# === LOOP WATCHDOG ===
+# A plain thread watches the lag monitor's heartbeat. If the loop misses it
+# by more than BLOCK_THRESHOLD_MS, whatever the loop thread is running right
+# then is the blocking call; its stack is sent to the owner once the loop
+# is free again, at most once per code location per cooldown.
+BLOCK_THRESHOLD_MS = 250
+BLOCK_REPORT_COOLDOWN = 900
+WATCHDOG = {"heartbeat": 0.0, "thread": None, "loop": None, "loop_thread": None, "bot": None}
+BLOCK_REPORTS = {}
+BLOCK_STATS = {"stalls": 0, "reported": 0}
+
+def blocking_fingerprint(stack: list) -> str:
+    # Deepest frame inside this file, so library internals don't split reports
+    for frame in reversed(stack):
+        if frame.filename == __file__:
+            return f"{frame.name}:{frame.lineno}"
+    return f"{stack[-1].name}:{stack[-1].lineno}" if stack else "unknown"
+
+def watch_event_loop():
+    stalled = None
+    while True:
+        time.sleep(BLOCK_THRESHOLD_MS / 4000)
+        beat = WATCHDOG["heartbeat"]
+        if not beat:
+            stalled = None
+            continue
+
+        late_ms = (time.perf_counter() - beat - LOOP_LAG_INTERVAL) * 1000
+        if stalled is None and late_ms > BLOCK_THRESHOLD_MS:
+            frame = sys._current_frames().get(WATCHDOG["loop_thread"])
+            if frame is not None:
+                stalled = (beat, traceback.extract_stack(frame))
+                BLOCK_STATS["stalls"] += 1
+        elif stalled is not None and beat != stalled[0]:
+            # The new heartbeat is written right after the late wake-up
+            blocked_ms = (beat - stalled[0] - LOOP_LAG_INTERVAL) * 1000
+            stack = stalled[1]
+            stalled = None
+            try:
+                WATCHDOG["loop"].call_soon_threadsafe(report_blocking_call, stack, blocked_ms)
+            except RuntimeError:
+                pass  # loop already closed
+
+def report_blocking_call(stack: list, blocked_ms: float):
+    fingerprint = blocking_fingerprint(stack)
+    log_event("watchdog", "warning", "Event loop blocked", ms=round(blocked_ms), where=fingerprint)
+
+    now = time.time()
+    if now - BLOCK_REPORTS.get(fingerprint, 0) < BLOCK_REPORT_COOLDOWN or WATCHDOG["bot"] is None:
+        return
+    BLOCK_REPORTS[fingerprint] = now
+    BLOCK_STATS["reported"] += 1
+
+    trace = "".join(traceback.format_list(stack[-12:]))
+    msg = (
+        f"🐢 <b>[EVENT LOOP BLOCKED]</b>\n"
+        f"<b>⏱️ Blocked:</b> <code>~{blocked_ms:.0f} ms</code>\n"
+        f"<b>📍 Where:</b> <code>{escape(fingerprint)}</code>\n\n"
+        f"<b>📄 Stack:</b>\n<pre>{escape(trace[-3500:])}</pre>"
+    )
+    spawn_task("block_report", send_block_report(WATCHDOG["bot"], msg))
+
+async def send_block_report(bot, msg: str):
+    try:
+        await bot.send_message(OWNER_ID, msg, parse_mode="HTML")
+    except Exception as e:
+        log_event("watchdog", "error", "Failed to report blocking call", error=str(e))
+
+def start_loop_watchdog(app: Application):
+    # Called on every (re)start; the thread itself is started only once
+    WATCHDOG["loop"] = asyncio.get_running_loop()
+    WATCHDOG["loop_thread"] = threading.get_ident()
+    WATCHDOG["bot"] = app.bot
+    if WATCHDOG["thread"] is None:
+        WATCHDOG["thread"] = threading.Thread(target=watch_event_loop, name="loop-watchdog", daemon=True)
+        WATCHDOG["thread"].start()
+
+def stop_loop_watchdog():
+    # The thread is kept for the next start; without a heartbeat or bot it idles
+    WATCHDOG["bot"] = None
+    WATCHDOG["heartbeat"] = 0.0
+
+# === UPDATE ACTORS ===
+# Updates run concurrently, but everything from one user (or one channel,
+# for channel posts) goes through that actor's lock so USER_STATE is never
+# touched by two handlers of the same user at once. asyncio.Lock wakes
+# waiters in FIFO order, which keeps each actor's updates in arrival order.
+MAX_CONCURRENT_UPDATES = 64
+ACTOR_LOCKS = {}
+ACTOR_STATS = {"handled": 0, "contended": 0, "max_queue": 0}
+
+def actor_key(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return f"user:{update.effective_user.id}"
+    if update.effective_chat:
+        return f"chat:{update.effective_chat.id}"
+    return None
+
+def serialized(callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        if "first_update" not in STARTUP_MARKS and mark_startup("first_update"):
+            log_event("bot", "info", "First update handled", ms_after_boot=round(STARTUP_MARKS["first_update"] * 1000))
+        if not STATE_READY.is_set():
+            await STATE_READY.wait()
+
+        key = actor_key(update)
+        if key is None:
+            return await callback(update, context)
+
+        # Over-limit clicks and messages never reach a handler or the queue
+        kind = rate_limit_kind(update)
+        if kind and not rate_limit_take(kind, update.effective_user.id):
+            if update.callback_query:
+                # Stop the client spinner; a stale query is fine to ignore
+                try:
+                    await update.callback_query.answer("⌛ Wait a second...", show_alert=False)
+                except Exception:
+                    pass
+            return
+
+        # [lock, users]; the entry is dropped once nobody holds or waits on it
+        entry = ACTOR_LOCKS.get(key)
+        if entry is None:
+            entry = ACTOR_LOCKS[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        if entry[1] > 1:
+            ACTOR_STATS["contended"] += 1
+            ACTOR_STATS["max_queue"] = max(ACTOR_STATS["max_queue"], entry[1] - 1)
+        try:
+            async with entry[0]:
+                ACTOR_STATS["handled"] += 1
+                return await callback(update, context)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                ACTOR_LOCKS.pop(key, None)
+    return wrapper
+
+def serialize_handlers(application: Application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = serialized(handler.callback)
 
 # Add this helper function at top
 def parse_buttons_grid_2x2(raw: str) -> InlineKeyboardMarkup:
@@ -249,9 +1372,6 @@ def generate_method_keyboard(user_id: int) -> InlineKeyboardMarkup:
 
     return InlineKeyboardMarkup(buttons)
 
-# Load persisted state from previous session
-load_state()
-
 # === Keyboards ===
 owner_keyboard = ReplyKeyboardMarkup(
     keyboard=[
@@ -284,6 +1404,14 @@ async def autosave_task():
         async with state_lock:
             save_state()
 
+def write_backup_zip(zip_filename: str):
+    with zipfile.ZipFile(zip_filename, "w") as zipf:
+        for filename in ["config.json", "state.json", "main.py", "requirements.txt", "Procfile"]:
+            if os.path.exists(filename):
+                zipf.write(filename)
+            else:
+                log_event("backup", "warning", "File not found, skipping", file=filename)
+
 async def backup_config(context=None, query=None):
     now = datetime.now(ZoneInfo("Asia/Kolkata"))
     date_str = now.strftime("%d-%m-%Y")
@@ -294,14 +1422,9 @@ async def backup_config(context=None, query=None):
         save_state()
 
     try:
-        with zipfile.ZipFile(zip_filename, "w") as zipf:
-            for filename in ["config.json", "state.json", "main.py", "requirements.txt", "Procfile"]:
-                if os.path.exists(filename):
-                    zipf.write(filename)
-                else:
-                    print(f"[WARN] {filename} not found, skipping...")
+        await asyncio.to_thread(write_backup_zip, zip_filename)
     except Exception as e:
-        print(f"Error creating ZIP: {e}")
+        log_event("backup", "error", "Error creating ZIP", error=str(e))
         return
 
     if context:
@@ -324,7 +1447,7 @@ async def backup_config(context=None, query=None):
                     parse_mode="HTML"
                 )
         except Exception as e:
-            print(f"Failed to send backup: {e}")
+            log_event("backup", "error", "Failed to send backup", error=str(e))
 
     if os.path.exists(zip_filename):
         os.remove(zip_filename)
@@ -525,7 +1648,7 @@ async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "first_seen": int(time.time())
                 }
             except Exception as e:
-                print(f"[!] Failed to fetch user info: {e}")
+                log_event("users", "warning", "Failed to fetch user info", user_id=user_id, error=str(e))
                 USER_DATA[str(user_id)] = {
                     "first_name": "—",
                     "username": "—",
@@ -663,7 +1786,20 @@ async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
         hours, remainder = divmod(remainder, 3600)
         minutes, seconds = divmod(remainder, 60)
     
-        ping_ms = round(random.uniform(10, 60), 2)
+        started = time.perf_counter()
+        await context.bot.get_me()
+        api_ms = (time.perf_counter() - started) * 1000
+
+        loop_lag = f"{LOOP_LAG_MS[-1]:.1f} ms (max {max(LOOP_LAG_MS):.1f} ms/1m)" if LOOP_LAG_MS else "—"
+        queued = context.application.update_queue.qsize()
+        waiting = sum(entry[1] - 1 for entry in ACTOR_LOCKS.values())
+        if WEBHOOK_URL:
+            last_poll = "webhook"
+        elif API_STATS["last_poll"]:
+            last_poll = f"{time.time() - API_STATS['last_poll']:.1f}s ago"
+        else:
+            last_poll = "never"
+        handler_p95 = recent_percentile(RECENT_HANDLER_MS, 0.95)
         now = datetime.now(ZoneInfo("Asia/Kolkata"))
         date_str = now.strftime("%d-%m-%Y")
         time_str = now.strftime("%I:%M %p")
@@ -675,7 +1811,11 @@ async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"⏰ <b>Time:</b> <code>{time_str}</code>\n"
             f"🧾 <b>Update:</b> <code>{UPDATE_DATE}</code>\n"
             f"⏱️ <b>Uptime:</b> <code>{days}D {hours}H {minutes}M {seconds}S</code>\n"
-            f"⚡ <b>Latency:</b> <code>{ping_ms} ms</code>\n"
+            f"⚡ <b>API RTT:</b> <code>{api_ms:.1f} ms</code>\n"
+            f"🌀 <b>Loop Lag:</b> <code>{loop_lag}</code>\n"
+            f"📥 <b>Queue:</b> <code>{queued} queued, {waiting} waiting</code>\n"
+            f"📡 <b>Last Poll:</b> <code>{last_poll}</code>\n"
+            f"⏳ <b>Handler p95:</b> <code>{handler_p95:.1f} ms ({len(RECENT_HANDLER_MS)} recent)</code>\n"
             "━━━━━━━━━━━━━━━━━━━━━━━\n"
             f"🧠 <i>Powered by</i> <a href='https://t.me/Ceo_DarkFury'>@Ceo_DarkFury</a>"
         )
@@ -1090,27 +2230,15 @@ async def process_method1_apk(update: Update, context: ContextTypes.DEFAULT_TYPE
         doc = update.message.document
         caption = update.message.caption or ""
 
-        key = None
-
-        # Try regex extraction
-        match = re.search(r'Key\s*-\s*(\S+)', caption)
-        if match:
-            key = match.group(1)
-
-        # Try code entity fallback
-        if not key and update.message.caption_entities:
-            for entity in update.message.caption_entities:
-                if entity.type == "code":
-                    offset = entity.offset
-                    length = entity.length
-                    key = caption[offset:offset + length]
-                    break
+        # "Key -" label first, then a code entity
+        key = extract_key(caption, update.message.caption_entities)
 
         # Ask for key if still missing
         if not key:
             USER_STATE.setdefault(user_id, {})
             USER_STATE[user_id]["waiting_key"] = True
             USER_STATE[user_id]["file_id"] = doc.file_id
+            USER_STATE[user_id]["file_unique_id"] = doc.file_unique_id
             await update.message.reply_text(
                 text=(
                     "<blockquote>"
@@ -1137,12 +2265,14 @@ async def process_method1_apk(update: Update, context: ContextTypes.DEFAULT_TYPE
             return
 
         # Format caption with key
-        final_caption = saved_caption.replace("Key -", f"Key - <code>{key}</code>")
+        final_caption = render_caption(saved_caption, key, "mono")
 
         # Store pending APK
         USER_STATE.setdefault(user_id, {})
         USER_STATE[user_id]["pending_apk"] = {
             "file_id": doc.file_id,
+            "file_unique_id": doc.file_unique_id,
+            "key": key,
             "caption": final_caption,
             "channel": channel_id,
             "confirm_message_id": update.message.message_id
@@ -1189,6 +2319,7 @@ async def process_method2_apk(update: Update, context: ContextTypes.DEFAULT_TYPE
         file_name = doc.file_name or ""
     
         state = USER_STATE.setdefault(user_id, {})
+        remember_file_meta(doc)
     
         # Cancel old countdown task if key was pending
         if state.get("waiting_key"):
@@ -1277,7 +2408,7 @@ async def process_method2_apk(update: Update, context: ContextTypes.DEFAULT_TYPE
             try:
                 task.cancel()
             except Exception as e:
-                print(f"[Countdown Cancel Error] User: {user_id} | {e}")
+                log_event("method2", "warning", "Countdown cancel failed", user_id=user_id, error=str(e))
         
         # Start new countdown task
         new_task = asyncio.create_task(start_method2_countdown(user_id, context))
@@ -1303,13 +2434,13 @@ async def start_method2_countdown(user_id: int, context: ContextTypes.DEFAULT_TY
 
         # Build list of captured APKs
         apk_lines = []
-        for idx, (name, fid) in enumerate(zip(filenames, file_ids), start=1):
-            try:
-                file_info = await context.bot.get_file(fid)
-                size = round(file_info.file_size / (1024 * 1024), 2)
-                size_str = f"{size} MB" if size < 1024 else f"{round(size / 1024, 2)} GB"
-            except:
+        metas = await resolve_file_meta(context.bot, file_ids)
+        for idx, (name, meta) in enumerate(zip(filenames, metas), start=1):
+            size = file_size_mb(meta)
+            if size is None:
                 size_str = "— MB"
+            else:
+                size_str = f"{size} MB" if size < 1024 else f"{round(size / 1024, 2)} GB"
             apk_lines.append(f"➤ {idx}. {name} ({size_str})")
 
         apk_list = "\n".join(apk_lines) if apk_lines else "➤ No APKs yet."
@@ -1348,7 +2479,7 @@ async def start_method2_countdown(user_id: int, context: ContextTypes.DEFAULT_TY
                 reply_markup=keyboard
             )
         except Exception as e:
-            print(f"[Countdown Send Error] User: {user_id} | {e}")
+            log_event("method2", "error", "Countdown send failed", user_id=user_id, error=str(e))
             return
 
         state["countdown_msg_id"] = sent.message_id
@@ -1421,44 +2552,38 @@ async def method2_send_to_channel(user_id, context):
             )
             return
     
+        # Drop APKs that were already posted to this channel with the same key
+        metas = await resolve_file_meta(context.bot, session_files)
+        fresh = [
+            (file_id, name, meta.get("unique_id")) for file_id, name, meta in zip(session_files, session_filenames, metas)
+            if not dedup_is_duplicate(meta.get("unique_id"), channel_id, key)
+        ]
+        skipped_count = len(session_files) - len(fresh)
+
+        if not fresh:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text="♻️ <b>Duplicate APKs skipped.</b>\nEvery APK in this session was already posted to your channel with this key.",
+                parse_mode="HTML"
+            )
+            return
+
+        session_files = [file_id for file_id, _, _ in fresh]
+        session_filenames = [name for _, name, _ in fresh]
+        unique_ids = [unique_id for _, _, unique_id in fresh]
+
         # Auto-reset previous post data to avoid old delete targets
         state["apk_posts"] = []
         state["last_post_session"] = {}
 
-        posted_ids = []
-        last_message = None
-
-        for idx, file_id in enumerate(session_files, start=1):
-            is_last_apk = (idx == len(session_files))
-
-            # Build caption based on key mode
-            if key_mode == "quote":
-                caption = (
-                    saved_caption.replace("Key -", f"<blockquote>Key - <code>{key}</code></blockquote>")
-                    if is_last_apk or len(session_files) == 1
-                    else f"<blockquote>Key - <code>{key}</code></blockquote>"
-                )
-            elif key_mode == "mono":
-                caption = (
-                    saved_caption.replace("Key -", f"Key - <code>{key}</code>")
-                    if is_last_apk or len(session_files) == 1
-                    else f"Key - <code>{key}</code>"
-                )
-            else:
-                caption = (
-                    saved_caption.replace("Key -", f"Key - {key}")
-                    if is_last_apk or len(session_files) == 1
-                    else f"Key - {key}"
-                )
+        captions = render_session_captions(saved_caption, key, key_mode, len(session_files), "spread")
+        items = list(zip(session_files, captions))
 
-            sent_message = await context.bot.send_document(
-                chat_id=channel_id,
-                document=file_id,
-                caption=caption,
-                parse_mode="HTML"
-            )
-            posted_ids.append(sent_message.message_id)
-            last_message = sent_message
+        # Whole session as one album
+        sent_messages = await publish_documents(context.bot, channel_id, items)
+        posted_ids = [msg.message_id for msg in sent_messages]
+        dedup_keys = [dedup_remember(unique_id, channel_id, key) for unique_id in unique_ids]
+        last_message = sent_messages[-1] if sent_messages else None
 
         if not posted_ids:
             await context.bot.send_message(
@@ -1475,10 +2600,7 @@ async def method2_send_to_channel(user_id, context):
         # Build post link
         post_link = "Unknown"
         if last_message:
-            if str(channel_id).startswith("@"):
-                post_link = f"https://t.me/{channel_id.strip('@')}/{last_message.message_id}"
-            elif str(channel_id).startswith("-100"):
-                post_link = f"https://t.me/c/{channel_id.replace('-100', '')}/{last_message.message_id}"
+            post_link = build_post_link(channel_id, last_message.message_id)
             state["last_post_link"] = post_link
 
         # Save session details
@@ -1489,7 +2611,8 @@ async def method2_send_to_channel(user_id, context):
             "key_mode": key_mode,
             "caption_template": saved_caption,
             "channel_id": channel_id,
-            "post_message_ids": posted_ids
+            "post_message_ids": posted_ids,
+            "dedup_keys": dedup_keys
         }
         
        # Store message IDs for deletion panel
@@ -1520,11 +2643,14 @@ async def method2_send_to_channel(user_id, context):
         else:
             key_line = f"🔐 Key - {key}"
         
+        skipped_line = f"♻️ Skipped {skipped_count} duplicate APK(s)\n" if skipped_count else ""
+
         summary = (
             "<b>𝗖𝗵𝗮𝗻𝗻𝗲𝗹 𝗣𝗼𝘀𝘁𝗲𝗱 𝗜𝗻𝗳𝗼 💀</b>\n"
             "━━━━━━━━━━━━━━━━━━━━\n"
             f"<pre>{apk_quotes}</pre>\n\n"
             f"{key_line}\n"
+            f"{skipped_line}"
             "━━━━━━━━━━━━━━━━━━━━\n"
             "<i>𝚂𝚎𝚕𝚎𝚌𝚝 𝚊𝚗𝚢 𝚋𝚎𝚕𝚘𝚠</i>\n"
             "<i>𝚖𝚘𝚛𝚎 𝚏𝚎𝚊𝚝𝚞𝚛𝚎𝚜 𝚑𝚎𝚛𝚎 🔖</i>"
@@ -1594,14 +2720,11 @@ async def method2_convert_quote(user_id, context: ContextTypes.DEFAULT_TYPE):
         # Build preview message like show_preview
         preview_text = "<b>𝗤𝗨𝗢𝗧𝗘 𝗞𝗘𝗬 𝗜𝗡𝗙𝗢 📝</b>\n<pre>"
     
-        for idx, (file_id, file_name) in enumerate(zip(session_files, session_filenames), start=1):
-            try:
-                file_info = await context.bot.get_file(file_id)
-                file_size = round(file_info.file_size / (1024 * 1024), 2)
-            except Exception as e:
-                print(f"Failed to fetch file size: {e}")
+        metas = await resolve_file_meta(context.bot, session_files)
+        for idx, (meta, file_name) in enumerate(zip(metas, session_filenames), start=1):
+            file_size = file_size_mb(meta)
+            if file_size is None:
                 file_size = "?"
-    
             preview_text += f"{idx}. {file_name} [{file_size} MB]\n"
     
         preview_text += "</pre>\n"
@@ -1635,7 +2758,7 @@ async def method2_convert_quote(user_id, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
         except Exception as e:
-            print(f"Error converting to quote style: {e}")
+            log_event("preview", "warning", "Quote style conversion failed", error=str(e))
 
     except Exception as e:
         await notify_owner_on_error(context.bot, e, source="method2_convert_quote")
@@ -1663,14 +2786,11 @@ async def method2_convert_mono(user_id, context: ContextTypes.DEFAULT_TYPE):
         # Build preview message like show_preview
         preview_text = "<b>𝗠𝗢𝗡𝗢 𝗞𝗘𝗬 𝗜𝗡𝗙𝗢 🏆</b>\n<pre>"
     
-        for idx, (file_id, file_name) in enumerate(zip(session_files, session_filenames), start=1):
-            try:
-                file_info = await context.bot.get_file(file_id)
-                file_size = round(file_info.file_size / (1024 * 1024), 2)
-            except Exception as e:
-                print(f"Failed to fetch file size: {e}")
+        metas = await resolve_file_meta(context.bot, session_files)
+        for idx, (meta, file_name) in enumerate(zip(metas, session_filenames), start=1):
+            file_size = file_size_mb(meta)
+            if file_size is None:
                 file_size = "?"
-    
             preview_text += f"{idx}. {file_name} [{file_size} MB]\n"
     
         preview_text += "</pre>\n"
@@ -1704,7 +2824,7 @@ async def method2_convert_mono(user_id, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
         except Exception as e:
-            print(f"Error converting to mono style: {e}")
+            log_event("preview", "warning", "Mono style conversion failed", error=str(e))
 
     except Exception as e:
         await notify_owner_on_error(context.bot, e, source="method2_convert_mono")
@@ -1764,7 +2884,7 @@ async def method2_edit_caption(update: Update, context: ContextTypes.DEFAULT_TYP
         try:
             await context.bot.delete_message(chat_id=user_id, message_id=preview_message_id)
         except Exception as e:
-            print(f"Failed to delete old preview message: {e}")
+            log_event("preview", "warning", "Failed to delete old preview message", error=str(e))
     
         # Send updated message with inline keyboard
         new_msg = await context.bot.send_message(
@@ -1800,14 +2920,11 @@ async def method2_show_preview(user_id, context):
         # Begin terminal preview
         preview_text = "<b>𝗣𝗥𝗘𝗩𝗜𝗘𝗪 𝗜𝗡𝗙𝗢 📃</b>\n<pre>"
     
-        for idx, (file_id, file_name) in enumerate(zip(session_files, session_filenames), start=1):
-            try:
-                file_info = await context.bot.get_file(file_id)
-                file_size = round(file_info.file_size / (1024 * 1024), 2)
-            except Exception as e:
-                print(f"Failed to fetch file size: {e}")
+        metas = await resolve_file_meta(context.bot, session_files)
+        for idx, (meta, file_name) in enumerate(zip(metas, session_filenames), start=1):
+            file_size = file_size_mb(meta)
+            if file_size is None:
                 file_size = "?"
-    
             preview_text += f"{idx}. {file_name} [{file_size} MB]\n"
     
         preview_text += "</pre>\n"
@@ -1848,7 +2965,7 @@ async def method2_show_preview(user_id, context):
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
         except Exception as e:
-            print(f"Error in showing preview: {e}")
+            log_event("preview", "error", "Error in showing preview", error=str(e))
 
     except Exception as e:
         await notify_owner_on_error(context.bot, e, source="method2_show_preview")
@@ -1956,52 +3073,12 @@ async def auto_recaption(user_id, context):
             )
             return
     
-        # Build media group with updated captions
-        media = []
-        for idx, file_id in enumerate(file_ids, start=1):
-            is_last_apk = (idx == len(file_ids))
-    
-            if key_mode == "quote":
-                caption = (
-                    caption_template.replace("Key -", f"<blockquote>Key - <code>{key}</code></blockquote>")
-                    if is_last_apk or len(file_ids) == 1
-                    else f"<blockquote>Key - <code>{key}</code></blockquote>"
-                )
-            elif key_mode == "mono":
-                caption = (
-                    caption_template.replace("Key -", f"Key - <code>{key}</code>")
-                    if is_last_apk or len(file_ids) == 1
-                    else f"Key - <code>{key}</code>"
-                )
-            else:
-                caption = (
-                    caption_template.replace("Key -", f"Key - {key}")
-                    if is_last_apk or len(file_ids) == 1
-                    else f"Key - {key}"
-                )
-    
-            media.append(InputMediaDocument(media=file_id, caption=caption, parse_mode="HTML"))
+        # Build updated captions
+        captions = render_session_captions(caption_template, key, key_mode, len(file_ids), "spread")
     
-        # Send new media group
-        new_posts = await context.bot.send_media_group(chat_id=channel_id, media=media)
-    
-        # Delete old channel messages
-        for msg_id in old_posts:
-            try:
-                await context.bot.delete_message(chat_id=channel_id, message_id=msg_id)
-            except:
-                pass
-    
-        # Save new message IDs
-        new_ids = [msg.message_id for msg in new_posts]
-        last_msg = new_posts[-1]
-        post_link = (
-            f"https://t.me/{channel_id.strip('@')}/{last_msg.message_id}"
-            if channel_id.startswith("@") else
-            f"https://t.me/c/{channel_id.replace('-100', '')}/{last_msg.message_id}"
-            if channel_id.startswith("-100") else
-            "Unknown"
-        )
+        # Edit the posted captions in place
+        new_ids = await rewrite_captions(context.bot, channel_id, old_posts, file_ids, captions)
+        post_link = build_post_link(channel_id, new_ids[-1])
     
         # Update state with new post info
         state["apk_posts"] = new_ids
@@ -2027,7 +3104,7 @@ async def auto_recaption(user_id, context):
                     reply_markup=InlineKeyboardMarkup(buttons)
                 )
             except Exception as e:
-                print(f"Preview message update failed: {e}")
+                log_event("preview", "warning", "Preview message update failed", error=str(e))
     
         # Quietly clear session state
         state.update({
@@ -2060,38 +3137,12 @@ async def auto_last_caption(user_id, context):
             await context.bot.send_message(chat_id=user_id, text="⚠️ No session data found.")
             return
     
-        # Delete old channel posts
-        for msg_id in old_posts:
-            try:
-                await context.bot.delete_message(chat_id=channel_id, message_id=msg_id)
-            except:
-                pass
-    
-        # Build new media group with key only on last file
-        media = []
-        for idx, file_id in enumerate(file_ids, start=1):
-            if idx == len(file_ids):  # last file only
-                if key_mode == "quote":
-                    caption = caption_template.replace("Key -", f"<blockquote>Key - <code>{key}</code></blockquote>")
-                elif key_mode == "mono":
-                    caption = caption_template.replace("Key -", f"Key - <code>{key}</code>")
-                else:
-                    caption = caption_template.replace("Key -", f"Key - {key}")
-                media.append(InputMediaDocument(media=file_id, caption=caption, parse_mode="HTML"))
-            else:
-                media.append(InputMediaDocument(media=file_id))  # No caption
-    
-        # Send new media group
-        new_posts = await context.bot.send_media_group(chat_id=channel_id, media=media)
+        # Key only on last file
+        captions = render_session_captions(caption_template, key, key_mode, len(file_ids), "last_full")
     
-        # Track new message IDs
-        new_ids = [msg.message_id for msg in new_posts]
-        last_msg = new_posts[-1]
-        post_link = (
-            f"https://t.me/{channel_id.strip('@')}/{last_msg.message_id}"
-            if channel_id.startswith("@") else
-            f"https://t.me/c/{channel_id.replace('-100', '')}/{last_msg.message_id}"
-        )
+        # Edit the posted captions in place
+        new_ids = await rewrite_captions(context.bot, channel_id, old_posts, file_ids, captions)
+        post_link = build_post_link(channel_id, new_ids[-1])
     
         # Update state
         state["apk_posts"] = new_ids
@@ -2147,37 +3198,11 @@ async def last_caption_key(user_id, context):
             await context.bot.send_message(chat_id=user_id, text="⚠️ No session data found.")
             return
     
-        # Delete old posts
-        for msg_id in old_posts:
-            try:
-                await context.bot.delete_message(chat_id=channel_id, message_id=msg_id)
-            except:
-                pass
-    
-        # Prepare media group with only key caption on last APK
-        media = []
-        for idx, file_id in enumerate(file_ids, start=1):
-            if idx == len(file_ids):
-                if key_mode == "quote":
-                    caption = f"<blockquote>Key - <code>{key}</code></blockquote>"
-                elif key_mode == "mono":
-                    caption = f"Key - <code>{key}</code>"
-                else:
-                    caption = f"Key - {key}"
-                media.append(InputMediaDocument(media=file_id, caption=caption, parse_mode="HTML"))
-            else:
-                media.append(InputMediaDocument(media=file_id))
-    
-        new_posts = await context.bot.send_media_group(chat_id=channel_id, media=media)
+        # Only key caption on last APK
+        captions = render_session_captions("", key, key_mode, len(file_ids), "last_key")
     
-        # Update state with new post data
-        new_ids = [msg.message_id for msg in new_posts]
-        last_msg = new_posts[-1]
-        post_link = (
-            f"https://t.me/{channel_id.strip('@')}/{last_msg.message_id}"
-            if channel_id.startswith("@") else
-            f"https://t.me/c/{channel_id.replace('-100', '')}/{last_msg.message_id}"
-        )
+        new_ids = await rewrite_captions(context.bot, channel_id, old_posts, file_ids, captions)
+        post_link = build_post_link(channel_id, new_ids[-1])
     
         state["apk_posts"] = new_ids
         state["last_post_link"] = post_link
@@ -2232,39 +3257,11 @@ async def key_after_apks(user_id, context):
             await context.bot.send_message(chat_id=user_id, text="⚠️ No session data found.")
             return
 
-        # Delete previously posted messages
-        for msg_id in old_posts:
-            try:
-                await context.bot.delete_message(chat_id=channel_id, message_id=msg_id)
-            except:
-                pass
-
-        # Prepare new media group
-        media = []
-        for idx, file_id in enumerate(file_ids):
-            if idx == len(file_ids) - 1:
-                # LAST APK gets the key caption
-                if key_mode == "quote":
-                    caption = f"<blockquote><code>{key}</code></blockquote>"
-                elif key_mode == "mono":
-                    caption = f"<code>{key}</code>"
-                else:
-                    caption = f"{key}"
-
-                media.append(InputMediaDocument(media=file_id, caption=caption, parse_mode="HTML"))
-            else:
-                media.append(InputMediaDocument(media=file_id))
-
-        new_posts = await context.bot.send_media_group(chat_id=channel_id, media=media)
+        # LAST APK gets the bare key
+        captions = render_session_captions("", key, key_mode, len(file_ids), "last_bare")
 
-        # Update post info
-        post_ids = [m.message_id for m in new_posts]
-        last_msg = new_posts[-1]
-        post_link = (
-            f"https://t.me/{channel_id.strip('@')}/{last_msg.message_id}"
-            if str(channel_id).startswith("@")
-            else f"https://t.me/c/{str(channel_id).replace('-100', '')}/{last_msg.message_id}"
-        )
+        post_ids = await rewrite_captions(context.bot, channel_id, old_posts, file_ids, captions)
+        post_link = build_post_link(channel_id, post_ids[-1])
 
         # Save state
         state["apk_posts"] = post_ids
@@ -2320,49 +3317,19 @@ async def caption_plus_key(user_id, context):
             await context.bot.send_message(chat_id=user_id, text="⚠️ No session data found.")
             return
 
-        # Step 1: Delete old posts
-        for msg_id in old_posts:
-            try:
-                await context.bot.delete_message(chat_id=channel_id, message_id=msg_id)
-            except:
-                pass
-
-        # Step 2: Clean caption (remove "Key -")
-        cleaned_caption = saved_caption.replace("Key -", "").strip()
-
-        # Step 3: Build media group
-        media = []
-        for idx, file_id in enumerate(file_ids):
-            if idx == len(file_ids) - 1:
-                # Format key as per mode
-                if key_mode == "quote":
-                    tail = f"<blockquote><code>{key}</code></blockquote>"
-                elif key_mode == "mono":
-                    tail = f"<code>{key}</code>"
-                else:
-                    tail = f"{key}"
-
-                final_caption = f"{tail}\n{cleaned_caption}"
-                media.append(InputMediaDocument(media=file_id, caption=final_caption, parse_mode="HTML"))
-            else:
-                media.append(InputMediaDocument(media=file_id))
-
-        new_posts = await context.bot.send_media_group(chat_id=channel_id, media=media)
+        # Step 1: Key on top of the caption (placeholder removed), last APK only
+        captions = render_session_captions(saved_caption, key, key_mode, len(file_ids), "last_top")
 
-        # Step 4: Update state
-        new_ids = [msg.message_id for msg in new_posts]
-        last_msg = new_posts[-1]
-        post_link = (
-            f"https://t.me/{channel_id.strip('@')}/{last_msg.message_id}"
-            if channel_id.startswith("@") else
-            f"https://t.me/c/{channel_id.replace('-100', '')}/{last_msg.message_id}"
-        )
+        # Step 2: Edit the posted captions in place
+        new_ids = await rewrite_captions(context.bot, channel_id, old_posts, file_ids, captions)
+        post_link = build_post_link(channel_id, new_ids[-1])
 
+        # Step 3: Update state
         state["apk_posts"] = new_ids
         state["last_post_link"] = post_link
         session["post_message_ids"] = new_ids
 
-        # Step 5: Buttons
+        # Step 4: Buttons
         buttons = [
             [InlineKeyboardButton("📄 Open Last Uploaded Post", url=post_link)],
             [InlineKeyboardButton("🗑️ Remove Uploaded Files", callback_data="delete_apk_post")],
@@ -2370,7 +3337,7 @@ async def caption_plus_key(user_id, context):
             [InlineKeyboardButton("🔙 Back to Upload Options", callback_data="back_to_methods")]
         ]
 
-        # Step 6: Preview update
+        # Step 5: Preview update
         if preview_message_id:
             try:
                 await context.bot.edit_message_text(
@@ -2383,7 +3350,7 @@ async def caption_plus_key(user_id, context):
             except:
                 pass
 
-        # Step 7: Clean session
+        # Step 6: Clean session
         state.update({
             "session_files": [],
             "session_filenames": [],
@@ -2508,6 +3475,94 @@ async def test_monthly(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await context.bot.send_message(chat_id=uid, text=text, parse_mode="HTML", reply_markup=markup)
         await reset_stats("monthly")
 
+async def key_rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if update.effective_user.id != OWNER_ID:
+            return
+
+        args = context.args or []
+        if len(args) >= 2 and args[0] in ("1", "2", "3", "4"):
+            setup = AUTO_SETUP[f"setup{args[0]}"]
+            if args[1].lower() == "default":
+                setup.pop("key_rules", None)
+            else:
+                rules = [r.strip().lower() for r in " ".join(args[1:]).split(",") if r.strip()]
+                unknown = [r for r in rules if r not in KEY_RULES]
+                if unknown or not rules:
+                    await update.message.reply_text(
+                        f"❌ Unknown rule: <code>{escape(', '.join(unknown) or '-')}</code>\n"
+                        f"Available: <code>{', '.join(KEY_RULES)}</code>",
+                        parse_mode="HTML"
+                    )
+                    return
+                setup["key_rules"] = rules
+            save_config()
+
+        lines = [
+            f"• Auto {i}: <code>{', '.join(key_rules_for(AUTO_SETUP[f'setup{i}']))}</code>"
+            + ("" if AUTO_SETUP[f"setup{i}"].get("key_rules") else " <i>(default)</i>")
+            for i in range(1, 5)
+        ]
+        await update.message.reply_text(
+            "🔑 <b>Key Extraction Rules</b>\n"
+            + "\n".join(lines)
+            + f"\n\n<b>Usage:</b> <code>/keyrules &lt;1-4&gt; rule,rule,...</code> or <code>default</code>\n"
+            f"Available: <code>{', '.join(KEY_RULES)}</code>",
+            parse_mode="HTML"
+        )
+
+    except Exception as e:
+        await notify_owner_on_error(context.bot, e, source="key_rules_command")
+
+async def scratch_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global SCRATCH_CHAT_ID
+    try:
+        if update.effective_user.id != OWNER_ID:
+            return
+
+        args = context.args or []
+        if len(args) != 1 or not args[0].lstrip("-").isdigit():
+            current = f"<code>{SCRATCH_CHAT_ID}</code>" if SCRATCH_CHAT_ID else "<i>not set (probes go to this chat)</i>"
+            await update.message.reply_text(
+                f"🧪 <b>Scratch Chat:</b> {current}\n\n"
+                "<b>Usage:</b> <code>/setscratch &lt;chat_id&gt;</code>\n"
+                "A private group or channel where the bot can post and delete.",
+                parse_mode="HTML"
+            )
+            return
+
+        chat_id = int(args[0])
+        try:
+            # The bot must be able to post and delete there for probes to work
+            test_msg = await context.bot.send_message(chat_id, "🧪 Scratch chat check", disable_notification=True)
+            await context.bot.delete_message(chat_id=chat_id, message_id=test_msg.message_id)
+        except Exception as e:
+            await update.message.reply_text(f"❌ Can't use <code>{chat_id}</code>: {escape(str(e))}", parse_mode="HTML")
+            return
+
+        SCRATCH_CHAT_ID = chat_id
+        save_config()
+        await update.message.reply_text(f"✅ Scratch chat set to <code>{chat_id}</code>.", parse_mode="HTML")
+
+    except Exception as e:
+        await notify_owner_on_error(context.bot, e, source="scratch_chat_command")
+
+async def warn_missing_scratch_chat(bot):
+    if SCRATCH_CHAT_ID:
+        return
+    log_event("verify", "error", "scratch_chat_id is not configured; probing source posts in the owner chat")
+    try:
+        await bot.send_message(
+            OWNER_ID,
+            "⚠️ <b>No scratch chat configured</b>\n"
+            "Source posts are checked by forwarding them into this chat until one is set, "
+            "and /backfill is disabled.\n"
+            "<b>Fix:</b> <code>/setscratch &lt;chat_id&gt;</code>",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        log_event("verify", "error", "Could not send the scratch chat warning", error=str(e))
+
 async def erase_all_session(user_id, context):
     try:
         state = USER_STATE.get(user_id, {})
@@ -2552,7 +3607,8 @@ async def settings_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 InlineKeyboardButton("🔧 Auto-Setup Settings", callback_data="view_autosetup")
             ],
             [
-                InlineKeyboardButton("🔄 Create Backup", callback_data="backup_config")
+                InlineKeyboardButton("🔄 Create Backup", callback_data="backup_config"),
+                InlineKeyboardButton("📊 Metrics", callback_data="view_metrics")
             ],
             [
                 InlineKeyboardButton("♻️ Reset Everything", callback_data="force_reset")
@@ -2579,170 +3635,278 @@ async def settings_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await notify_owner_on_error(context.bot, e, source="settings_panel")
 
-async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        query = update.callback_query
-        user_id = query.from_user.id
-    
-        if not is_authorized(user_id):
-            await query.answer("🚫 Unauthorized", show_alert=True)
-            return
-    
-        try:
-            await query.answer()
-        except:
-            await query.message.reply_text("⏳ Session expired or invalid! ❌\nPlease restart using /start.")
-            return
-    
-        data = query.data
-    
-        if data == "view_users":
-            if not ALLOWED_USERS:
-                await query.edit_message_text(
-                    "❌ No allowed users found.",
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="settings_back")]])
-                )
-                return
-    
-            lines = [f"<b>🧾 Total Allowed Users:</b> {len(ALLOWED_USERS)}\n"]
-    
-            for index, uid in enumerate(ALLOWED_USERS, start=1):
-                user_data = USER_DATA.get(str(uid), {})
-    
-                # Try to fetch fresh user info if missing
-                if "first_name" not in user_data or "username" not in user_data:
-                    try:
-                        chat = await context.bot.get_chat(uid)
-                        user_data["first_name"] = chat.first_name or "—"
-                        user_data["username"] = chat.username or "—"
-                        USER_DATA[str(uid)] = user_data
-                        save_config()
-                    except:
-                        user_data.setdefault("first_name", "—")
-                        user_data.setdefault("username", "—")
-    
-                name = user_data.get("first_name", "—")
-                username = user_data.get("username", "—")
-                channel = user_data.get("channel", "—")
-    
-                lines.append(
-                    f"📌 <b>User {index}</b>\n"
-                    f"├─ 👤 <b>Name:</b> {name}\n"
-                    f"├─ 🧬 <b>Username:</b> {'@' + username if username and username != '—' else '—'}\n"
-                    f"├─ 📡 <b>Channel:</b> {channel}\n"
-                    f"└─ 🆔 <b>ID:</b> <code>{uid}</code>\n"
-                    f"━━━━━━━━━━━━━━━━━━━━"
+# === SETTINGS CALLBACKS ===
+async def cb_view_users(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    if not ALLOWED_USERS:
+        await query.edit_message_text(
+            "❌ No allowed users found.",
+            parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="settings_back")]])
+        )
+        return
+
+    lines = [f"<b>🧾 Total Allowed Users:</b> {len(ALLOWED_USERS)}\n"]
+
+    for index, uid in enumerate(ALLOWED_USERS, start=1):
+        user_data = USER_DATA.get(str(uid), {})
+
+        # Try to fetch fresh user info if missing
+        if "first_name" not in user_data or "username" not in user_data:
+            try:
+                chat = await context.bot.get_chat(uid)
+                user_data["first_name"] = chat.first_name or "—"
+                user_data["username"] = chat.username or "—"
+                USER_DATA[str(uid)] = user_data
+                save_config()
+            except:
+                user_data.setdefault("first_name", "—")
+                user_data.setdefault("username", "—")
+
+        name = user_data.get("first_name", "—")
+        username = user_data.get("username", "—")
+        channel = user_data.get("channel", "—")
+
+        lines.append(
+            f"📌 <b>User {index}</b>\n"
+            f"├─ 👤 <b>Name:</b> {name}\n"
+            f"├─ 🧬 <b>Username:</b> {'@' + username if username and username != '—' else '—'}\n"
+            f"├─ 📡 <b>Channel:</b> {channel}\n"
+            f"└─ 🆔 <b>ID:</b> <code>{uid}</code>\n"
+            f"━━━━━━━━━━━━━━━━━━━━"
+        )
+
+    await query.edit_message_text(
+        "\n".join(lines),
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="settings_back")]]),
+        disable_web_page_preview=True
+    )
+
+async def cb_view_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    await query.edit_message_text(
+        f"<b>📊 Hot-Path Metrics</b> (ms)\n"
+        f"<b>Handlers</b>\n<pre>{escape(format_metrics_table(HANDLER_METRICS))}</pre>"
+        f"<b>Callbacks</b>\n<pre>{escape(format_metrics_table(CALLBACK_METRICS))}</pre>"
+        f"<b>Bot API</b>\n<pre>{escape(format_metrics_table(API_METRICS))}</pre>"
+        f"<b>Flood control:</b> {API_STATS['flood_waits']} waits ({API_STATS['flood_wait_s']:.0f}s), "
+        f"{API_STATS['retries']} retried, {API_STATS['dropped']} dropped, {API_STATS['coalesced']} edits coalesced\n"
+        f"<b>Key rules:</b> {key_rule_summary()}",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 Refresh", callback_data="view_metrics")],
+            [InlineKeyboardButton("🔙 Back", callback_data="settings_back")]
+        ])
+    )
+
+async def cb_view_autosetup(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    await query.edit_message_text(
+        "<b>🔧 Select a setup to view details:</b>\n"
+        f"♻️ Duplicate filter: {DEDUP_STATS['hits']} skipped / {DEDUP_STATS['misses']} passed "
+        f"({len(DEDUP_INDEX)} tracked)",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("Auto Setup 1", callback_data="viewsetup1")],
+            [InlineKeyboardButton("Auto Setup 2", callback_data="viewsetup2")],
+            [InlineKeyboardButton("Auto Setup 3", callback_data="viewsetup3")],
+            [InlineKeyboardButton("Auto Setup 4", callback_data="viewsetup4")],
+            [InlineKeyboardButton("🔙 Back", callback_data="settings_back")]
+        ])
+    )
+
+async def cb_settings_viewsetup(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    setup_num = arg
+    s = AUTO_SETUP.get(f"setup{setup_num}", {})
+
+    total_keys = s.get("completed_count", 0)
+    total_apks = s.get("processed_count", total_keys)
+    source = s.get("source_channel", "Not Set")
+    dest = s.get("dest_channel", "Not Set")
+    caption_ok = "✅" if s.get("dest_caption") else "❌"
+    key_mode = s.get("key_mode", "auto").capitalize()
+    style = s.get("style", "mono").capitalize()
+    status = "✅ ON" if s.get("enabled") else "⛔ OFF"
+
+    msg = (
+        f"<pre>"
+        f"┌──── AUTO {setup_num} SYSTEM DIAG ─────┐\n"
+        f"│ SOURCE        >>  {source}\n"
+        f"│ DESTINATION   >>  {dest}\n"
+        f"│ CAPTION       >>  {caption_ok}\n"
+        f"│ KEY_MODE      >>  {key_mode}\n"
+        f"│ STYLE         >>  {style}\n"
+        f"│ STATUS        >>  {status}\n"
+        f"│ KEYS_SENT     >>  {total_keys}\n"
+        f"│ TOTAL_APKS    >>  {total_apks} APK{'s' if total_apks != 1 else ''}\n"
+        f"└──────── END OF REPORT ────────┘"
+        f"</pre>"
+    )
+
+    await query.edit_message_text(
+        text=msg,
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="view_autosetup")]])
+    )
+
+async def cb_backup_config(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    if user_id != OWNER_ID:
+        return
+
+    await query.delete_message()
+    await backup_config(context=context)
+
+async def cb_force_reset(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    await query.edit_message_text(
+        "⚠️ <b>Are you sure you want to reset all sessions?</b>",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Yes", callback_data="confirm_reset"),
+             InlineKeyboardButton("❌ No", callback_data="settings_back")]
+        ])
+    )
+
+async def cb_confirm_reset(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    # Step 1: Backup before resetting
+    await backup_config(context=context)
+
+    # Step 2: Reset all USER_STATE
+    for user in USER_STATE:
+        USER_STATE[user] = {}
+
+    # Step 3: Clear Bot Admin Link in config
+    config["bot_admin_link"] = ""
+    global BOT_ADMIN_LINK
+    BOT_ADMIN_LINK = ""
+    save_config()
+    save_state()
+
+    # Step 4: Confirm to Owner
+    await query.edit_message_text(
+        "✅ Reset complete!\nAll data cleared and backup sent.",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Back", callback_data="settings_back")]
+        ])
+    )
+
+async def cb_settings_back(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    if user_id not in USER_STATE:
+        USER_STATE[user_id] = {}
+
+    USER_STATE[user_id].pop("pending_restore_file", None)
+    USER_STATE[user_id].pop("awaiting_zip", None)
+    USER_STATE[user_id].pop("zip_timeout", None)
+
+    await query.edit_message_text(
+        "🛠️ <b>Settings Panel</b>\nManage your bot below:",
+        parse_mode="HTML",
+        reply_markup = InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton("➕ Add New User", callback_data="add_user"),
+                InlineKeyboardButton("➖ Remove a User", callback_data="remove_user")
+            ],
+            [
+                InlineKeyboardButton("👥 Show All Users", callback_data="view_users"),
+                InlineKeyboardButton("🔧 Auto-Setup Settings", callback_data="view_autosetup")
+            ],
+            [
+                InlineKeyboardButton("🔄 Create Backup", callback_data="backup_config"),
+                InlineKeyboardButton("📊 Metrics", callback_data="view_metrics")
+            ],
+            [
+                InlineKeyboardButton("♻️ Reset Everything", callback_data="force_reset")
+            ],
+            [
+                InlineKeyboardButton("🌟 Open Admin Channel", callback_data="bot_admin_link")
+            ],
+            [
+                InlineKeyboardButton("🧬 Restore from Backup", callback_data="backup_restore")
+            ],
+            [
+                InlineKeyboardButton("🧹 Reset Settings Panel", callback_data="reset_settings_panel")
+            ],
+            [
+                InlineKeyboardButton("🔙 Return to Upload Menu", callback_data="back_to_methods")
+            ]
+        ])
+    )
+
+async def cb_bot_admin_link(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    if user_id != OWNER_ID:
+        return
+
+    USER_STATE[user_id]["awaiting_admin_link"] = True
+    await query.edit_message_text("🔗 Send the new Bot Admin link (must start with https://)")
+
+async def cb_backup_restore(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    USER_STATE.setdefault(user_id, {})
+    USER_STATE[user_id]["awaiting_zip"] = True
+    USER_STATE[user_id]["zip_timeout"] = time.time() + 20
+
+    message = await query.edit_message_text(
+        text="📁 <b>Please upload your backup ZIP file now.</b>\n"
+             "⏳ <b>[>-------------------] (0%)</b>",
+        parse_mode="HTML"
+    )
+
+    USER_STATE[user_id]["zip_prompt_message_id"] = message.message_id
+    chat_id = message.chat_id
+
+    async def cancel_zip_restore():
+        for elapsed in range(1, 21):
+            await asyncio.sleep(1)
+            state = USER_STATE.get(user_id, {})
+            if not state.get("awaiting_zip"):
+                return
+
+            arrows = ">" * elapsed
+            dashes = "-" * (20 - elapsed)
+            percent = int((elapsed / 20) * 100)
+            bar = arrows + dashes
+
+            try:
+                await context.bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message.message_id,
+                    text=(
+                        "📁 <b>Please upload your backup ZIP file now.</b>\n"
+                        f"⏳ <b>[{bar}] ({percent}%)</b>"
+                    ),
+                    parse_mode="HTML"
                 )
-    
-            await query.edit_message_text(
-                "\n".join(lines),
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="settings_back")]]),
-                disable_web_page_preview=True
-            )
-    
-        elif data == "view_autosetup":
-            await query.edit_message_text(
-                "<b>🔧 Select a setup to view details:</b>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("Auto Setup 1", callback_data="viewsetup1")],
-                    [InlineKeyboardButton("Auto Setup 2", callback_data="viewsetup2")],
-                    [InlineKeyboardButton("Auto Setup 3", callback_data="viewsetup3")],
-                    [InlineKeyboardButton("Auto Setup 4", callback_data="viewsetup4")],
-                    [InlineKeyboardButton("🔙 Back", callback_data="settings_back")]
-                ])
-            )
-            return
-    
-        elif data.startswith("viewsetup"):
-            setup_num = data[-1]
-            s = AUTO_SETUP.get(f"setup{setup_num}", {})
-    
-            total_keys = s.get("completed_count", 0)
-            total_apks = s.get("processed_count", total_keys)
-            source = s.get("source_channel", "Not Set")
-            dest = s.get("dest_channel", "Not Set")
-            caption_ok = "✅" if s.get("dest_caption") else "❌"
-            key_mode = s.get("key_mode", "auto").capitalize()
-            style = s.get("style", "mono").capitalize()
-            status = "✅ ON" if s.get("enabled") else "⛔ OFF"
-    
-            msg = (
-                f"<pre>"
-                f"┌──── AUTO {setup_num} SYSTEM DIAG ─────┐\n"
-                f"│ SOURCE        >>  {source}\n"
-                f"│ DESTINATION   >>  {dest}\n"
-                f"│ CAPTION       >>  {caption_ok}\n"
-                f"│ KEY_MODE      >>  {key_mode}\n"
-                f"│ STYLE         >>  {style}\n"
-                f"│ STATUS        >>  {status}\n"
-                f"│ KEYS_SENT     >>  {total_keys}\n"
-                f"│ TOTAL_APKS    >>  {total_apks} APK{'s' if total_apks != 1 else ''}\n"
-                f"└──────── END OF REPORT ────────┘"
-                f"</pre>"
-            )
-    
-            await query.edit_message_text(
-                text=msg,
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="view_autosetup")]])
-            )
-            return
-    
-        elif data == "backup_config" and user_id == OWNER_ID:
-            await query.delete_message()
-            await backup_config(context=context)
-            return
-    
-        elif data == "force_reset":
-            await query.edit_message_text(
-                "⚠️ <b>Are you sure you want to reset all sessions?</b>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ Yes", callback_data="confirm_reset"),
-                     InlineKeyboardButton("❌ No", callback_data="settings_back")]
-                ])
-            )
-            return
-    
-        elif data == "confirm_reset":
-            # Step 1: Backup before resetting
-            await backup_config(context=context)
-        
-            # Step 2: Reset all USER_STATE
-            for user in USER_STATE:
-                USER_STATE[user] = {}
-        
-            # Step 3: Clear Bot Admin Link in config
-            config["bot_admin_link"] = ""
-            global BOT_ADMIN_LINK
-            BOT_ADMIN_LINK = ""
-            save_config()
-            save_state()
-        
-            # Step 4: Confirm to Owner
-            await query.edit_message_text(
-                "✅ Reset complete!\nAll data cleared and backup sent.",
+            except:
+                pass
+
+        # Timeout
+        state = USER_STATE.get(user_id, {})
+        if state.get("awaiting_zip"):
+            state.pop("awaiting_zip", None)
+            state.pop("zip_timeout", None)
+            state.pop("pending_restore_file", None)
+
+            try:
+                await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+            except:
+                pass
+
+            await context.bot.send_message(
+                chat_id=user_id,
+                text="⏳ <b>Backup restore timed out.</b>\nPlease try again from the settings panel.",
                 parse_mode="HTML",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Back", callback_data="settings_back")]
-                ])
-            )
-    
-        elif data == "settings_back" or data == "cancel_restore":
-            if user_id not in USER_STATE:
-                USER_STATE[user_id] = {}
-            
-            USER_STATE[user_id].pop("pending_restore_file", None)
-            USER_STATE[user_id].pop("awaiting_zip", None)
-            USER_STATE[user_id].pop("zip_timeout", None)
-        
-            await query.edit_message_text(
-                "🛠️ <b>Settings Panel</b>\nManage your bot below:",
-                parse_mode="HTML",
-                reply_markup = InlineKeyboardMarkup([
                     [
                         InlineKeyboardButton("➕ Add New User", callback_data="add_user"),
                         InlineKeyboardButton("➖ Remove a User", callback_data="remove_user")
@@ -2752,7 +3916,8 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
                         InlineKeyboardButton("🔧 Auto-Setup Settings", callback_data="view_autosetup")
                     ],
                     [
-                        InlineKeyboardButton("🔄 Create Backup", callback_data="backup_config")
+                        InlineKeyboardButton("🔄 Create Backup", callback_data="backup_config"),
+                        InlineKeyboardButton("📊 Metrics", callback_data="view_metrics")
                     ],
                     [
                         InlineKeyboardButton("♻️ Reset Everything", callback_data="force_reset")
@@ -2771,140 +3936,52 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
                     ]
                 ])
             )
-    
-        elif data == "bot_admin_link" and user_id == OWNER_ID:
-            USER_STATE[user_id]["awaiting_admin_link"] = True
-            await query.edit_message_text("🔗 Send the new Bot Admin link (must start with https://)")
-            return
-    
-        elif data == "backup_restore":
-            USER_STATE.setdefault(user_id, {})
-            USER_STATE[user_id]["awaiting_zip"] = True
-            USER_STATE[user_id]["zip_timeout"] = time.time() + 20
-        
-            message = await query.edit_message_text(
-                text="📁 <b>Please upload your backup ZIP file now.</b>\n"
-                     "⏳ <b>[>-------------------] (0%)</b>",
-                parse_mode="HTML"
-            )
-        
-            USER_STATE[user_id]["zip_prompt_message_id"] = message.message_id
-            chat_id = message.chat_id
-        
-            async def cancel_zip_restore():
-                for elapsed in range(1, 21):
-                    await asyncio.sleep(1)
-                    state = USER_STATE.get(user_id, {})
-                    if not state.get("awaiting_zip"):
-                        return
-        
-                    arrows = ">" * elapsed
-                    dashes = "-" * (20 - elapsed)
-                    percent = int((elapsed / 20) * 100)
-                    bar = arrows + dashes
-        
-                    try:
-                        await context.bot.edit_message_text(
-                            chat_id=chat_id,
-                            message_id=message.message_id,
-                            text=(
-                                "📁 <b>Please upload your backup ZIP file now.</b>\n"
-                                f"⏳ <b>[{bar}] ({percent}%)</b>"
-                            ),
-                            parse_mode="HTML"
-                        )
-                    except:
-                        pass
-        
-                # Timeout
-                state = USER_STATE.get(user_id, {})
-                if state.get("awaiting_zip"):
-                    state.pop("awaiting_zip", None)
-                    state.pop("zip_timeout", None)
-                    state.pop("pending_restore_file", None)
-        
-                    try:
-                        await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                    except:
-                        pass
-        
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text="⏳ <b>Backup restore timed out.</b>\nPlease try again from the settings panel.",
-                        parse_mode="HTML",
-                        reply_markup=InlineKeyboardMarkup([
-                            [
-                                InlineKeyboardButton("➕ Add New User", callback_data="add_user"),
-                                InlineKeyboardButton("➖ Remove a User", callback_data="remove_user")
-                            ],
-                            [
-                                InlineKeyboardButton("👥 Show All Users", callback_data="view_users"),
-                                InlineKeyboardButton("🔧 Auto-Setup Settings", callback_data="view_autosetup")
-                            ],
-                            [
-                                InlineKeyboardButton("🔄 Create Backup", callback_data="backup_config")
-                            ],
-                            [
-                                InlineKeyboardButton("♻️ Reset Everything", callback_data="force_reset")
-                            ],
-                            [
-                                InlineKeyboardButton("🌟 Open Admin Channel", callback_data="bot_admin_link")
-                            ],
-                            [
-                                InlineKeyboardButton("🧬 Restore from Backup", callback_data="backup_restore")
-                            ],
-                            [
-                                InlineKeyboardButton("🧹 Reset Settings Panel", callback_data="reset_settings_panel")
-                            ],
-                            [
-                                InlineKeyboardButton("🔙 Return to Upload Menu", callback_data="back_to_methods")
-                            ]
-                        ])
-                    )
-        
-            context.application.create_task(cancel_zip_restore())
-    
-        elif data == "confirm_restore":
-            doc_info = USER_STATE[user_id].get("pending_restore_file")
-            if not doc_info:
-                await query.answer("❌ No file to restore.", show_alert=True)
-                return
-        
-            try:
-                file = await context.bot.get_file(doc_info["file_id"])
-                await handle_backup_restore_from_document(file, context, user_id, doc_info["file_name"])
-            except Exception as e:
-                await query.message.reply_text(f"❌ Failed to download backup.\nError: {e}")
-        
-        elif data == "reset_settings_panel":
-            USER_STATE[user_id] = {}  # Clear all pending states
-        
-            await query.edit_message_text(
-                "✅ Setting panel has been reset.\n\nYou're back to a clean slate!",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Back to Settings", callback_data="settings_back")]
-                ])
-            )
-            return
-        
-        elif data == "add_user":
-            USER_STATE.setdefault(user_id, {})["awaiting_add_user"] = True
-            await query.edit_message_text(
-                "🆔 <b>Send the Telegram User ID</b> to <u>add</u>:",
-                parse_mode="HTML"
-            )
-            return
-        
-        elif data == "remove_user":
-            USER_STATE.setdefault(user_id, {})["awaiting_remove_user"] = True
-            await query.edit_message_text(
-                "🆔 <b>Send the Telegram User ID</b> to <u>remove</u>:",
-                parse_mode="HTML"
-            )
-            return
 
+    context.application.create_task(cancel_zip_restore())
+
+async def cb_confirm_restore(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    doc_info = USER_STATE[user_id].get("pending_restore_file")
+    if not doc_info:
+        await query.answer("❌ No file to restore.", show_alert=True)
+        return
+
+    try:
+        file = await context.bot.get_file(doc_info["file_id"])
+        await handle_backup_restore_from_document(file, context, user_id, doc_info["file_name"])
     except Exception as e:
-        await notify_owner_on_error(context.bot, e, source="handle_settings_callback")
+        await query.message.reply_text(f"❌ Failed to download backup.\nError: {e}")
+
+async def cb_reset_settings_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    USER_STATE[user_id] = {}  # Clear all pending states
+
+    await query.edit_message_text(
+        "✅ Setting panel has been reset.\n\nYou're back to a clean slate!",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Back to Settings", callback_data="settings_back")]
+        ])
+    )
+
+async def cb_add_user(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    USER_STATE.setdefault(user_id, {})["awaiting_add_user"] = True
+    await query.edit_message_text(
+        "🆔 <b>Send the Telegram User ID</b> to <u>add</u>:",
+        parse_mode="HTML"
+    )
+
+async def cb_remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    USER_STATE.setdefault(user_id, {})["awaiting_remove_user"] = True
+    await query.edit_message_text(
+        "🆔 <b>Send the Telegram User ID</b> to <u>remove</u>:",
+        parse_mode="HTML"
+    )
 
 async def handle_backup_restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -2951,6 +4028,10 @@ async def handle_backup_restore(update: Update, context: ContextTypes.DEFAULT_TY
         await notify_owner_on_error(context.bot, e, source="handle_backup_restore")
 
 
+def extract_backup_zip(zip_path: str):
+    with zipfile.ZipFile(zip_path, "r") as zip_ref:
+        zip_ref.extractall(".")
+
 async def handle_backup_restore_from_document(file, context, user_id, filename):
     try:
         zip_path = f"/tmp/{filename}"
@@ -2962,9 +4043,8 @@ async def handle_backup_restore_from_document(file, context, user_id, filename):
             # Step 1: Download the ZIP
             await file.download_to_drive(zip_path)
 
-            # Step 2: Extract contents
-            with zipfile.ZipFile(zip_path, "r") as zip_ref:
-                zip_ref.extractall(".")
+            # Step 2: Extract contents (off the event loop)
+            await asyncio.to_thread(extract_backup_zip, zip_path)
 
             # Step 3: Remove ZIP
             os.remove(zip_path)
@@ -3003,1678 +4083,1796 @@ async def handle_backup_restore_from_document(file, context, user_id, filename):
     except Exception as e:
         await notify_owner_on_error(context.bot, e, source="handle_backup_restore_from_document")
 
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        global BOT_ACTIVE, USER_DATA, ALLOWED_USERS, BOT_ADMIN_LINK  # <-- FIXED LINE
+# === TEXT ROUTER ===
+# Text is resolved in two steps: the reply-keyboard buttons (matched on the
+# lower-cased text) and then the user's conversational state. Broadcast input
+# captures every message; otherwise a button press wins over pending input.
+ROUTE_OPEN = "open"
+ROUTE_SESSION = "session"
+ROUTE_SETTINGS = "settings"
+ROUTE_OWNER = "owner"
+ROUTE_DIGITS = re.compile(r"\d+")
+
+def route_lookup(routes: dict, key: str) -> tuple:
+    if key in routes:
+        return key, None
+    match = ROUTE_DIGITS.search(key)
+    if match:
+        template = f"{key[:match.start()]}#{key[match.end():]}"
+        if template in routes:
+            return template, match.group()
+    return None, None
+
+async def text_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    raw_message_text = update.message.text.strip()
+    msg = update.message
 
-        if not update.message or not update.message.text or not update.effective_user:
-            return
+    # If buttons text given
+    if raw_message_text and "|" in raw_message_text and "http" in raw_message_text:
+        BROADCAST_SESSION[user_id]["buttons_raw"] = raw_message_text
+        await msg.reply_text("✅ Buttons received. Ready to confirm.")
+        return
 
-        user = update.effective_user
-        user_id = user.id
-        raw_message_text = update.message.text.strip()
-        message_text = raw_message_text.lower()
-        
-        # Register user
-        if str(user_id) not in USER_DATA:
-            USER_DATA[str(user_id)] = {
-                "first_name": user.first_name,
-                "username": user.username,
-            }
-            save_config()
+    # If empty
+    if not raw_message_text:
+        await msg.reply_text("❌ Empty message cannot be broadcasted.")
+        return
 
-        # Bot OFF logic
-        if not BOT_ACTIVE and user_id != OWNER_ID:
-            await update.message.reply_text("🚫 The bot is currently turned off by the admin.")
-            return
+    BROADCAST_SESSION[user_id]["message"] = msg
+    BROADCAST_SESSION[user_id]["waiting_for_message"] = False
 
-        # Unauthorized user check
-        if user_id != OWNER_ID and user_id not in ALLOWED_USERS:
-            await update.message.reply_text("🚫 You are not authorized to interact.")
-            return
+    preview_keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Confirm", callback_data="confirm_broadcast"),
+         InlineKeyboardButton("❌ Cancel", callback_data="cancel_broadcast")]
+    ])
 
-        # --- Owner Broadcast Mode ---
-        if user_id == OWNER_ID and BROADCAST_SESSION.get(user_id, {}).get("waiting_for_message"):
-            msg = update.message
+    safe_text = escape(raw_message_text[:4000])
 
-            # If buttons text given
-            if raw_message_text and "|" in raw_message_text and "http" in raw_message_text:
-                BROADCAST_SESSION[user_id]["buttons_raw"] = raw_message_text
-                await msg.reply_text("✅ Buttons received. Ready to confirm.")
-                return
+    await context.bot.send_message(
+        chat_id=user_id,
+        text=f"<b>📨 Preview:</b>\n\n{safe_text}",
+        parse_mode="HTML",
+        reply_markup=preview_keyboard
+    )
 
-            # If empty
-            if not raw_message_text:
-                await msg.reply_text("❌ Empty message cannot be broadcasted.")
-                return
+async def text_bot_on(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    global BOT_ACTIVE
+    BOT_ACTIVE = True
+    save_config()
+    await update.message.reply_text("✅ Bot is now active. Users can interact again.")
 
-            BROADCAST_SESSION[user_id]["message"] = msg
-            BROADCAST_SESSION[user_id]["waiting_for_message"] = False
+async def text_bot_off(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    global BOT_ACTIVE
+    BOT_ACTIVE = False
+    save_config()
+    await update.message.reply_text("⛔ Bot is now inactive. User interaction is disabled.")
 
-            preview_keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ Confirm", callback_data="confirm_broadcast"),
-                 InlineKeyboardButton("❌ Cancel", callback_data="cancel_broadcast")]
-            ])
+async def text_broadcast_mode(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    BROADCAST_SESSION[user_id] = {
+        "waiting_for_message": True,
+        "message": None,
+        "buttons_raw": None
+    }
+    await update.message.reply_text(
+        "<b>📣 BROADCAST MODE ACTIVE</b>\n"
+        "━━━━━━━━━━━━━━━━━━━━\n"
+        "📝 Send the message you want to broadcast (HTML supported).\n\n"
+        "➕ To add buttons, send this format after the message:\n"
+        "<code>Text | https://your-url.com</code>\n"
+        "(One button per line)\n"
+        "━━━━━━━━━━━━━━━━━━━━",
+        parse_mode="HTML"
+    )
 
-            safe_text = escape(raw_message_text[:4000])
+async def text_my_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    user_channel = USER_DATA.get(str(user_id), {}).get("channel", "Not Set")
+    formatted_channel = (user_channel[:26] + '…') if len(user_channel) > 28 else user_channel
+    await update.message.reply_text(
+        "<b>━━━━━━━━━━━━━━━━━━━━━━━━━━</b>\n"
+        "<b>      📡 CHANNEL INFO       </b>\n"
+        "<b>━━━━━━━━━━━━━━━━━━━━━━━━━━</b>\n"
+        f"<b>📎 Current:</b> <code>{formatted_channel}</code>",
+        parse_mode="HTML"
+    )
 
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"<b>📨 Preview:</b>\n\n{safe_text}",
-                parse_mode="HTML",
-                reply_markup=preview_keyboard
-            )
-            return
+async def text_my_caption(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    user_caption = USER_DATA.get(str(user_id), {}).get("caption", "Not Set")
+
+    await update.message.reply_text(
+        "<b>━━━━━━━━━━━━━━━━━━━━━━━━━━</b>\n"
+        "<b>     📝 CAPTION TEMPLATE     </b>\n"
+        "<b>━━━━━━━━━━━━━━━━━━━━━━━━━━</b>\n\n"
+        f"<code>{user_caption}</code>" if user_caption != "Not Set" else "<i>No caption set.</i>",
+        parse_mode="HTML"
+    )
 
-        # BUTTON TEXT HANDLING
-        if message_text == "ping":
-            await ping(update, context)
-            return
-        elif message_text == "help":
-            await help_command(update, context)
-            return
-        elif message_text == "rules":
-            await rules(update, context)
-            return
-        elif message_text == "reset":
-            await reset(update, context)
-            return
-        elif message_text == "userlist" and user_id == OWNER_ID:
-            await userlist(update, context)
-            return
-        elif message_text == "viewsetup":
-            await user_viewsetup(update, context)
-            return
-        elif message_text.lower() == "on" and user_id == OWNER_ID:
-            BOT_ACTIVE = True
-            save_config()
-            await update.message.reply_text("✅ Bot is now active. Users can interact again.")
-            return
-        elif message_text.lower() == "off" and user_id == OWNER_ID:
-            BOT_ACTIVE = False
-            save_config()
-            await update.message.reply_text("⛔ Bot is now inactive. User interaction is disabled.")
-            return
-        elif message_text == "settings" and user_id == OWNER_ID:
-            await settings_panel(update, context)
-            return
-        elif message_text.lower() == "broadcast" and user_id == OWNER_ID:
-            BROADCAST_SESSION[user_id] = {
-                "waiting_for_message": True,
-                "message": None,
-                "buttons_raw": None
-            }
-            await update.message.reply_text(
-                "<b>📣 BROADCAST MODE ACTIVE</b>\n"
-                "━━━━━━━━━━━━━━━━━━━━\n"
-                "📝 Send the message you want to broadcast (HTML supported).\n\n"
-                "➕ To add buttons, send this format after the message:\n"
-                "<code>Text | https://your-url.com</code>\n"
-                "(One button per line)\n"
-                "━━━━━━━━━━━━━━━━━━━━",
-                parse_mode="HTML"
-            )
-            return
-        elif message_text == "My Channel":
-            user_channel = USER_DATA.get(str(user_id), {}).get("channel", "Not Set")
-            formatted_channel = (user_channel[:26] + '…') if len(user_channel) > 28 else user_channel
-            await update.message.reply_text(
-                "<b>━━━━━━━━━━━━━━━━━━━━━━━━━━</b>\n"
-                "<b>      📡 CHANNEL INFO       </b>\n"
-                "<b>━━━━━━━━━━━━━━━━━━━━━━━━━━</b>\n"
-                f"<b>📎 Current:</b> <code>{formatted_channel}</code>",
-                parse_mode="HTML"
-            )
-            return
-        elif message_text == "My Caption":
-            user_caption = USER_DATA.get(str(user_id), {}).get("caption", "Not Set")
-        
-            await update.message.reply_text(
-                "<b>━━━━━━━━━━━━━━━━━━━━━━━━━━</b>\n"
-                "<b>     📝 CAPTION TEMPLATE     </b>\n"
-                "<b>━━━━━━━━━━━━━━━━━━━━━━━━━━</b>\n\n"
-                f"<code>{user_caption}</code>" if user_caption != "Not Set" else "<i>No caption set.</i>",
-                parse_mode="HTML"
-            )
-            return
-        elif message_text == "userstats" and user_id == OWNER_ID:
-            from datetime import datetime
-            from html import escape
-            import time
-            from zoneinfo import ZoneInfo  # For IST timezone
-
-            lines = [
-                "<b>📊 𝗨𝗦𝗘𝗥 𝗥𝗘𝗣𝗢𝗥𝗧</b>",
-                "<b>━━━━━━━━━━━━━━━━━━━━━━━</b>"
-            ]
+async def text_userstats(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    lines = [
+        "<b>📊 𝗨𝗦𝗘𝗥 𝗥𝗘𝗣𝗢𝗥𝗧</b>",
+        "<b>━━━━━━━━━━━━━━━━━━━━━━━</b>"
+    ]
+
+    if not ALLOWED_USERS:
+        lines.append("<b>⚠️ No authorized users found.</b>")
+    else:
+        for index, uid in enumerate(ALLOWED_USERS, start=1):
+            user = USER_DATA.get(str(uid), {})
+            state = USER_STATE.setdefault(uid, {})
 
-            if not ALLOWED_USERS:
-                lines.append("<b>⚠️ No authorized users found.</b>")
+            # Init start_time if missing
+            if "start_time" not in state:
+                state["start_time"] = time.time()
+
+            # Fetch live user details if needed
+            if "first_name" not in user or "username" not in user:
+                try:
+                    chat = await context.bot.get_chat(uid)
+                    user["first_name"] = chat.first_name or "—"
+                    user["username"] = chat.username or "—"
+                    USER_DATA[str(uid)] = user
+                    save_config()
+                except Exception:
+                    user.setdefault("first_name", "—")
+                    user.setdefault("username", "—")
+
+            # Format user display data
+            name = user.get("first_name", "—")
+            uname = user.get("username", "—")
+            uname_tag = f"@{uname}" if uname and uname != "—" else "—"
+
+            # Channel logic: clean display
+            raw_channel = str(user.get("channel") or "—")
+            if raw_channel.startswith("-100"):
+                channel_display = "Private ID"
+            elif raw_channel.startswith("@"):
+                channel_display = raw_channel.strip("@")
             else:
-                for index, uid in enumerate(ALLOWED_USERS, start=1):
-                    user = USER_DATA.get(str(uid), {})
-                    state = USER_STATE.setdefault(uid, {})
-
-                    # Init start_time if missing
-                    if "start_time" not in state:
-                        state["start_time"] = time.time()
-
-                    # Fetch live user details if needed
-                    if "first_name" not in user or "username" not in user:
-                        try:
-                            chat = await context.bot.get_chat(uid)
-                            user["first_name"] = chat.first_name or "—"
-                            user["username"] = chat.username or "—"
-                            USER_DATA[str(uid)] = user
-                            save_config()
-                        except Exception:
-                            user.setdefault("first_name", "—")
-                            user.setdefault("username", "—")
-
-                    # Format user display data
-                    name = user.get("first_name", "—")
-                    uname = user.get("username", "—")
-                    uname_tag = f"@{uname}" if uname and uname != "—" else "—"
-
-                    # Channel logic: clean display
-                    raw_channel = str(user.get("channel") or "—")
-                    if raw_channel.startswith("-100"):
-                        channel_display = "Private ID"
-                    elif raw_channel.startswith("@"):
-                        channel_display = raw_channel.strip("@")
-                    else:
-                        channel_display = raw_channel.strip("@")
-
-                    caption = user.get("caption")
-                    caption_text = f"<pre>{escape(str(caption)[:150])}</pre>" if caption else "—"
-
-                    start_ts = state.get("start_time", time.time())
-                    ist_now = datetime.now(ZoneInfo("Asia/Kolkata"))
-                    start_dt = datetime.fromtimestamp(start_ts, ZoneInfo("Asia/Kolkata"))
-                    days_used = (ist_now - start_dt).days
-
-                    # All-time counts
-                    m1_apks = state.get("alltime_method1_apks", 0)
-                    m1_keys = state.get("alltime_method1_keys", 0)
-                    m2_apks = state.get("alltime_method2_apks", 0)
-                    m2_keys = state.get("alltime_method2_keys", 0)
-                    total_apks = m1_apks + m2_apks
-                    total_keys = m1_keys + m2_keys
-
-                    lines.extend([
-                        f"\n<b>👤 USER {index}</b>",
-                        "<blockquote>",
-                        f"🆔 <b>ID:</b> <code>{uid}</code>",
-                        f"👤 <b>Name:</b> {name}",
-                        f"🔗 <b>Username:</b> {uname_tag}",
-                        f"📡 <b>Channel:</b> @{channel_display}" if channel_display != "Private ID" else "📡 <b>Channel:</b> Private ID",
-                        f"📝 <b>Caption:</b>\n{caption_text}",
-                        f"⏳ <b>Using Since:</b> {days_used} days",
-                        f"📦 <b>Method 1:</b> {m1_apks} APKs | {m1_keys} Keys",
-                        f"🧪 <b>Method 2:</b> {m2_apks} APKs | {m2_keys} Keys",
-                        f"🧮 <b>Total:</b> {total_apks} APKs | {total_keys} Keys",
-                        "</blockquote>"
-                    ])
-
-            lines.append(f"\n<b>👥 Total Users:</b> {len(ALLOWED_USERS)}")
-            lines.append(f"<b>📅 Generated:</b> {datetime.now(ZoneInfo('Asia/Kolkata')).strftime('%d %b %Y, %I:%M %p')}")
-
-            reply_markup = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🚂 Railway Panel", url="https://railway.app/project/")]
+                channel_display = raw_channel.strip("@")
+
+            caption = user.get("caption")
+            caption_text = f"<pre>{escape(str(caption)[:150])}</pre>" if caption else "—"
+
+            start_ts = state.get("start_time", time.time())
+            ist_now = datetime.now(ZoneInfo("Asia/Kolkata"))
+            start_dt = datetime.fromtimestamp(start_ts, ZoneInfo("Asia/Kolkata"))
+            days_used = (ist_now - start_dt).days
+
+            # All-time counts
+            m1_apks = state.get("alltime_method1_apks", 0)
+            m1_keys = state.get("alltime_method1_keys", 0)
+            m2_apks = state.get("alltime_method2_apks", 0)
+            m2_keys = state.get("alltime_method2_keys", 0)
+            total_apks = m1_apks + m2_apks
+            total_keys = m1_keys + m2_keys
+
+            lines.extend([
+                f"\n<b>👤 USER {index}</b>",
+                "<blockquote>",
+                f"🆔 <b>ID:</b> <code>{uid}</code>",
+                f"👤 <b>Name:</b> {name}",
+                f"🔗 <b>Username:</b> {uname_tag}",
+                f"📡 <b>Channel:</b> @{channel_display}" if channel_display != "Private ID" else "📡 <b>Channel:</b> Private ID",
+                f"📝 <b>Caption:</b>\n{caption_text}",
+                f"⏳ <b>Using Since:</b> {days_used} days",
+                f"📦 <b>Method 1:</b> {m1_apks} APKs | {m1_keys} Keys",
+                f"🧪 <b>Method 2:</b> {m2_apks} APKs | {m2_keys} Keys",
+                f"🧮 <b>Total:</b> {total_apks} APKs | {total_keys} Keys",
+                "</blockquote>"
             ])
 
-            await update.message.reply_text(
-                "\n".join(lines),
-                parse_mode="HTML",
-                disable_web_page_preview=True,
-                reply_markup=reply_markup
-            )
-            return
-        
-        
-        # STATE HANDLING
-        state = USER_STATE.get(user_id)
-        if not state:
-            return
-        
-        # --- Handle ReplyKeyboard Method Selection via Text ---
-        if raw_message_text == "METHOD 1":
-            query = update  # mock object
-            USER_STATE.setdefault(user_id, {})["current_method"] = "method1"
-            USER_STATE[user_id]["status"] = "normal"
-        
-            user_data = USER_DATA.get(str(user_id), {})
-            channel = user_data.get("channel")
-            caption = user_data.get("caption")
-        
-            buttons = []
-        
-            if BOT_ADMIN_LINK:
-                buttons.append([InlineKeyboardButton("🌟 Bot Admin", url=BOT_ADMIN_LINK)])
-        
-            buttons.append([InlineKeyboardButton("📡 Set Channel", callback_data="set_channel")])
-            buttons.append([InlineKeyboardButton("📝 Set Caption", callback_data="set_caption")])
-        
-            if channel and caption:
-                buttons.append([InlineKeyboardButton("📤 Send One APK", callback_data="send_apk_method1")])
-        
-            buttons.append([InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")])
-        
-            await update.message.reply_text(
-                "<b>╭─[ METHOD 1 SELECTED ]</b>\n"
-                "<blockquote>"
-                "│ ✅ Mode: Auto Key\n"
-                "│ 📤 One APK per send\n"
-                "│ ⚙️ Setup: Admin + Channel + Caption\n"
-                "╰────────────────────────\n"
-                "</blockquote>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(buttons)
-            )
-            return
-        
-        if raw_message_text == "METHOD 2":
-            USER_STATE.setdefault(user_id, {})["current_method"] = "method2"
-            USER_STATE[user_id]["status"] = "normal"
-        
-            user_data = USER_DATA.get(str(user_id), {})
-            channel = user_data.get("channel")
-            caption = user_data.get("caption")
-        
-            buttons = []
-        
-            if BOT_ADMIN_LINK:
-                buttons.append([InlineKeyboardButton("🌟 Bot Admin", url=BOT_ADMIN_LINK)])
-        
-            buttons.append([InlineKeyboardButton("📡 Set Channel", callback_data="set_channel")])
-            buttons.append([InlineKeyboardButton("📝 Set Caption", callback_data="set_caption")])
-        
-            if channel and caption:
-                buttons.append([InlineKeyboardButton("📤 Send 2–3 APKs", callback_data="send_apk_method2")])
-        
-            buttons.append([InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")])
-        
-            await update.message.reply_text(
-                "<b>╭─[ METHOD 2 SELECTED ]</b>\n"
-                "<blockquote>"
-                "│ ✅ Mode: Multi APK Upload\n"
-                "│ 📤 Upload 2-3 APKs\n"
-                "│ ⚙️ Setup: Channel + Caption\n"
-                "╰────────────────────────\n"
-                "</blockquote>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(buttons)
-            )
-            return
-    
-        if state.get("status") == "waiting_new_caption":
-            await method2_edit_caption(update, context)
-            return
-    
-        # ========= Method 1 & 2 ========= #
-    
-        # Handle Channel Setting (used in Method 1 & 2)
-        if state and state.get("status") == "waiting_channel":
-            channel_id = message_text.strip()
-        
-            # Validate channel format
-            if not (channel_id.startswith("@") or channel_id.startswith("-100")):
-                await update.message.reply_text(
-                    "<b>❌ Invalid Channel ID</b>\n"
-                    "Use <code>@channelusername</code> or <code>-100xxxxxxxxxx</code>",
-                    parse_mode="HTML"
-                )
-                return
-        
-            try:
-                chat_info = await context.bot.get_chat(channel_id)
-                admins = await context.bot.get_chat_administrators(chat_info.id)
-        
-                # Check bot is admin
-                bot_admin = any(admin.user.id == context.bot.id and admin.status in ["administrator", "creator"] for admin in admins)
-                if not bot_admin:
-                    await update.message.reply_text(
-                        "<b>🚫 Bot is not an admin!</b>\n"
-                        "Please make the bot an admin to continue.",
-                        parse_mode="HTML"
-                    )
-                    return
-        
-                # Check user is admin
-                user_admin = any(admin.user.id == user_id and admin.status in ["administrator", "creator"] for admin in admins)
-                if not user_admin:
-                    await update.message.reply_text(
-                        "<b>🚫 You are not an admin of this channel!</b>\n"
-                        "Only channel admins can link the channel.",
-                        parse_mode="HTML"
-                    )
-                    return
-        
-            except Exception as e:
-                await update.message.reply_text(
-                    f"<b>❌ Channel Not Found or Access Denied!</b>\n"
-                    "Make sure the bot is added and has access.\n"
-                    f"Error: {e}",
-                    parse_mode="HTML"
-                )
-                return
-        
-            # Save channel
-            USER_DATA[str(user_id)] = USER_DATA.get(str(user_id), {})
-            USER_DATA[str(user_id)]["channel"] = channel_id
-            save_config()
-            USER_STATE[user_id]["status"] = "normal"
-        
-            channel_disp = channel_id if channel_id.startswith("@") else f"<code>{channel_id}</code>"
-        
-            keyboard = [
-                [InlineKeyboardButton("⚡ Method 1", callback_data="method_1")],
-                [InlineKeyboardButton("🚀 Method 2", callback_data="method_2")]
-            ]
-        
-            await update.message.reply_text(
-                "<b>✅ 𝗖𝗵𝗮𝗻𝗻𝗲𝗹 𝗟𝗶𝗻𝗸𝗲𝗱 𝗦𝘂𝗰𝗰𝗲𝘀𝘀𝗳𝘂𝗹𝗹𝘆!</b>\n\n"
-                "<blockquote>"
-                f"📡 <b>Linked Channel:</b> {channel_disp}\n"
-                "🛡️ <b>Bot Status:</b> 𝗔𝗗𝗠𝗜𝗡 𝗖𝗢𝗡𝗙𝗜𝗥𝗠𝗘𝗗\n"
-                "🔄 <b>Channel Access:</b> 𝚅𝚎𝚛𝚒𝚏𝚒𝚎𝚍\n"
-                "━━━━━━━━━━━━━━━━━━━━━"
-                "</blockquote>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            return
-    
-        # Handle Styled Caption Setup (raw HTML allowed)
-        if state.get("status") == "waiting_caption":
-            caption = update.message.text.strip()
-
-            if "Key -" not in caption:
-                await update.message.reply_text(
-                    "<b>❗ Invalid Caption</b>\n"
-                    "It must include: <code>Key -</code>",
-                    parse_mode="HTML"
-                )
-                return
+    lines.append(f"\n<b>👥 Total Users:</b> {len(ALLOWED_USERS)}")
+    lines.append(f"<b>📅 Generated:</b> {datetime.now(ZoneInfo('Asia/Kolkata')).strftime('%d %b %Y, %I:%M %p')}")
 
-            USER_DATA[str(user_id)] = USER_DATA.get(str(user_id), {})
-            USER_DATA[str(user_id)]["caption"] = caption
-            save_config()
-            USER_STATE[user_id]["status"] = "normal"
+    reply_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🚂 Railway Panel", url="https://railway.app/project/")]
+    ])
 
-            keyboard = [
-                [InlineKeyboardButton("⚡ Method 1", callback_data="method_1")],
-                [InlineKeyboardButton("🚀 Method 2", callback_data="method_2")]
-            ]
+    await update.message.reply_text(
+        "\n".join(lines),
+        parse_mode="HTML",
+        disable_web_page_preview=True,
+        reply_markup=reply_markup
+    )
 
+async def text_method_1(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    USER_STATE.setdefault(user_id, {})["current_method"] = "method1"
+    USER_STATE[user_id]["status"] = "normal"
+
+    user_data = USER_DATA.get(str(user_id), {})
+    channel = user_data.get("channel")
+    caption = user_data.get("caption")
+
+    buttons = []
+
+    if BOT_ADMIN_LINK:
+        buttons.append([InlineKeyboardButton("🌟 Bot Admin", url=BOT_ADMIN_LINK)])
+
+    buttons.append([InlineKeyboardButton("📡 Set Channel", callback_data="set_channel")])
+    buttons.append([InlineKeyboardButton("📝 Set Caption", callback_data="set_caption")])
+
+    if channel and caption:
+        buttons.append([InlineKeyboardButton("📤 Send One APK", callback_data="send_apk_method1")])
+
+    buttons.append([InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")])
+
+    await update.message.reply_text(
+        "<b>╭─[ METHOD 1 SELECTED ]</b>\n"
+        "<blockquote>"
+        "│ ✅ Mode: Auto Key\n"
+        "│ 📤 One APK per send\n"
+        "│ ⚙️ Setup: Admin + Channel + Caption\n"
+        "╰────────────────────────\n"
+        "</blockquote>",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+async def text_method_2(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    USER_STATE.setdefault(user_id, {})["current_method"] = "method2"
+    USER_STATE[user_id]["status"] = "normal"
+
+    user_data = USER_DATA.get(str(user_id), {})
+    channel = user_data.get("channel")
+    caption = user_data.get("caption")
+
+    buttons = []
+
+    if BOT_ADMIN_LINK:
+        buttons.append([InlineKeyboardButton("🌟 Bot Admin", url=BOT_ADMIN_LINK)])
+
+    buttons.append([InlineKeyboardButton("📡 Set Channel", callback_data="set_channel")])
+    buttons.append([InlineKeyboardButton("📝 Set Caption", callback_data="set_caption")])
+
+    if channel and caption:
+        buttons.append([InlineKeyboardButton("📤 Send 2–3 APKs", callback_data="send_apk_method2")])
+
+    buttons.append([InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")])
+
+    await update.message.reply_text(
+        "<b>╭─[ METHOD 2 SELECTED ]</b>\n"
+        "<blockquote>"
+        "│ ✅ Mode: Multi APK Upload\n"
+        "│ 📤 Upload 2-3 APKs\n"
+        "│ ⚙️ Setup: Channel + Caption\n"
+        "╰────────────────────────\n"
+        "</blockquote>",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+async def text_set_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    channel_id = update.message.text.strip().lower()
+
+    # Validate channel format
+    if not (channel_id.startswith("@") or channel_id.startswith("-100")):
+        await update.message.reply_text(
+            "<b>❌ Invalid Channel ID</b>\n"
+            "Use <code>@channelusername</code> or <code>-100xxxxxxxxxx</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    try:
+        chat_info = await context.bot.get_chat(channel_id)
+        admins = await context.bot.get_chat_administrators(chat_info.id)
+
+        # Check bot is admin
+        bot_admin = any(admin.user.id == context.bot.id and admin.status in ["administrator", "creator"] for admin in admins)
+        if not bot_admin:
             await update.message.reply_text(
-                "<b>✅ 𝗖𝗮𝗽𝘁𝗶𝗼𝗻 𝗦𝗮𝘃𝗲𝗱 𝗦𝘂𝗰𝗰𝗲𝘀𝘀𝗳𝘂𝗹𝗹𝘆!</b>\n\n"
-                "<blockquote>"
-                "📝 <b>𝗖𝘂𝗿𝗿𝗲𝗻𝘁 𝗖𝗮𝗽𝘁𝗶𝗼𝗻 𝗣𝗿𝗲𝘃𝗶𝗲𝘄:</b>\n\n"
-                f"{caption}\n"
-                "━━━━━━━━━━━━━━━━━━━━━"
-                "</blockquote>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            return
-        
-        # ========= Method 3 (Auto 1, 2, 3) ========= #
-            
-        elif state.get("status", "").startswith("waiting_source"):
-            setup_num = state["status"][-1]
-            text = update.message.text.strip()
-        
-            if not (text.startswith("@") or text.startswith("-100")):
-                await update.message.reply_text("❌ Invalid Source Channel ID.\nMust start with @username or -100...")
-                return
-        
-            try:
-                if text.startswith("@"):
-                    chat = await context.bot.get_chat(text)
-                    resolved_id = str(chat.id)
-                    AUTO_SETUP[f"setup{setup_num}"]["source_channel"] = resolved_id
-                else:
-                    AUTO_SETUP[f"setup{setup_num}"]["source_channel"] = text
-            except Exception as e:
-                await update.message.reply_text(f"❌ Failed to resolve channel: {e}")
-                return
-        
-            USER_STATE[user_id]["status"] = "normal"
-            save_config()
-        
-            keyboard = [
-                [InlineKeyboardButton("📡 Set Source", callback_data=f"setsource{setup_num}"),
-                 InlineKeyboardButton("🎯 Set Destination", callback_data=f"setdest{setup_num}")],
-                [InlineKeyboardButton("✍️ Set Caption", callback_data=f"setdestcaption{setup_num}")],
-                [InlineKeyboardButton("🤖 Automated", callback_data=f"automated{setup_num}"),
-                 InlineKeyboardButton("🧠 Key Manual", callback_data=f"manual{setup_num}")],
-                [InlineKeyboardButton("📌 Quote Key", callback_data=f"quote{setup_num}"),
-                 InlineKeyboardButton("🔤 Mono Key", callback_data=f"mono{setup_num}")],
-                [InlineKeyboardButton("✅ On", callback_data=f"on{setup_num}"),
-                 InlineKeyboardButton("⛔ Off", callback_data=f"off{setup_num}")],
-                [InlineKeyboardButton("👁️ View Setup", callback_data=f"viewsetup{setup_num}"),
-                 InlineKeyboardButton("🧹 Reset Setup", callback_data=f"resetsetup{setup_num}")],
-                [InlineKeyboardButton("🔙 Back to Auto Menu", callback_data="method_3")]
-            ]
-        
-            await update.message.reply_text(
-                f"✅ Source Channel saved for Auto {setup_num}!\n\nChoose your next action:",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode="HTML"
-            )
-            return
-        
-        # ------------------------------
-        
-        elif state.get("status", "").startswith("waiting_dest"):
-            setup_num = state["status"][-1]
-            text = update.message.text.strip()
-        
-            if not (text.startswith("@") or text.startswith("-100")):
-                await update.message.reply_text("❌ Invalid Destination Channel ID.\nMust start with @username or -100...")
-                return
-        
-            try:
-                if text.startswith("@"):
-                    chat = await context.bot.get_chat(text)
-                    resolved_id = str(chat.id)
-                    AUTO_SETUP[f"setup{setup_num}"]["dest_channel"] = resolved_id
-                else:
-                    AUTO_SETUP[f"setup{setup_num}"]["dest_channel"] = text
-            except Exception as e:
-                await update.message.reply_text(f"❌ Failed to resolve channel: {e}")
-                return
-        
-            USER_STATE[user_id]["status"] = "normal"
-            save_config()
-        
-            keyboard = [
-                [InlineKeyboardButton("📡 Set Source", callback_data=f"setsource{setup_num}"),
-                 InlineKeyboardButton("🎯 Set Destination", callback_data=f"setdest{setup_num}")],
-                [InlineKeyboardButton("✍️ Set Caption", callback_data=f"setdestcaption{setup_num}")],
-                [InlineKeyboardButton("🤖 Automated", callback_data=f"automated{setup_num}"),
-                 InlineKeyboardButton("🧠 Key Manual", callback_data=f"manual{setup_num}")],
-                [InlineKeyboardButton("📌 Quote Key", callback_data=f"quote{setup_num}"),
-                 InlineKeyboardButton("🔤 Mono Key", callback_data=f"mono{setup_num}")],
-                [InlineKeyboardButton("✅ On", callback_data=f"on{setup_num}"),
-                 InlineKeyboardButton("⛔ Off", callback_data=f"off{setup_num}")],
-                [InlineKeyboardButton("👁️ View Setup", callback_data=f"viewsetup{setup_num}"),
-                 InlineKeyboardButton("🧹 Reset Setup", callback_data=f"resetsetup{setup_num}")],
-                [InlineKeyboardButton("🔙 Back to Auto Menu", callback_data="method_3")]
-            ]
-        
-            await update.message.reply_text(
-                f"✅ Destination Channel saved for Auto {setup_num}!\n\nChoose your next action:",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                "<b>🚫 Bot is not an admin!</b>\n"
+                "Please make the bot an admin to continue.",
                 parse_mode="HTML"
             )
             return
-        
-        # ------------------------------
-        
-        elif state.get("status", "").startswith("waiting_caption"):
-            setup_num = state["status"][-1]
-            text = update.message.text.strip()
-        
-            if "Key -" not in text:
-                await update.message.reply_text("❌ Destination Caption must include 'Key -' placeholder.")
-                return
-        
-            AUTO_SETUP[f"setup{setup_num}"]["dest_caption"] = text
-            USER_STATE[user_id]["status"] = "normal"
-            save_config()
-        
-            keyboard = [
-                [InlineKeyboardButton("📡 Set Source", callback_data=f"setsource{setup_num}"),
-                 InlineKeyboardButton("🎯 Set Destination", callback_data=f"setdest{setup_num}")],
-                [InlineKeyboardButton("✍️ Set Caption", callback_data=f"setdestcaption{setup_num}")],
-                [InlineKeyboardButton("🤖 Automated", callback_data=f"automated{setup_num}"),
-                 InlineKeyboardButton("🧠 Key Manual", callback_data=f"manual{setup_num}")],
-                [InlineKeyboardButton("📌 Quote Key", callback_data=f"quote{setup_num}"),
-                 InlineKeyboardButton("🔤 Mono Key", callback_data=f"mono{setup_num}")],
-                [InlineKeyboardButton("✅ On", callback_data=f"on{setup_num}"),
-                 InlineKeyboardButton("⛔ Off", callback_data=f"off{setup_num}")],
-                [InlineKeyboardButton("👁️ View Setup", callback_data=f"viewsetup{setup_num}"),
-                 InlineKeyboardButton("🧹 Reset Setup", callback_data=f"resetsetup{setup_num}")],
-                [InlineKeyboardButton("🔙 Back to Auto Menu", callback_data="method_3")]
-            ]
-        
+
+        # Check user is admin
+        user_admin = any(admin.user.id == user_id and admin.status in ["administrator", "creator"] for admin in admins)
+        if not user_admin:
             await update.message.reply_text(
-                f"✅ Destination Caption saved for Auto {setup_num}!\n\nChoose your next action:",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                "<b>🚫 You are not an admin of this channel!</b>\n"
+                "Only channel admins can link the channel.",
                 parse_mode="HTML"
             )
             return
-        
-        # Inside your text handler
-        if state.get("waiting_key") and state.get("current_method") == "method1":
-            key = update.message.text.strip()
-            file_id = state.get("file_id")
-            saved_caption = USER_DATA.get(str(user_id), {}).get("caption", "")
-            channel_id = USER_DATA.get(str(user_id), {}).get("channel", "")
-        
-            if not key or not file_id or not saved_caption or not channel_id:
-                await update.message.reply_text("❌ Missing data. Please restart Method 1.")
-                return
-        
-            final_caption = saved_caption.replace("Key -", f"Key - <code>{key}</code>")
-            
-            USER_STATE[user_id]["waiting_key"] = False
-            USER_STATE[user_id]["file_id"] = None
-            USER_STATE[user_id]["pending_apk"] = {
-                "file_id": file_id,
-                "caption": final_caption,
-                "channel": channel_id,
-                "confirm_message_id": update.message.message_id
-            }
-        
-            await ask_to_share(update, context)
-            return
-        
-        # Method 2 Key Handler — FINAL & STABLE
-        if state.get("current_method") == "method2":
-        
-            # Step 0: Accept key only if either waiting_key is True or countdown running
-            waiting = state.get("waiting_key", False)
-            countdown_active = (
-                state.get("countdown_task") and not state["countdown_task"].done()
-            )
-            if not (waiting or countdown_active):
-                return  # Ignore if neither countdown nor waiting_key is active
-        
-            # Step 1: Ignore if key already saved
-            if state.get("saved_key"):
-                return
-        
-            # Step 2: Grab key text and session files
-            key = update.message.text.strip()
-            session_files = state.get("session_files", [])
-        
-            # Step 3: Ignore if key is empty
-            if not key:
-                return
-        
-            # Step 4: Validate key length
-            if len(key) < 4 or len(key) > 30:
-                await update.message.reply_text("❗ Invalid key. Please enter a valid key.")
-                return
-        
-            # Step 5: Abort if no APKs exist
-            if not session_files:
-                return
-        
-            # Step 6: Stop countdown if it's running
-            task = state.get("countdown_task")
-            if task and not task.done():
-                task.cancel()
-            state["countdown_task"] = None
-        
-            # Step 7: Delete countdown message if exists
-            if state.get("countdown_msg_id"):
-                try:
-                    await context.bot.delete_message(
-                        chat_id=user_id,
-                        message_id=state["countdown_msg_id"]
-                    )
-                except:
-                    pass
-                state["countdown_msg_id"] = None
-        
-            # Step 8: Save key and reset session flags
-            state["saved_key"] = key
-            state["waiting_key"] = False
-            state["key_prompt_sent"] = True
-            state["quote_applied"] = False
-            state["mono_applied"] = False
-            state["progress_message_id"] = None
-        
-            # Step 9: Show post-key control panel
-            keyboard = [
-                [
-                    InlineKeyboardButton("✅ Send to Channel", callback_data="method2_yes"),
-                    InlineKeyboardButton("❌ Cancel Upload", callback_data="method2_no")
-                ],
-                [
-                    InlineKeyboardButton("✍️ Add Quote Style", callback_data="method2_quote"),
-                    InlineKeyboardButton("🔤 Add Mono Style", callback_data="method2_mono")
-                ],
-                [
-                    InlineKeyboardButton("📝 Edit Caption", callback_data="method2_edit"),
-                    InlineKeyboardButton("👁️ Preview Before Posting", callback_data="method2_preview")
-                ],
-                [
-                    InlineKeyboardButton("🧹 Clear all", callback_data="erase_all_session")
-                ]
-            ]
-        
-            sent = await update.message.reply_text(
-                text=(
-                    f"<pre>"
-                    f"▌ KEY RECEIVED ▌\n"
-                    f"▶ Your Key: {key}\n"
-                    f"▶ Choose what to do next with your APKs:\n"
-                    f"────────────────────"
-                    f"</pre>"
-                ),
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        
-            # Step 10: Save preview panel message ID
-            state["preview_message_id"] = sent.message_id
-            return
 
-        if USER_STATE.get(user_id, {}).get("awaiting_admin_link"):
-            link = update.message.text.strip()
+    except Exception as e:
+        await update.message.reply_text(
+            f"<b>❌ Channel Not Found or Access Denied!</b>\n"
+            "Make sure the bot is added and has access.\n"
+            f"Error: {e}",
+            parse_mode="HTML"
+        )
+        return
 
-            USER_STATE.setdefault(user_id, {})
+    # Save channel
+    USER_DATA[str(user_id)] = USER_DATA.get(str(user_id), {})
+    USER_DATA[str(user_id)]["channel"] = channel_id
+    save_config()
+    USER_STATE[user_id]["status"] = "normal"
 
-            if link.startswith("https://"):
-                BOT_ADMIN_LINK = link  # now this is allowed
-                config["bot_admin_link"] = link
-                save_config()
-                USER_STATE[user_id]["awaiting_admin_link"] = False
+    channel_disp = channel_id if channel_id.startswith("@") else f"<code>{channel_id}</code>"
 
-                await update.message.reply_text(
-                    "✅ Bot Admin link updated!",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Back to Settings", callback_data="settings_back")]
-                    ])
-                )
-            else:
-                await update.message.reply_text("❌ Invalid link. It must start with https://")
-            return
-        
-        # === Handle Add/Remove User Input from Settings Panel ===
-        if user_id == OWNER_ID:
-            # Always initialize USER_STATE entry for owner
-            state = USER_STATE.setdefault(user_id, {})
-            
-            # Handle Add User
-            if state.get("awaiting_add_user", False):
-                try:
-                    target_id = int(update.message.text.strip())
-                    ALLOWED_USERS.add(target_id)
-        
-                    # Attempt to fetch and store user info
-                    try:
-                        user = await context.bot.get_chat(target_id)
-                        USER_DATA[str(target_id)] = {
-                            "first_name": user.first_name or "—",
-                            "username": user.username or "—",
-                            "channel": USER_DATA.get(str(target_id), {}).get("channel", "—"),
-                            "first_seen": int(time.time())  # Optional: track join time
-                        }
-                    except Exception as e:
-                        print(f"[!] Failed to fetch user info: {e}")
-                        USER_DATA[str(target_id)] = {
-                            "first_name": "—",
-                            "username": "—",
-                            "channel": "—",
-                            "first_seen": int(time.time())
-                        }
-        
-                    save_config()
-                    state["awaiting_add_user"] = False  # Reset flag
-                    await update.message.reply_text(
-                        f"✅ User `{target_id}` added successfully!",
-                        parse_mode="Markdown",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔙 Back to Settings", callback_data="settings_back")]
-                        ])
-                    )
-                except Exception as e:
-                    print(f"[!] Error while adding user: {e}")
-                    await update.message.reply_text(
-                        f"❌ Error while adding user:\n<code>{e}</code>",
-                        parse_mode="HTML"
-                    )
-                return  # Let the callback handle back navigation
-        
-            # Handle Remove User
-            if state.get("awaiting_remove_user", False):
-                try:
-                    target_id = int(update.message.text.strip())
-                    ALLOWED_USERS.discard(target_id)
-                    USER_DATA.pop(str(target_id), None)
-                    save_config()
-                    state["awaiting_remove_user"] = False  # Reset flag
-                    await update.message.reply_text(
-                        f"🚫 User `{target_id}` removed successfully!",
-                        parse_mode="Markdown",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔙 Back to Settings", callback_data="settings_back")]
-                        ])
-                    )
-                except Exception as e:
-                    print(f"[!] Error while removing user: {e}")
-                    await update.message.reply_text(
-                        f"❌ Error while removing user:\n<code>{e}</code>",
-                        parse_mode="HTML"
-                    )
-                return  # Let the callback handle back navigation
-        
+    keyboard = [
+        [InlineKeyboardButton("⚡ Method 1", callback_data="method_1")],
+        [InlineKeyboardButton("🚀 Method 2", callback_data="method_2")]
+    ]
+
+    await update.message.reply_text(
+        "<b>✅ 𝗖𝗵𝗮𝗻𝗻𝗲𝗹 𝗟𝗶𝗻𝗸𝗲𝗱 𝗦𝘂𝗰𝗰𝗲𝘀𝘀𝗳𝘂𝗹𝗹𝘆!</b>\n\n"
+        "<blockquote>"
+        f"📡 <b>Linked Channel:</b> {channel_disp}\n"
+        "🛡️ <b>Bot Status:</b> 𝗔𝗗𝗠𝗜𝗡 𝗖𝗢𝗡𝗙𝗜𝗥𝗠𝗘𝗗\n"
+        "🔄 <b>Channel Access:</b> 𝚅𝚎𝚛𝚒𝚏𝚒𝚎𝚍\n"
+        "━━━━━━━━━━━━━━━━━━━━━"
+        "</blockquote>",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def text_set_caption(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    caption = update.message.text.strip()
+
+    if "Key -" not in caption:
+        await update.message.reply_text(
+            "<b>❗ Invalid Caption</b>\n"
+            "It must include: <code>Key -</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    USER_DATA[str(user_id)] = USER_DATA.get(str(user_id), {})
+    USER_DATA[str(user_id)]["caption"] = caption
+    save_config()
+    USER_STATE[user_id]["status"] = "normal"
+
+    keyboard = [
+        [InlineKeyboardButton("⚡ Method 1", callback_data="method_1")],
+        [InlineKeyboardButton("🚀 Method 2", callback_data="method_2")]
+    ]
+
+    await update.message.reply_text(
+        "<b>✅ 𝗖𝗮𝗽𝘁𝗶𝗼𝗻 𝗦𝗮𝘃𝗲𝗱 𝗦𝘂𝗰𝗰𝗲𝘀𝘀𝗳𝘂𝗹𝗹𝘆!</b>\n\n"
+        "<blockquote>"
+        "📝 <b>𝗖𝘂𝗿𝗿𝗲𝗻𝘁 𝗖𝗮𝗽𝘁𝗶𝗼𝗻 𝗣𝗿𝗲𝘃𝗶𝗲𝘄:</b>\n\n"
+        f"{caption}\n"
+        "━━━━━━━━━━━━━━━━━━━━━"
+        "</blockquote>",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def text_auto_source(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    setup_num = arg
+    text = update.message.text.strip()
+
+    if not (text.startswith("@") or text.startswith("-100")):
+        await update.message.reply_text("❌ Invalid Source Channel ID.\nMust start with @username or -100...")
+        return
+
+    try:
+        if text.startswith("@"):
+            chat = await context.bot.get_chat(text)
+            resolved_id = str(chat.id)
+            AUTO_SETUP[f"setup{setup_num}"]["source_channel"] = resolved_id
+        else:
+            AUTO_SETUP[f"setup{setup_num}"]["source_channel"] = text
     except Exception as e:
-        await notify_owner_on_error(context.bot, e, source="handle_text")
+        await update.message.reply_text(f"❌ Failed to resolve channel: {e}")
+        return
+
+    USER_STATE[user_id]["status"] = "normal"
+    save_config()
+
+    await update.message.reply_text(
+        f"✅ Source Channel saved for Auto {setup_num}!\n\nChoose your next action:",
+        reply_markup=build_auto_keyboard(setup_num),
+        parse_mode="HTML"
+    )
+
+async def text_auto_dest(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    setup_num = arg
+    text = update.message.text.strip()
+
+    if not (text.startswith("@") or text.startswith("-100")):
+        await update.message.reply_text("❌ Invalid Destination Channel ID.\nMust start with @username or -100...")
+        return
 
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        query = update.callback_query
-        user_id = query.from_user.id
-        data = query.data
+        if text.startswith("@"):
+            chat = await context.bot.get_chat(text)
+            resolved_id = str(chat.id)
+            AUTO_SETUP[f"setup{setup_num}"]["dest_channel"] = resolved_id
+        else:
+            AUTO_SETUP[f"setup{setup_num}"]["dest_channel"] = text
+    except Exception as e:
+        await update.message.reply_text(f"❌ Failed to resolve channel: {e}")
+        return
 
-        # Immediately answer callback to avoid Telegram timeout
+    USER_STATE[user_id]["status"] = "normal"
+    save_config()
+
+    await update.message.reply_text(
+        f"✅ Destination Channel saved for Auto {setup_num}!\n\nChoose your next action:",
+        reply_markup=build_auto_keyboard(setup_num),
+        parse_mode="HTML"
+    )
+
+async def text_auto_caption(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    setup_num = arg
+    text = update.message.text.strip()
+
+    if "Key -" not in text:
+        await update.message.reply_text("❌ Destination Caption must include 'Key -' placeholder.")
+        return
+
+    AUTO_SETUP[f"setup{setup_num}"]["dest_caption"] = text
+    USER_STATE[user_id]["status"] = "normal"
+    save_config()
+
+    await update.message.reply_text(
+        f"✅ Destination Caption saved for Auto {setup_num}!\n\nChoose your next action:",
+        reply_markup=build_auto_keyboard(setup_num),
+        parse_mode="HTML"
+    )
+
+async def text_method1_key(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    state = USER_STATE[user_id]
+    key = update.message.text.strip()
+    file_id = state.get("file_id")
+    saved_caption = USER_DATA.get(str(user_id), {}).get("caption", "")
+    channel_id = USER_DATA.get(str(user_id), {}).get("channel", "")
+
+    if not key or not file_id or not saved_caption or not channel_id:
+        await update.message.reply_text("❌ Missing data. Please restart Method 1.")
+        return
+
+    final_caption = render_caption(saved_caption, key, "mono")
+
+    USER_STATE[user_id]["waiting_key"] = False
+    USER_STATE[user_id]["file_id"] = None
+    USER_STATE[user_id]["pending_apk"] = {
+        "file_id": file_id,
+        "file_unique_id": state.pop("file_unique_id", None),
+        "key": key,
+        "caption": final_caption,
+        "channel": channel_id,
+        "confirm_message_id": update.message.message_id
+    }
+
+    await ask_to_share(update, context)
+
+async def text_method2_key(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    state = USER_STATE[user_id]
+
+    # Step 1: Ignore if key already saved
+    if state.get("saved_key"):
+        return
+
+    # Step 2: Grab key text and session files
+    key = update.message.text.strip()
+    session_files = state.get("session_files", [])
+
+    # Step 3: Ignore if key is empty
+    if not key:
+        return
+
+    # Step 4: Validate key length
+    if len(key) < 4 or len(key) > 30:
+        await update.message.reply_text("❗ Invalid key. Please enter a valid key.")
+        return
+
+    # Step 5: Abort if no APKs exist
+    if not session_files:
+        return
+
+    # Step 6: Stop countdown if it's running
+    task = state.get("countdown_task")
+    if task and not task.done():
+        task.cancel()
+    state["countdown_task"] = None
+
+    # Step 7: Delete countdown message if exists
+    if state.get("countdown_msg_id"):
         try:
-            await query.answer()
+            await context.bot.delete_message(
+                chat_id=user_id,
+                message_id=state["countdown_msg_id"]
+            )
         except:
-            await query.message.reply_text("⏳ Session expired or invalid. ❌")
-            return
+            pass
+        state["countdown_msg_id"] = None
 
-        # Anti-spam cooldown
-        now = time.time()
-        if not hasattr(context, "user_cooldowns"):
-            context.user_cooldowns = {}
-        if user_id in context.user_cooldowns and now - context.user_cooldowns[user_id] < 1:
-            await query.answer("⌛ Wait a second...", show_alert=False)
-            return
-        context.user_cooldowns[user_id] = now
+    # Step 8: Save key and reset session flags
+    state["saved_key"] = key
+    state["waiting_key"] = False
+    state["key_prompt_sent"] = True
+    state["quote_applied"] = False
+    state["mono_applied"] = False
+    state["progress_message_id"] = None
 
-        # ✅ Confirm Broadcast
-        if data == "confirm_broadcast":
-            await send_broadcast(update, context)
-            return
+    # Step 9: Show post-key control panel
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ Send to Channel", callback_data="method2_yes"),
+            InlineKeyboardButton("❌ Cancel Upload", callback_data="method2_no")
+        ],
+        [
+            InlineKeyboardButton("✍️ Add Quote Style", callback_data="method2_quote"),
+            InlineKeyboardButton("🔤 Add Mono Style", callback_data="method2_mono")
+        ],
+        [
+            InlineKeyboardButton("📝 Edit Caption", callback_data="method2_edit"),
+            InlineKeyboardButton("👁️ Preview Before Posting", callback_data="method2_preview")
+        ],
+        [
+            InlineKeyboardButton("🧹 Clear all", callback_data="erase_all_session")
+        ]
+    ]
 
-        # ❌ Cancel Broadcast
-        if data == "cancel_broadcast":
-            BROADCAST_SESSION.pop(user_id, None)
-            try:
-                await query.message.delete()
-            except:
-                await query.edit_message_text("❌ Broadcast Cancelled.", parse_mode="HTML")
-            return
+    sent = await update.message.reply_text(
+        text=(
+            f"<pre>"
+            f"▌ KEY RECEIVED ▌\n"
+            f"▶ Your Key: {key}\n"
+            f"▶ Choose what to do next with your APKs:\n"
+            f"────────────────────"
+            f"</pre>"
+        ),
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-        # ⚠️ Unknown Callback
-        await query.answer("⚠️ Unknown action.", show_alert=True)
+    # Step 10: Save preview panel message ID
+    state["preview_message_id"] = sent.message_id
 
-        # Optional: Session check (if callback is from normal user flow)
-        if user_id not in USER_STATE:
-            await query.edit_message_text(
-                "⏳ Session expired or invalid! ❌\nPlease restart using /start.",
-                parse_mode="Markdown"
-            )
-            return
-    
-        # --- define auto keyboard generator here ---
-        def get_auto_keyboard(setup_num):
-            keyboard = [
-                [InlineKeyboardButton("📡 Set Source", callback_data=f"setsource{setup_num}"),
-                 InlineKeyboardButton("🎯 Set Destination", callback_data=f"setdest{setup_num}")],
-                [InlineKeyboardButton("✍️ Set Caption", callback_data=f"setdestcaption{setup_num}")]
-            ]
-        
-            # Only show key mode buttons for Auto 1–3
-            if setup_num in ("1", "2", "3"):
-                keyboard.append([
-                    InlineKeyboardButton("🤖 Automated", callback_data=f"automated{setup_num}"),
-                    InlineKeyboardButton("🧠 Key Manual", callback_data=f"manual{setup_num}")
-                ])
-        
-            # Key style buttons (shown for all autos)
-            keyboard.append([
-                InlineKeyboardButton("📌 Quote Key", callback_data=f"quote{setup_num}"),
-                InlineKeyboardButton("🔤 Mono Key", callback_data=f"mono{setup_num}")
-            ])
-        
-            # On/Off toggle
-            keyboard.append([
-                InlineKeyboardButton("✅ On", callback_data=f"on{setup_num}"),
-                InlineKeyboardButton("⛔ Off", callback_data=f"off{setup_num}")
+async def text_admin_link(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    global BOT_ADMIN_LINK
+    user_id = update.effective_user.id
+    link = update.message.text.strip()
+
+    if link.startswith("https://"):
+        BOT_ADMIN_LINK = link  # now this is allowed
+        config["bot_admin_link"] = link
+        save_config()
+        USER_STATE[user_id]["awaiting_admin_link"] = False
+
+        await update.message.reply_text(
+            "✅ Bot Admin link updated!",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Back to Settings", callback_data="settings_back")]
             ])
-        
-            # View/Reset + back button
-            keyboard.append([
-                InlineKeyboardButton("👁️ View Setup", callback_data=f"viewsetup{setup_num}"),
-                InlineKeyboardButton("🧹 Reset Setup", callback_data=f"resetsetup{setup_num}")
+        )
+    else:
+        await update.message.reply_text("❌ Invalid link. It must start with https://")
+
+async def text_add_user(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    state = USER_STATE[user_id]
+    try:
+        target_id = int(update.message.text.strip())
+        ALLOWED_USERS.add(target_id)
+
+        # Attempt to fetch and store user info
+        try:
+            user = await context.bot.get_chat(target_id)
+            USER_DATA[str(target_id)] = {
+                "first_name": user.first_name or "—",
+                "username": user.username or "—",
+                "channel": USER_DATA.get(str(target_id), {}).get("channel", "—"),
+                "first_seen": int(time.time())  # Optional: track join time
+            }
+        except Exception as e:
+            log_event("users", "warning", "Failed to fetch user info", user_id=target_id, error=str(e))
+            USER_DATA[str(target_id)] = {
+                "first_name": "—",
+                "username": "—",
+                "channel": "—",
+                "first_seen": int(time.time())
+            }
+
+        save_config()
+        state["awaiting_add_user"] = False  # Reset flag
+        await update.message.reply_text(
+            f"✅ User `{target_id}` added successfully!",
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Back to Settings", callback_data="settings_back")]
             ])
-        
-            keyboard.append([
-                InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")
+        )
+    except Exception as e:
+        log_event("users", "error", "Error while adding user", error=str(e))
+        await update.message.reply_text(
+            f"❌ Error while adding user:\n<code>{e}</code>",
+            parse_mode="HTML"
+        )
+
+async def text_remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    user_id = update.effective_user.id
+    state = USER_STATE[user_id]
+    try:
+        target_id = int(update.message.text.strip())
+        ALLOWED_USERS.discard(target_id)
+        USER_DATA.pop(str(target_id), None)
+        save_config()
+        state["awaiting_remove_user"] = False  # Reset flag
+        await update.message.reply_text(
+            f"🚫 User `{target_id}` removed successfully!",
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Back to Settings", callback_data="settings_back")]
             ])
-        
-            return InlineKeyboardMarkup(keyboard)
-    
-        # --- Handling Auto Setup Buttons ---
-        if data == "method_3":
-            keyboard = [
-                [InlineKeyboardButton("⚙️ Auto 1", callback_data="auto1_menu"),
-                 InlineKeyboardButton("⚙️ Auto 2", callback_data="auto2_menu")],
-                [InlineKeyboardButton("⚙️ Auto 3", callback_data="auto3_menu"),
-                 InlineKeyboardButton("⚙️ Auto 4", callback_data="auto4_menu")],
-                [InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")]
-            ]
-            await query.edit_message_text(
-                "🛠 <b>Method 3 Activated!</b>\nChoose a setup to configure:",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            return
+        )
+    except Exception as e:
+        log_event("users", "error", "Error while removing user", error=str(e))
+        await update.message.reply_text(
+            f"❌ Error while removing user:\n<code>{e}</code>",
+            parse_mode="HTML"
+        )
 
-        if data == "back_to_methods":
-            user = query.from_user
-            user_id = user.id
-            user_key = str(user_id)  # Moved this up before using it
-    
-            # Get or set first_seen timestamp
-            first_seen = USER_DATA.get(user_key, {}).get("first_seen")
-            if not first_seen:
-                first_seen = int(time.time())
-                USER_DATA[user_key] = USER_DATA.get(user_key, {})
-                USER_DATA[user_key]["first_seen"] = first_seen
-                save_config()
-    
-            now = int(time.time())
-            days_count = (now - first_seen) // 86400
-    
-            india_tz = ZoneInfo("Asia/Kolkata")
-    
-            keyboard = [
-                [InlineKeyboardButton("⚡ Method 1", callback_data="method_1")],
-                [InlineKeyboardButton("🚀 Method 2", callback_data="method_2")]
-            ]
-            if user_id == OWNER_ID:
-                keyboard.append([InlineKeyboardButton("🛠 Method 3", callback_data="method_3")])
-    
-            await query.edit_message_text(
-                text=(
-                    "<b>𝗖𝗘𝗢 𝗣𝗔𝗡𝗘𝗟 🏆</b>\n"
-                    "<blockquote>"
-                    "<b>━━━━━━━━━━━━━━━━━━━━━━━━\n"
-                    f"• 👤 Name     : {user.first_name or 'User'}\n"
-                    f"• 🆔 User ID  : <a href=\"tg://user?id={user_id}\">{user_id}</a>\n"
-                    f"• ⏱️ Days     : {days_count} Days\n"
-                    "• ✅ Access   : Authorized ✓\n"
-                    "• ⚙️ System   : Online ✓\n\n"
-                    "      <b>𝗨𝗽𝗹𝗼𝗮𝗱 𝗠𝗲𝘁𝗵𝗼𝗱𝘀</b>\n"
-                    "➡ Method 1 - 𝚄𝚙𝚕𝚘𝚊𝚍 𝟷/𝟷 𝙰𝚙𝚔\n"
-                    "➡ Method 2 - 𝚄𝚙𝚕𝚘𝚊𝚍 𝟹/𝟹 𝚊𝚙𝚔𝚜\n"
-                    "━━━━━━━━━━━━━━━━━━━━━━━━</b>"
-                    "</blockquote>\n"
-                    "<i>NOTE: You can switch methods anytime. Logs are monitored.</i>"
-                ),
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                disable_web_page_preview=True
-            )
-    
-        if data.startswith("auto") and data.endswith("_menu"):
-            setup_num = data[4]
-            await query.edit_message_text(
-                text=f"⚙️ <b>Auto {setup_num} Config</b>\nSelect an option to configure:",
-                parse_mode="HTML",
-                reply_markup=get_auto_keyboard(setup_num)
-            )
-            return
-    
-        if data.startswith("setsource"):
-            setup_num = data[-1]
-            USER_STATE[user_id]["status"] = f"waiting_source{setup_num}"
-            await query.edit_message_text(f"📡 Send Source Channel ID for Auto {setup_num}", parse_mode="HTML")
-            return
-    
-        if data.startswith("setdest") and not data.startswith("setdestcaption"):
-            setup_num = data[-1]
-            USER_STATE[user_id]["status"] = f"waiting_dest{setup_num}"
-            await query.edit_message_text(f"🎯 Send Destination Channel ID for Auto {setup_num}", parse_mode="HTML")
-            return
-    
-        if data.startswith("setdestcaption"):
-            setup_num = data[-1]
-            USER_STATE[user_id]["status"] = f"waiting_caption{setup_num}"
-            await query.edit_message_text(f"✍️ Send Caption (must include 'Key -') for Auto {setup_num}", parse_mode="HTML")
-            return
-    
-        if data.startswith("automated"):
-            setup_num = data[-1]
-            AUTO_SETUP[f"setup{setup_num}"]["key_mode"] = "auto"
-            save_config()
-            await query.edit_message_text(
-                text=f"✅ Auto {setup_num} set to <b>Automated Key Mode</b>.\n\nChoose next action:",
-                parse_mode="HTML",
-                reply_markup=get_auto_keyboard(setup_num)
-            )
+TEXT_BUTTONS = {
+    "ping": (lambda update, context, arg: ping(update, context), ROUTE_OPEN),
+    "help": (lambda update, context, arg: help_command(update, context), ROUTE_OPEN),
+    "rules": (lambda update, context, arg: rules(update, context), ROUTE_OPEN),
+    "reset": (lambda update, context, arg: reset(update, context), ROUTE_OPEN),
+    "viewsetup": (lambda update, context, arg: user_viewsetup(update, context), ROUTE_OPEN),
+    "my channel": (text_my_channel, ROUTE_OPEN),
+    "my caption": (text_my_caption, ROUTE_OPEN),
+    "method 1": (text_method_1, ROUTE_SESSION),
+    "method 2": (text_method_2, ROUTE_SESSION),
+    "userlist": (lambda update, context, arg: userlist(update, context), ROUTE_OWNER),
+    "userstats": (text_userstats, ROUTE_OWNER),
+    "settings": (lambda update, context, arg: settings_panel(update, context), ROUTE_OWNER),
+    "broadcast": (text_broadcast_mode, ROUTE_OWNER),
+    "on": (text_bot_on, ROUTE_OWNER),
+    "off": (text_bot_off, ROUTE_OWNER)
+}
+
+TEXT_STATES = {
+    "broadcast": text_broadcast_message,
+    "waiting_channel": text_set_channel,
+    "waiting_caption": text_set_caption,
+    "waiting_new_caption": lambda update, context, arg: method2_edit_caption(update, context),
+    "waiting_source#": text_auto_source,
+    "waiting_dest#": text_auto_dest,
+    "waiting_caption#": text_auto_caption,
+    "method1_key": text_method1_key,
+    "method2_key": text_method2_key,
+    "admin_link": text_admin_link,
+    "add_user": text_add_user,
+    "remove_user": text_remove_user
+}
+
+def text_state(user_id: int) -> str:
+    if user_id == OWNER_ID and BROADCAST_SESSION.get(user_id, {}).get("waiting_for_message"):
+        return "broadcast"
+
+    state = USER_STATE.get(user_id)
+    if not state:
+        return None
+
+    status = state.get("status") or ""
+    if route_lookup(TEXT_STATES, status)[0]:
+        return status
+
+    if state.get("current_method") == "method1" and state.get("waiting_key"):
+        return "method1_key"
+
+    # Method 2 accepts a key while waiting for one or while the countdown runs
+    if state.get("current_method") == "method2":
+        task = state.get("countdown_task")
+        if state.get("waiting_key") or (task and not task.done()):
+            return "method2_key"
+
+    if state.get("awaiting_admin_link"):
+        return "admin_link"
+    if user_id == OWNER_ID and state.get("awaiting_add_user"):
+        return "add_user"
+    if user_id == OWNER_ID and state.get("awaiting_remove_user"):
+        return "remove_user"
+    return None
+
+def button_allowed(access: str, user_id: int) -> bool:
+    if access == ROUTE_OWNER:
+        return user_id == OWNER_ID
+    if access == ROUTE_SESSION:
+        return user_id in USER_STATE
+    return True
+
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if not update.message or not update.message.text or not update.effective_user:
             return
-    
-        if data.startswith("manual"):
-            setup_num = data[-1]
-            AUTO_SETUP[f"setup{setup_num}"]["key_mode"] = "manual"
+
+        user = update.effective_user
+        user_id = user.id
+
+        # Register user
+        if str(user_id) not in USER_DATA:
+            USER_DATA[str(user_id)] = {
+                "first_name": user.first_name,
+                "username": user.username,
+            }
             save_config()
-            await query.edit_message_text(
-                text=f"✅ Auto {setup_num} set to <b>Manual Key Mode</b>.\n\nChoose next action:",
-                parse_mode="HTML",
-                reply_markup=get_auto_keyboard(setup_num)
-            )
+
+        # Bot OFF logic
+        if not BOT_ACTIVE and user_id != OWNER_ID:
+            await update.message.reply_text("🚫 The bot is currently turned off by the admin.")
             return
-    
-        if data.startswith("quote"):
-            setup_num = data[-1]
-            AUTO_SETUP[f"setup{setup_num}"]["style"] = "quote"
-            save_config()
-            await query.edit_message_text(
-                text=f"✅ Auto {setup_num} set to <b>Quote Key Style</b>.\n\nChoose next action:",
-                parse_mode="HTML",
-                reply_markup=get_auto_keyboard(setup_num)
-            )
+
+        # Unauthorized user check
+        if user_id != OWNER_ID and user_id not in ALLOWED_USERS:
+            await update.message.reply_text("🚫 You are not authorized to interact.")
             return
-    
-        if data.startswith("mono"):
-            setup_num = data[-1]
-            AUTO_SETUP[f"setup{setup_num}"]["style"] = "mono"
-            save_config()
-            await query.edit_message_text(
-                text=f"✅ Auto {setup_num} set to <b>Mono Key Style</b>.\n\nChoose next action:",
-                parse_mode="HTML",
-                reply_markup=get_auto_keyboard(setup_num)
-            )
-            return
-    
-        if data.startswith("on"):
-            setup_num = data[-1]
-            AUTO_SETUP[f"setup{setup_num}"]["enabled"] = True
-            save_config()
-            await query.edit_message_text(
-                text=f"✅ Auto {setup_num} has been <b>Turned ON</b>.\n\nChoose next action:",
-                parse_mode="HTML",
-                reply_markup=get_auto_keyboard(setup_num)
-            )
-            return
-    
-        if data.startswith("off"):
-            setup_num = data[-1]
-            AUTO_SETUP[f"setup{setup_num}"]["enabled"] = False
-            save_config()
-            await query.edit_message_text(
-                text=f"⛔ Auto {setup_num} has been <b>Turned OFF</b>.\n\nChoose next action:",
-                parse_mode="HTML",
-                reply_markup=get_auto_keyboard(setup_num)
-            )
-            return
-        
-        if data == "auto4_menu":
-            keyboard = [
-                [InlineKeyboardButton("📡 Set Source", callback_data="setsource4"),
-                 InlineKeyboardButton("🎯 Set Destination", callback_data="setdest4")],
-                [InlineKeyboardButton("✍️ Set Caption", callback_data="setdestcaption4")],
-                [InlineKeyboardButton("🤖 Automated", callback_data="automated4"),
-                 InlineKeyboardButton("🧠 Key Manual", callback_data="manual4")],
-                [InlineKeyboardButton("📌 Quote Key", callback_data="quote4"),
-                 InlineKeyboardButton("🔤 Mono Key", callback_data="mono4")],
-                [InlineKeyboardButton("✅ On", callback_data="on4"),
-                 InlineKeyboardButton("⛔ Off", callback_data="off4")],
-                [InlineKeyboardButton("👁️ View Setup", callback_data="viewsetup4"),
-                 InlineKeyboardButton("🧹 Reset Setup", callback_data="resetsetup4")],
-                [InlineKeyboardButton("🔙 Back to Auto Menu", callback_data="method_3")]
-            ]
-            await query.edit_message_text(
-                text="⚙️ <b>Auto 4 Config</b>\nSelect an option to configure:",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            return
-        
-        if data.startswith("viewsetup"):
-            setup_num = data[-1]
-            s = AUTO_SETUP.get(f"setup{setup_num}", {})
-        
-            total_keys = s.get("completed_count", 0)
-            total_apks = s.get("processed_count", total_keys)  # fallback
-            source = s.get("source_channel", "Not Set")
-            dest = s.get("dest_channel", "Not Set")
-            caption_ok = "✅" if s.get("dest_caption") else "❌"
-            key_mode = s.get("key_mode", "auto").capitalize()
-            style = s.get("style", "mono").capitalize()
-            status = "✅ ON" if s.get("enabled") else "⛔ OFF"
-        
-            msg = (
-                f"<pre>"
-                f"┌──── AUTO {setup_num} SYSTEM DIAG ─────┐\n"
-                f"│ SOURCE        >>  {source}\n"
-                f"│ DESTINATION   >>  {dest}\n"
-                f"│ CAPTION       >>  {caption_ok}\n"
-                f"│ KEY_MODE      >>  {key_mode}\n"
-                f"│ STYLE         >>  {style}\n"
-                f"│ STATUS        >>  {status}\n"
-                f"│ KEYS_SENT     >>  {total_keys}\n"
-                f"│ TOTAL_APKS    >>  {total_apks} APK{'s' if total_apks != 1 else ''}\n"
-                f"└──────── END OF REPORT ────────┘"
-                f"</pre>"
-            )
-        
-            await query.edit_message_text(
-                text=msg,
-                parse_mode="HTML",
-                reply_markup=get_auto_keyboard(setup_num)
-            )
-            return
-    
-        if data.startswith("resetsetup"):
-            setup_num = data[-1]
-            AUTO_SETUP[f"setup{setup_num}"] = {
-                "source_channel": "",
-                "dest_channel": "",
-                "dest_caption": "",
-                "key_mode": "auto",
-                "style": "mono",
-                "enabled": False,
-                "completed_count": 0,
-                "processed_count": 0,
-                "last_key": ""
-            }
-            save_config()
-        
-            msg = (
-                f"<pre>"
-                f"┌──── AUTO {setup_num} SYSTEM RESET ─────┐\n"
-                f"│ STATUS       >>  RESET COMPLETE        │\n"
-                f"│ ALL VALUES   >>  CLEARED               │\n"
-                f"│ MODE         >>  AUTO                  │\n"
-                f"│ STYLE        >>  MONO                  │\n"
-                f"└───────RESET DONE──────────┘"
-                f"</pre>"
-            )
-        
-            await query.edit_message_text(
-                text=msg,
-                parse_mode="HTML",
-                reply_markup=get_auto_keyboard(setup_num)
-            )
-            return
-    
-        # --- Check user session ---
-        if user_id not in USER_STATE:
-            await query.edit_message_text(
-                "⏳ *Session expired or invalid!* ❌\nPlease restart using /start.",
-                parse_mode="Markdown"
-            )
-            return
-    
-        state = USER_STATE[user_id]
-        channel_id = USER_DATA.get(str(user_id), {}).get("channel")
-    
-        # --- Set Channel or Caption ---
-        if data == "set_channel":
-            USER_STATE[user_id]["status"] = "waiting_channel"
-        
-            keyboard = []
-            if BOT_ADMIN_LINK:
-                keyboard.append([InlineKeyboardButton("👨‍💻 Bot Admin", url=BOT_ADMIN_LINK)])
-        
-            await query.edit_message_text(
-                "📡 <b>Please send your Channel ID now!</b>\n"
-                "Example: <code>@yourchannel</code> or <code>-100xxxxxxxxxx</code>\n\n"
-                "⚠️ Make sure the bot is added as ADMIN in that channel!",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
-            )
-            return
-    
-        if data == "set_caption":
-            USER_STATE[user_id]["status"] = "waiting_caption"
-            await query.edit_message_text(
-                "📝 *Please send your Caption now!* Must contain: `Key -`",
-                parse_mode="Markdown"
-            )
-            return
-    
-        # --- Method 1 Selected ---
-        if data == "method_1":
-            USER_STATE.setdefault(user_id, {})["current_method"] = "method1"
-            USER_STATE[user_id]["status"] = "normal"
-        
-            user_data = USER_DATA.get(str(user_id), {})
-            channel = user_data.get("channel", "❌ Not Set")
-            caption = user_data.get("caption", "❌ Not Set")
-        
-            text = (
-                "<b>⚙️ 𝐌𝐄𝐓𝐇𝐎𝐃 𝟏 𝐒𝐄𝐋𝐄𝐂𝐓𝐄𝐃</b>\n"
-                "<blockquote>━━━━━━━━━━━━━━━━━━━━━━\n\n"
-                "<b>𝗬𝗼𝘂𝗿 𝗖𝗵𝗮𝗻𝗻𝗲𝗹 📡</b>\n"
-                f"{channel}\n\n"
-                "<b>𝗬𝗼𝘂𝗿 𝗖𝗮𝗽𝘁𝗶𝗼𝗻 📝</b>\n\n"
-                f"{caption}\n"
-                "━━━━━━━━━━━━━━━━━━━━━━</blockquote>\n"
-                "<b>🧠 Details:</b>\n"
-                "<i>• Auto-Key detection from your APK</i>\n"
-                "<i>• Channel & Caption required</i>"
-            )
-        
-            await query.edit_message_text(
-                text=text,
-                parse_mode="HTML",
-                reply_markup=generate_method_keyboard(user_id)
-            )
-            return
-        
-        # --- Method 2 Selected ---
-        elif data == "method_2":
-            USER_STATE.setdefault(user_id, {})["current_method"] = "method2"
-            USER_STATE[user_id]["status"] = "normal"
-        
-            user_data = USER_DATA.get(str(user_id), {})
-            channel = user_data.get("channel", "❌ Not Set")
-            caption = user_data.get("caption", "❌ Not Set")
-        
-            text = (
-                "<b>⚙️ 𝐌𝐄𝐓𝐇𝐎𝐃 𝟐 𝐒𝐄𝐋𝐄𝐂𝐓𝐄𝐃</b>\n"
-                "<blockquote>━━━━━━━━━━━━━━━━━━━━━━\n\n"
-                "<b>𝗬𝗼𝘂𝗿 𝗖𝗵𝗮𝗻𝗻𝗲𝗹 📡</b>\n"
-                f"{channel}\n\n"
-                "<b>𝗬𝗼𝘂𝗿 𝗖𝗮𝗽𝘁𝗶𝗼𝗻 📝</b>\n\n"
-                f"{caption}\n"
-                "━━━━━━━━━━━━━━━━━━━━━━</blockquote>\n"
-                "<b>🧠 Details:</b>\n"
-                "• Upload 2–3 APKs in batch\n"
-                "• Channel & Caption required"
-            )
-        
-            await query.edit_message_text(
-                text=text,
-                parse_mode="HTML",
-                reply_markup=generate_method_keyboard(user_id)
-            )
+
+        conversation = text_state(user_id)
+
+        button = TEXT_BUTTONS.get(update.message.text.strip().lower())
+        if conversation != "broadcast" and button and button_allowed(button[1], user_id):
+            await button[0](update, context, None)
             return
 
-        elif data == "reset_channel":
-            old_channel = USER_DATA.get(str(user_id), {}).get("channel", "N/A")
-            USER_DATA[str(user_id)]["channel"] = None
-            save_config()
-            await query.edit_message_text(
-                f"<b>𝗬𝗼𝘂𝗿 𝗖𝗵𝗮𝗻𝗻𝗲𝗹 𝗥𝗲𝘀𝗲𝘁 𝗗𝗼𝗻𝗲 ✅!</b>\n\n<blockquote>𝗬𝗼𝘂𝗿 𝗣𝗿𝗲𝘃𝗶𝗼𝘂𝘀 𝗖𝗵𝗮𝗻𝗻𝗲𝗹 𝗛𝗲𝗿𝗲 📈\n\n<code>{old_channel}</code></blockquote>",
-                parse_mode="HTML",
-                reply_markup=generate_method_keyboard(user_id)
-            )
-            return
-        
-        elif data == "reset_caption":
-            old_caption = USER_DATA.get(str(user_id), {}).get("caption", "N/A")
-            USER_DATA[str(user_id)]["caption"] = None
-            save_config()
-            await query.edit_message_text(
-                f"<b>𝗬𝗼𝘂𝗿 𝗖𝗮𝗽𝘁𝗶𝗼𝗻 𝗥𝗲𝘀𝗲𝘁 𝗗𝗼𝗻𝗲 👋🏼!</b>\n\n<blockquote>𝗬𝗼𝘂𝗿 𝗣𝗿𝗲𝘃𝗶𝗼𝘂𝘀 𝗖𝗮𝗽𝘁𝗶𝗼𝗻 𝗛𝗲𝗿𝗲 📈\n\n<code>{old_caption}</code></blockquote>",
-                parse_mode="HTML",
-                reply_markup=generate_method_keyboard(user_id)
-            )
-            return
+        action, arg = route_lookup(TEXT_STATES, conversation) if conversation else (None, None)
+        if action:
+            await TEXT_STATES[action](update, context, arg)
 
-        if data == "share_yes":
-            pending = USER_STATE.get(user_id, {}).pop("pending_apk", None)
-            if not pending:
-                await query.answer("❌ No APK to send.", show_alert=True)
-                return
-        
-            try:
-                result = await context.bot.send_document(
-                    chat_id=pending["channel"],
-                    document=pending["file_id"],
-                    caption=pending["caption"],
-                    parse_mode="HTML"
-                )
-        
-                # Update method1 stats
-                update_user_stats(user_id, method="method1", apks=1, keys=1)
-                save_state()
-        
-                # Save last post info for deletion
-                USER_STATE[user_id]["last_post"] = {
-                    "channel": pending["channel"],
-                    "msg_id": result.message_id
-                }
-        
-                # Build post link
-                channel_id_str = str(pending["channel"])
-                if channel_id_str.startswith("-100"):
-                    post_link = f"https://t.me/c/{channel_id_str[4:]}/{result.message_id}"
-                else:
-                    post_link = f"https://t.me/{channel_id_str.strip('@')}/{result.message_id}"
-        
-                # Confirmation UI
-                keyboard = [
-                    [InlineKeyboardButton("🔗 View Post", url=post_link)],
-                    [InlineKeyboardButton("🗑️ Delete Apk", callback_data="delete_last")]
-                ]
-                await query.edit_message_text(
-                    "<b>𝐏𝐨𝐬𝐭𝐞𝐝 𝐘𝐨𝐮𝐫 𝐂𝐡𝐚𝐧𝐧𝐞𝐥 🔖</b>",
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-        
-            except Exception as e:
-                await query.answer("❌ Failed to post APK!", show_alert=True)
-                await notify_owner_on_error(context.bot, e, source="share_yes_posting")
-        
-        elif data == "share_no":
-            USER_STATE.get(user_id, {}).pop("pending_apk", None)
-            await query.edit_message_text("❌ APK send cancelled.")
-            return
-        
-        elif data == "delete_last":
-            last = USER_STATE.get(user_id, {}).get("last_post")
-            if last:
-                try:
-                    await context.bot.delete_message(chat_id=last["channel"], message_id=last["msg_id"])
-                    await query.edit_message_text("🗑️ <b>Last post deleted!</b>", parse_mode="HTML")
-                except Exception as e:
-                    await query.answer("❌ Failed to delete post!", show_alert=True)
-                    await notify_owner_on_error(context.bot, e, source="delete_last")
-            else:
-                await query.answer("⚠️ No post to delete.", show_alert=True)
-        
-        if data == "method2_yes":
-            await method2_send_to_channel(user_id, context)
-            return
-    
-        if data == "method2_no":
-            USER_STATE[user_id]["session_files"] = []
-            USER_STATE[user_id]["session_filenames"] = []
-            await query.edit_message_text("❌ *Session canceled!*", parse_mode="Markdown")
-            return
-    
-        if data == "method2_quote":
-            USER_STATE[user_id]["key_mode"] = "quote"
-            await method2_convert_quote(user_id, context)
-            return
-        
-        if data == "method2_mono":
-            USER_STATE[user_id]["key_mode"] = "mono"
-            await method2_convert_mono(user_id, context)
-            return
-    
-        if data == "method2_edit":
-            USER_STATE[user_id]["status"] = "waiting_new_caption"
-            await query.edit_message_text(
-                "📝 *Send new Caption now!* (Must include `Key -`)",
-                parse_mode="Markdown"
-            )
-            return
-    
-        if data == "method2_preview":
-            await method2_show_preview(user_id, context)
-            return
-        
-        if data == "auto_recaption":
-            await auto_recaption(user_id, context)
-            return
-        
-        if data == "auto_last_caption":
-            await auto_last_caption(user_id, context)
-            return
-        
-        if data == "last_caption_key":
-            await last_caption_key(user_id, context)
-            return
+    except Exception as e:
+        await notify_owner_on_error(context.bot, e, source="handle_text")
 
-        if data == "key_after_apks":
-            await key_after_apks(user_id, context)
-            return
-        
-        if data == "caption_plus_key":
-            await caption_plus_key(user_id, context)
-            return
-        
-        if query.data == "fresh_session":
-            await erase_all_session(user_id, context)
-            await query.edit_message_text("✅ Session reset. Please send APKs again.")
-        
-        if data == "erase_all":
-            await erase_all_session(user_id, context)
-            await query.edit_message_text(
-                text="🧹 <b>Session Erased!</b>\nYou can now send new APKs.",
-                parse_mode="HTML"
-            )
-            return
-        
-        if data == "erase_all_session":
-            user_id = update.callback_query.from_user.id
-    
-            # Run full session cleanup
-            await erase_all_session(user_id, context)
-    
-            # Send confirmation
-            try:
-                await update.callback_query.edit_message_text(
-                    "🧹 <b>Your session has been erased!</b>",
-                    parse_mode="HTML"
-                )
-            except:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text="🧹 <b>Your session has been erased!</b>",
-                    parse_mode="HTML"
-                )
+# === UPLOAD & AUTO SETUP CALLBACKS ===
+def build_auto_keyboard(setup_num):
+    keyboard = [
+        [InlineKeyboardButton("📡 Set Source", callback_data=f"setsource{setup_num}"),
+         InlineKeyboardButton("🎯 Set Destination", callback_data=f"setdest{setup_num}")],
+        [InlineKeyboardButton("✍️ Set Caption", callback_data=f"setdestcaption{setup_num}")]
+    ]
 
-        if data == "back_to_manage_post":
-            buttons = [
-                [InlineKeyboardButton("📄 Open Last Uploaded Post", url=USER_STATE[user_id]["last_post_link"])],
-                [InlineKeyboardButton("🗑️ Remove Uploaded Files", callback_data="delete_apk_post")],
-                [InlineKeyboardButton("🧹 Clear This Session", callback_data="erase_all")],
-                [InlineKeyboardButton("🔙 Back to Upload Options", callback_data="back_to_methods")]
-            ]
-        
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=USER_STATE[user_id]["preview_message_id"],
-                text="<b>✅ 𝗠𝟮 - 𝗦𝗘𝗦𝗦𝗜𝗢𝗡 𝗠𝗘𝗡𝗨</b>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(buttons)
-            )
-            return
+    # Only show key mode buttons for Auto 1–3
+    if setup_num in ("1", "2", "3"):
+        keyboard.append([
+            InlineKeyboardButton("🤖 Automated", callback_data=f"automated{setup_num}"),
+            InlineKeyboardButton("🧠 Key Manual", callback_data=f"manual{setup_num}")
+        ])
 
-        if data == "back_to_manage_post":
-            buttons = [
-                [InlineKeyboardButton("📄 Open Last Uploaded Post", url=USER_STATE[user_id]["last_post_link"])],
-                [InlineKeyboardButton("🗑️ Remove Uploaded Files", callback_data="delete_apk_post")],
-                [InlineKeyboardButton("🧹 Clear This Session", callback_data="erase_all")],
-                [InlineKeyboardButton("🔙 Back to Upload Options", callback_data="back_to_methods")]
-            ]
-        
-            await context.bot.edit_message_text(
+    # Key style buttons (shown for all autos)
+    keyboard.append([
+        InlineKeyboardButton("📌 Quote Key", callback_data=f"quote{setup_num}"),
+        InlineKeyboardButton("🔤 Mono Key", callback_data=f"mono{setup_num}")
+    ])
+
+    # On/Off toggle
+    keyboard.append([
+        InlineKeyboardButton("✅ On", callback_data=f"on{setup_num}"),
+        InlineKeyboardButton("⛔ Off", callback_data=f"off{setup_num}")
+    ])
+
+    # View/Reset + back button
+    keyboard.append([
+        InlineKeyboardButton("👁️ View Setup", callback_data=f"viewsetup{setup_num}"),
+        InlineKeyboardButton("🧹 Reset Setup", callback_data=f"resetsetup{setup_num}")
+    ])
+
+    keyboard.append([
+        InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")
+    ])
+
+    return InlineKeyboardMarkup(keyboard)
+
+async def cb_confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    await send_broadcast(update, context)
+
+async def cb_cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    BROADCAST_SESSION.pop(user_id, None)
+    try:
+        await query.message.delete()
+    except:
+        await query.edit_message_text("❌ Broadcast Cancelled.", parse_mode="HTML")
+
+async def cb_method_3(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    keyboard = [
+        [InlineKeyboardButton("⚙️ Auto 1", callback_data="auto1_menu"),
+         InlineKeyboardButton("⚙️ Auto 2", callback_data="auto2_menu")],
+        [InlineKeyboardButton("⚙️ Auto 3", callback_data="auto3_menu"),
+         InlineKeyboardButton("⚙️ Auto 4", callback_data="auto4_menu")],
+        [InlineKeyboardButton("🔙 Back to Methods", callback_data="back_to_methods")]
+    ]
+    await query.edit_message_text(
+        "🛠 <b>Method 3 Activated!</b>\nChoose a setup to configure:",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def cb_back_to_methods(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user = query.from_user
+    user_id = user.id
+    user_key = str(user_id)  # Moved this up before using it
+
+    # Get or set first_seen timestamp
+    first_seen = USER_DATA.get(user_key, {}).get("first_seen")
+    if not first_seen:
+        first_seen = int(time.time())
+        USER_DATA[user_key] = USER_DATA.get(user_key, {})
+        USER_DATA[user_key]["first_seen"] = first_seen
+        save_config()
+
+    now = int(time.time())
+    days_count = (now - first_seen) // 86400
+
+    india_tz = ZoneInfo("Asia/Kolkata")
+
+    keyboard = [
+        [InlineKeyboardButton("⚡ Method 1", callback_data="method_1")],
+        [InlineKeyboardButton("🚀 Method 2", callback_data="method_2")]
+    ]
+    if user_id == OWNER_ID:
+        keyboard.append([InlineKeyboardButton("🛠 Method 3", callback_data="method_3")])
+
+    await query.edit_message_text(
+        text=(
+            "<b>𝗖𝗘𝗢 𝗣𝗔𝗡𝗘𝗟 🏆</b>\n"
+            "<blockquote>"
+            "<b>━━━━━━━━━━━━━━━━━━━━━━━━\n"
+            f"• 👤 Name     : {user.first_name or 'User'}\n"
+            f"• 🆔 User ID  : <a href=\"tg://user?id={user_id}\">{user_id}</a>\n"
+            f"• ⏱️ Days     : {days_count} Days\n"
+            "• ✅ Access   : Authorized ✓\n"
+            "• ⚙️ System   : Online ✓\n\n"
+            "      <b>𝗨𝗽𝗹𝗼𝗮𝗱 𝗠𝗲𝘁𝗵𝗼𝗱𝘀</b>\n"
+            "➡ Method 1 - 𝚄𝚙𝚕𝚘𝚊𝚍 𝟷/𝟷 𝙰𝚙𝚔\n"
+            "➡ Method 2 - 𝚄𝚙𝚕𝚘𝚊𝚍 𝟹/𝟹 𝚊𝚙𝚔𝚜\n"
+            "━━━━━━━━━━━━━━━━━━━━━━━━</b>"
+            "</blockquote>\n"
+            "<i>NOTE: You can switch methods anytime. Logs are monitored.</i>"
+        ),
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        disable_web_page_preview=True
+    )
+
+async def cb_auto_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    setup_num = arg
+    await query.edit_message_text(
+        text=f"⚙️ <b>Auto {setup_num} Config</b>\nSelect an option to configure:",
+        parse_mode="HTML",
+        reply_markup=build_auto_keyboard(setup_num)
+    )
+
+async def cb_set_source(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    setup_num = arg
+    USER_STATE[user_id]["status"] = f"waiting_source{setup_num}"
+    await query.edit_message_text(f"📡 Send Source Channel ID for Auto {setup_num}", parse_mode="HTML")
+
+async def cb_set_dest(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    setup_num = arg
+    USER_STATE[user_id]["status"] = f"waiting_dest{setup_num}"
+    await query.edit_message_text(f"🎯 Send Destination Channel ID for Auto {setup_num}", parse_mode="HTML")
+
+async def cb_set_dest_caption(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    setup_num = arg
+    USER_STATE[user_id]["status"] = f"waiting_caption{setup_num}"
+    await query.edit_message_text(f"✍️ Send Caption (must include 'Key -') for Auto {setup_num}", parse_mode="HTML")
+
+async def cb_key_mode_auto(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    setup_num = arg
+    AUTO_SETUP[f"setup{setup_num}"]["key_mode"] = "auto"
+    save_config()
+    await query.edit_message_text(
+        text=f"✅ Auto {setup_num} set to <b>Automated Key Mode</b>.\n\nChoose next action:",
+        parse_mode="HTML",
+        reply_markup=build_auto_keyboard(setup_num)
+    )
+
+async def cb_key_mode_manual(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    setup_num = arg
+    AUTO_SETUP[f"setup{setup_num}"]["key_mode"] = "manual"
+    save_config()
+    await query.edit_message_text(
+        text=f"✅ Auto {setup_num} set to <b>Manual Key Mode</b>.\n\nChoose next action:",
+        parse_mode="HTML",
+        reply_markup=build_auto_keyboard(setup_num)
+    )
+
+async def cb_style_quote(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    setup_num = arg
+    AUTO_SETUP[f"setup{setup_num}"]["style"] = "quote"
+    save_config()
+    await query.edit_message_text(
+        text=f"✅ Auto {setup_num} set to <b>Quote Key Style</b>.\n\nChoose next action:",
+        parse_mode="HTML",
+        reply_markup=build_auto_keyboard(setup_num)
+    )
+
+async def cb_style_mono(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    setup_num = arg
+    AUTO_SETUP[f"setup{setup_num}"]["style"] = "mono"
+    save_config()
+    await query.edit_message_text(
+        text=f"✅ Auto {setup_num} set to <b>Mono Key Style</b>.\n\nChoose next action:",
+        parse_mode="HTML",
+        reply_markup=build_auto_keyboard(setup_num)
+    )
+
+async def cb_setup_on(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    setup_num = arg
+    AUTO_SETUP[f"setup{setup_num}"]["enabled"] = True
+    save_config()
+    await query.edit_message_text(
+        text=f"✅ Auto {setup_num} has been <b>Turned ON</b>.\n\nChoose next action:",
+        parse_mode="HTML",
+        reply_markup=build_auto_keyboard(setup_num)
+    )
+
+async def cb_setup_off(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    setup_num = arg
+    AUTO_SETUP[f"setup{setup_num}"]["enabled"] = False
+    save_config()
+    await query.edit_message_text(
+        text=f"⛔ Auto {setup_num} has been <b>Turned OFF</b>.\n\nChoose next action:",
+        parse_mode="HTML",
+        reply_markup=build_auto_keyboard(setup_num)
+    )
+
+async def cb_reset_setup(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    setup_num = arg
+    AUTO_SETUP[f"setup{setup_num}"] = {
+        "source_channel": "",
+        "dest_channel": "",
+        "dest_caption": "",
+        "key_mode": "auto",
+        "style": "mono",
+        "enabled": False,
+        "completed_count": 0,
+        "processed_count": 0,
+        "last_key": ""
+    }
+    save_config()
+
+    msg = (
+        f"<pre>"
+        f"┌──── AUTO {setup_num} SYSTEM RESET ─────┐\n"
+        f"│ STATUS       >>  RESET COMPLETE        │\n"
+        f"│ ALL VALUES   >>  CLEARED               │\n"
+        f"│ MODE         >>  AUTO                  │\n"
+        f"│ STYLE        >>  MONO                  │\n"
+        f"└───────RESET DONE──────────┘"
+        f"</pre>"
+    )
+
+    await query.edit_message_text(
+        text=msg,
+        parse_mode="HTML",
+        reply_markup=build_auto_keyboard(setup_num)
+    )
+
+async def cb_set_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    USER_STATE[user_id]["status"] = "waiting_channel"
+
+    keyboard = []
+    if BOT_ADMIN_LINK:
+        keyboard.append([InlineKeyboardButton("👨‍💻 Bot Admin", url=BOT_ADMIN_LINK)])
+
+    await query.edit_message_text(
+        "📡 <b>Please send your Channel ID now!</b>\n"
+        "Example: <code>@yourchannel</code> or <code>-100xxxxxxxxxx</code>\n\n"
+        "⚠️ Make sure the bot is added as ADMIN in that channel!",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
+    )
+
+async def cb_set_caption(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    USER_STATE[user_id]["status"] = "waiting_caption"
+    await query.edit_message_text(
+        "📝 *Please send your Caption now!* Must contain: `Key -`",
+        parse_mode="Markdown"
+    )
+
+async def cb_method_1(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    USER_STATE.setdefault(user_id, {})["current_method"] = "method1"
+    USER_STATE[user_id]["status"] = "normal"
+
+    user_data = USER_DATA.get(str(user_id), {})
+    channel = user_data.get("channel", "❌ Not Set")
+    caption = user_data.get("caption", "❌ Not Set")
+
+    text = (
+        "<b>⚙️ 𝐌𝐄𝐓𝐇𝐎𝐃 𝟏 𝐒𝐄𝐋𝐄𝐂𝐓𝐄𝐃</b>\n"
+        "<blockquote>━━━━━━━━━━━━━━━━━━━━━━\n\n"
+        "<b>𝗬𝗼𝘂𝗿 𝗖𝗵𝗮𝗻𝗻𝗲𝗹 📡</b>\n"
+        f"{channel}\n\n"
+        "<b>𝗬𝗼𝘂𝗿 𝗖𝗮𝗽𝘁𝗶𝗼𝗻 📝</b>\n\n"
+        f"{caption}\n"
+        "━━━━━━━━━━━━━━━━━━━━━━</blockquote>\n"
+        "<b>🧠 Details:</b>\n"
+        "<i>• Auto-Key detection from your APK</i>\n"
+        "<i>• Channel & Caption required</i>"
+    )
+
+    await query.edit_message_text(
+        text=text,
+        parse_mode="HTML",
+        reply_markup=generate_method_keyboard(user_id)
+    )
+
+async def cb_method_2(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    USER_STATE.setdefault(user_id, {})["current_method"] = "method2"
+    USER_STATE[user_id]["status"] = "normal"
+
+    user_data = USER_DATA.get(str(user_id), {})
+    channel = user_data.get("channel", "❌ Not Set")
+    caption = user_data.get("caption", "❌ Not Set")
+
+    text = (
+        "<b>⚙️ 𝐌𝐄𝐓𝐇𝐎𝐃 𝟐 𝐒𝐄𝐋𝐄𝐂𝐓𝐄𝐃</b>\n"
+        "<blockquote>━━━━━━━━━━━━━━━━━━━━━━\n\n"
+        "<b>𝗬𝗼𝘂𝗿 𝗖𝗵𝗮𝗻𝗻𝗲𝗹 📡</b>\n"
+        f"{channel}\n\n"
+        "<b>𝗬𝗼𝘂𝗿 𝗖𝗮𝗽𝘁𝗶𝗼𝗻 📝</b>\n\n"
+        f"{caption}\n"
+        "━━━━━━━━━━━━━━━━━━━━━━</blockquote>\n"
+        "<b>🧠 Details:</b>\n"
+        "• Upload 2–3 APKs in batch\n"
+        "• Channel & Caption required"
+    )
+
+    await query.edit_message_text(
+        text=text,
+        parse_mode="HTML",
+        reply_markup=generate_method_keyboard(user_id)
+    )
+
+async def cb_reset_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    old_channel = USER_DATA.get(str(user_id), {}).get("channel", "N/A")
+    USER_DATA[str(user_id)]["channel"] = None
+    save_config()
+    await query.edit_message_text(
+        f"<b>𝗬𝗼𝘂𝗿 𝗖𝗵𝗮𝗻𝗻𝗲𝗹 𝗥𝗲𝘀𝗲𝘁 𝗗𝗼𝗻𝗲 ✅!</b>\n\n<blockquote>𝗬𝗼𝘂𝗿 𝗣𝗿𝗲𝘃𝗶𝗼𝘂𝘀 𝗖𝗵𝗮𝗻𝗻𝗲𝗹 𝗛𝗲𝗿𝗲 📈\n\n<code>{old_channel}</code></blockquote>",
+        parse_mode="HTML",
+        reply_markup=generate_method_keyboard(user_id)
+    )
+
+async def cb_reset_caption(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    old_caption = USER_DATA.get(str(user_id), {}).get("caption", "N/A")
+    USER_DATA[str(user_id)]["caption"] = None
+    save_config()
+    await query.edit_message_text(
+        f"<b>𝗬𝗼𝘂𝗿 𝗖𝗮𝗽𝘁𝗶𝗼𝗻 𝗥𝗲𝘀𝗲𝘁 𝗗𝗼𝗻𝗲 👋🏼!</b>\n\n<blockquote>𝗬𝗼𝘂𝗿 𝗣𝗿𝗲𝘃𝗶𝗼𝘂𝘀 𝗖𝗮𝗽𝘁𝗶𝗼𝗻 𝗛𝗲𝗿𝗲 📈\n\n<code>{old_caption}</code></blockquote>",
+        parse_mode="HTML",
+        reply_markup=generate_method_keyboard(user_id)
+    )
+
+async def cb_share_yes(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    pending = USER_STATE.get(user_id, {}).pop("pending_apk", None)
+    if not pending:
+        await query.answer("❌ No APK to send.", show_alert=True)
+        return
+
+    # Skip APKs already posted to this channel with the same key
+    if dedup_is_duplicate(pending.get("file_unique_id"), pending["channel"], pending.get("key")):
+        await query.edit_message_text(
+            "♻️ <b>Duplicate APK skipped.</b>\nThis APK was already posted to your channel with the same key.",
+            parse_mode="HTML"
+        )
+        return
+
+    try:
+        result = await context.bot.send_document(
+            chat_id=pending["channel"],
+            document=pending["file_id"],
+            caption=pending["caption"],
+            parse_mode="HTML"
+        )
+
+        # Update method1 stats
+        update_user_stats(user_id, method="method1", apks=1, keys=1)
+        dedup_key = dedup_remember(pending.get("file_unique_id"), pending["channel"], pending.get("key"))
+        save_state()
+
+        # Save last post info for deletion
+        USER_STATE[user_id]["last_post"] = {
+            "channel": pending["channel"],
+            "msg_id": result.message_id,
+            "dedup_key": dedup_key
+        }
+
+        # Build post link
+        post_link = build_post_link(pending["channel"], result.message_id)
+
+        # Confirmation UI
+        keyboard = [
+            [InlineKeyboardButton("🔗 View Post", url=post_link)],
+            [InlineKeyboardButton("🗑️ Delete Apk", callback_data="delete_last")]
+        ]
+        await query.edit_message_text(
+            "<b>𝐏𝐨𝐬𝐭𝐞𝐝 𝐘𝐨𝐮𝐫 𝐂𝐡𝐚𝐧𝐧𝐞𝐥 🔖</b>",
+            parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+    except Exception as e:
+        await query.answer("❌ Failed to post APK!", show_alert=True)
+        await notify_owner_on_error(context.bot, e, source="share_yes_posting")
+
+async def cb_share_no(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    USER_STATE.get(user_id, {}).pop("pending_apk", None)
+    await query.edit_message_text("❌ APK send cancelled.")
+
+async def cb_delete_last(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    last = USER_STATE.get(user_id, {}).get("last_post")
+    if last:
+        try:
+            await context.bot.delete_message(chat_id=last["channel"], message_id=last["msg_id"])
+            dedup_forget(last.get("dedup_key"))
+            await query.edit_message_text("🗑️ <b>Last post deleted!</b>", parse_mode="HTML")
+        except Exception as e:
+            await query.answer("❌ Failed to delete post!", show_alert=True)
+            await notify_owner_on_error(context.bot, e, source="delete_last")
+    else:
+        await query.answer("⚠️ No post to delete.", show_alert=True)
+
+async def cb_method2_yes(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await method2_send_to_channel(user_id, context)
+
+async def cb_method2_no(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    USER_STATE[user_id]["session_files"] = []
+    USER_STATE[user_id]["session_filenames"] = []
+    await query.edit_message_text("❌ *Session canceled!*", parse_mode="Markdown")
+
+async def cb_method2_quote(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    USER_STATE[user_id]["key_mode"] = "quote"
+    await method2_convert_quote(user_id, context)
+
+async def cb_method2_mono(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    USER_STATE[user_id]["key_mode"] = "mono"
+    await method2_convert_mono(user_id, context)
+
+async def cb_method2_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    USER_STATE[user_id]["status"] = "waiting_new_caption"
+    await query.edit_message_text(
+        "📝 *Send new Caption now!* (Must include `Key -`)",
+        parse_mode="Markdown"
+    )
+
+async def cb_method2_preview(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await method2_show_preview(user_id, context)
+
+async def cb_fresh_session(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await erase_all_session(user_id, context)
+    await query.edit_message_text("✅ Session reset. Please send APKs again.")
+
+async def cb_erase_all(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await erase_all_session(user_id, context)
+    await query.edit_message_text(
+        text="🧹 <b>Session Erased!</b>\nYou can now send new APKs.",
+        parse_mode="HTML"
+    )
+
+async def cb_erase_all_session(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+
+    # Run full session cleanup
+    await erase_all_session(user_id, context)
+
+    # Send confirmation
+    try:
+        await query.edit_message_text(
+            "🧹 <b>Your session has been erased!</b>",
+            parse_mode="HTML"
+        )
+    except:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text="🧹 <b>Your session has been erased!</b>",
+            parse_mode="HTML"
+        )
+
+async def cb_back_to_manage_post(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    buttons = [
+        [InlineKeyboardButton("📄 Open Last Uploaded Post", url=USER_STATE[user_id]["last_post_link"])],
+        [InlineKeyboardButton("🗑️ Remove Uploaded Files", callback_data="delete_apk_post")],
+        [InlineKeyboardButton("🧹 Clear This Session", callback_data="erase_all")],
+        [InlineKeyboardButton("🔙 Back to Upload Options", callback_data="back_to_methods")]
+    ]
+
+    await context.bot.edit_message_text(
+        chat_id=user_id,
+        message_id=USER_STATE[user_id]["preview_message_id"],
+        text="<b>✅ 𝗠𝟮 - 𝗦𝗘𝗦𝗦𝗜𝗢𝗡 𝗠𝗘𝗡𝗨</b>",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+async def cb_delete_apk_post(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    apk_posts = USER_STATE.get(user_id, {}).get("apk_posts", [])
+    filenames = USER_STATE.get(user_id, {}).get("last_post_session", {}).get("filenames", [])
+    preview_id = USER_STATE.get(user_id, {}).get("preview_message_id")
+
+    if not preview_id:
+        await context.bot.send_message(chat_id=user_id, text="⚠️ Preview message not found.")
+        return
+
+    if not apk_posts or not filenames:
+        await context.bot.send_message(chat_id=user_id, text="⚠️ No uploaded APKs to delete.")
+        return
+
+    from html import escape
+    keyboard = []
+    for idx, name in enumerate(filenames):
+        short_name = name if len(name) <= 20 else f"{name[:17]}..."
+        short_name = escape(short_name)
+        keyboard.append([InlineKeyboardButton(f"🗑️ Delete {short_name}", callback_data=f"delete_apk_{idx+1}")])
+
+    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_manage_post")])
+
+    try:
+        await context.bot.edit_message_text(
+            chat_id=user_id,
+            message_id=preview_id,
+            text="🗂 <b>Select the APK to delete by name:</b>",
+            parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    except BadRequest as e:
+        if "message to edit not found" in str(e).lower():
+            USER_STATE[user_id]["preview_message_id"] = None  # clean state
+            await context.bot.send_message(
                 chat_id=user_id,
-                message_id=USER_STATE[user_id]["preview_message_id"],
-                text="<b>✅ 𝗠𝟮 - 𝗦𝗘𝗦𝗦𝗜𝗢𝗡 𝗠𝗘𝗡𝗨</b>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(buttons)
+                text="⚠️ The previous preview message could not be edited (it may have been deleted).\nStarting fresh..."
             )
+        else:
+            raise
+
+async def cb_delete_apk(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    apk_number = int(arg)
+    state = USER_STATE.setdefault(user_id, {})
+    session = state.setdefault("last_post_session", {})
+    apk_posts = state.get("apk_posts", [])
+    filenames = session.get("filenames", [])
+    channel_id = USER_DATA.get(str(user_id), {}).get("channel")
+
+    if not apk_posts or not filenames or apk_number > len(apk_posts):
+        await query.edit_message_text("⚠️ No uploaded APKs to delete.")
+        return
+
+    msg_id = apk_posts[apk_number - 1]
+    filename = filenames[apk_number - 1]
+
+    try:
+        await context.bot.delete_message(chat_id=channel_id, message_id=msg_id)
+    except Exception as e:
+        log_event("posts", "warning", "Delete failed", chat_id=channel_id, message_id=msg_id, error=str(e))
+
+    # Remove specific item (and let it be posted again later)
+    dedup_keys = session.get("dedup_keys", [])
+    if apk_number <= len(dedup_keys):
+        dedup_forget(dedup_keys.pop(apk_number - 1))
+    apk_posts[apk_number - 1] = None
+    filenames[apk_number - 1] = None
+
+    apk_posts = [m for m in apk_posts if m]
+    filenames = [f for f in filenames if f]
+
+    state["apk_posts"] = apk_posts
+    session["filenames"] = filenames
+
+    if not apk_posts:
+        # Collect deleted names before clearing
+        deleted_names = [name for name in session.get("filenames", []) if name]
+
+        # Reset session
+        state.update({
+            "session_files": [],
+            "session_filenames": [],
+            "saved_key": None,
+            "apk_posts": [],
+            "last_apk_time": None,
+            "waiting_key": False,
+            "preview_message_id": None
+        })
+        session.clear()
+
+        # Build formatted deleted file list
+        name_list = "\n".join([f"• 🗑️ <code>{name}</code>" for name in deleted_names]) or "—"
+
+        await query.edit_message_text(
+            text=(
+                "<b>✅ ALL APKs DELETED SUCCESSFULLY!</b>\n"
+                "<blockquote>\n"
+                "🧾 <b>Files Removed:</b>\n"
+                f"{name_list}\n"
+                "━━━━━━━━━━━━━━━━━━━\n"
+                "🧹 Session has been reset.\n"
+                "You can now upload new APKs freely.\n"
+                "</blockquote>"
+            ),
+            parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("Clear Cache 🔖", callback_data="erase_all_session")]
+            ])
+        )
+        return
+
+    # Updated delete menu
+    from html import escape
+    keyboard = []
+    for idx, name in enumerate(filenames):
+        if not name:
+            continue
+        short = name if len(name) <= 20 else f"{name[:17]}..."
+        short = escape(short)
+        keyboard.append([InlineKeyboardButton(f"🗑️ Delete {short}", callback_data=f"delete_apk_{idx+1}")])
+    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_manage_post")])
+
+    await query.edit_message_text(
+        text=(
+            "✅ <b>APK Deleted:</b> <code>{filename}</code>\n"
+            "<blockquote>"
+            "🗂 <b>Select another APK below to delete:</b>\n"
+            "Tap the filename button to remove it from the channel.\n"
+            "</blockquote>"
+        ).format(filename=filename),
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def cb_method2_back_fullmenu(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    preview_message_id = USER_STATE.get(user_id, {}).get("preview_message_id")
+    key = USER_STATE.get(user_id, {}).get("saved_key", "")
+    session_files = USER_STATE.get(user_id, {}).get("session_files", [])
+
+    if not preview_message_id or not key or not session_files:
+        await query.edit_message_text(
+            text="⚠️ *Session expired or not found!*",
+            parse_mode="Markdown"
+        )
+        return
+
+    try:
+        text = (
+            "<pre>=== METHOD 2 MENU ===</pre>\n\n"
+            "Choose what you want to do next:"
+        )
+
+        await context.bot.edit_message_text(
+            chat_id=user_id,
+            message_id=preview_message_id,
+            text=text,
+            parse_mode="HTML",
+            reply_markup=build_method2_buttons(user_id)
+        )
+
+    except Exception as e:
+        log_event("preview", "warning", "Error going back to Full Menu", error=str(e))
+
+async def cb_method2_confirm_apks(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    state = USER_STATE[user_id]
+
+    task = state.get("countdown_task")
+    if task and not task.done():
+        task.cancel()
+
+    if state.get("countdown_msg_id"):
+        try:
+            await context.bot.delete_message(chat_id=user_id, message_id=state["countdown_msg_id"])
+        except:
+            pass
+        state["countdown_msg_id"] = None
+
+    state["waiting_key"] = True
+    state["countdown_task"] = None
+
+    await context.bot.send_message(
+        chat_id=user_id,
+        text=(
+            "<pre>"
+            "▌ 𝐌𝐄𝐓𝐇𝐎𝐃 𝟐 𝐒𝐘𝐒𝐓𝐄𝐌 ▌\n"
+            "▶ Send your Key Now\n"
+            "▶ Used for all Mods , Loaders\n"
+            "────────────────────"
+            "</pre>"
+        ),
+        parse_mode="HTML"
+    )
+
+async def cb_method2_cancel_session(update: Update, context: ContextTypes.DEFAULT_TYPE, arg=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    state = USER_STATE[user_id]
+
+    task = state.get("countdown_task")
+    if task and not task.done():
+        task.cancel()
+
+    if state.get("countdown_msg_id"):
+        try:
+            await context.bot.delete_message(chat_id=user_id, message_id=state["countdown_msg_id"])
+        except:
+            pass
+        state["countdown_msg_id"] = None
+
+    state.update({
+        "session_files": [],
+        "session_filenames": [],
+        "saved_key": None,
+        "waiting_key": False,
+        "key_prompt_sent": False,
+        "countdown_task": None,
+        "progress_message_id": None,
+        "last_apk_time": None,
+        "quote_applied": False,
+        "mono_applied": False,
+        "key_mode": "normal",
+        "preview_message_id": None,
+        "apk_posts": [],
+        "last_post_link": None,
+        "last_post_session": {}
+    })
+
+    await context.bot.send_message(
+        chat_id=user_id,
+        text="❌ <b>Session cancelled. All APKs cleared.</b>",
+        parse_mode="HTML"
+    )
+
+# === CALLBACK ROUTER ===
+# Exact callback_data first; otherwise the first run of digits is replaced
+# by "#" ("setsource2" -> "setsource#", "auto3_menu" -> "auto#_menu") and
+# the digits are passed to the handler as arg.
+CALLBACK_ROUTES = {
+    # Settings panel
+    "view_users": (cb_view_users, ROUTE_SETTINGS),
+    "view_autosetup": (cb_view_autosetup, ROUTE_SETTINGS),
+    "view_metrics": (cb_view_metrics, ROUTE_OWNER),
+    "viewsetup#": (cb_settings_viewsetup, ROUTE_SETTINGS),
+    "backup_config": (cb_backup_config, ROUTE_SETTINGS),
+    "force_reset": (cb_force_reset, ROUTE_SETTINGS),
+    "confirm_reset": (cb_confirm_reset, ROUTE_SETTINGS),
+    "settings_back": (cb_settings_back, ROUTE_SETTINGS),
+    "cancel_restore": (cb_settings_back, ROUTE_SETTINGS),
+    "bot_admin_link": (cb_bot_admin_link, ROUTE_SETTINGS),
+    "backup_restore": (cb_backup_restore, ROUTE_SETTINGS),
+    "confirm_restore": (cb_confirm_restore, ROUTE_SETTINGS),
+    "reset_settings_panel": (cb_reset_settings_panel, ROUTE_SETTINGS),
+    "add_user": (cb_add_user, ROUTE_SETTINGS),
+    "remove_user": (cb_remove_user, ROUTE_SETTINGS),
+
+    # Broadcast
+    "confirm_broadcast": (cb_confirm_broadcast, ROUTE_OWNER),
+    "cancel_broadcast": (cb_cancel_broadcast, ROUTE_OWNER),
+
+    # Menus and auto setups (Method 3 is only shown to the owner)
+    "method_3": (cb_method_3, ROUTE_OWNER),
+    "back_to_methods": (cb_back_to_methods, ROUTE_OPEN),
+    "auto#_menu": (cb_auto_menu, ROUTE_OWNER),
+    "setsource#": (cb_set_source, ROUTE_OWNER),
+    "setdest#": (cb_set_dest, ROUTE_OWNER),
+    "setdestcaption#": (cb_set_dest_caption, ROUTE_OWNER),
+    "automated#": (cb_key_mode_auto, ROUTE_OWNER),
+    "manual#": (cb_key_mode_manual, ROUTE_OWNER),
+    "quote#": (cb_style_quote, ROUTE_OWNER),
+    "mono#": (cb_style_mono, ROUTE_OWNER),
+    "on#": (cb_setup_on, ROUTE_OWNER),
+    "off#": (cb_setup_off, ROUTE_OWNER),
+    "resetsetup#": (cb_reset_setup, ROUTE_OWNER),
+
+    # Method 1 / Method 2
+    "set_channel": (cb_set_channel, ROUTE_SESSION),
+    "set_caption": (cb_set_caption, ROUTE_SESSION),
+    "method_1": (cb_method_1, ROUTE_SESSION),
+    "method_2": (cb_method_2, ROUTE_SESSION),
+    "reset_channel": (cb_reset_channel, ROUTE_SESSION),
+    "reset_caption": (cb_reset_caption, ROUTE_SESSION),
+    "share_yes": (cb_share_yes, ROUTE_SESSION),
+    "share_no": (cb_share_no, ROUTE_SESSION),
+    "delete_last": (cb_delete_last, ROUTE_SESSION),
+    "method2_yes": (cb_method2_yes, ROUTE_SESSION),
+    "method2_no": (cb_method2_no, ROUTE_SESSION),
+    "method2_quote": (cb_method2_quote, ROUTE_SESSION),
+    "method2_mono": (cb_method2_mono, ROUTE_SESSION),
+    "method2_edit": (cb_method2_edit, ROUTE_SESSION),
+    "method2_preview": (cb_method2_preview, ROUTE_SESSION),
+    "method2_back_fullmenu": (cb_method2_back_fullmenu, ROUTE_SESSION),
+    "method2_confirm_apks": (cb_method2_confirm_apks, ROUTE_SESSION),
+    "method2_cancel_session": (cb_method2_cancel_session, ROUTE_SESSION),
+    "auto_recaption": (lambda update, context, arg: auto_recaption(update.effective_user.id, context), ROUTE_SESSION),
+    "auto_last_caption": (lambda update, context, arg: auto_last_caption(update.effective_user.id, context), ROUTE_SESSION),
+    "last_caption_key": (lambda update, context, arg: last_caption_key(update.effective_user.id, context), ROUTE_SESSION),
+    "key_after_apks": (lambda update, context, arg: key_after_apks(update.effective_user.id, context), ROUTE_SESSION),
+    "caption_plus_key": (lambda update, context, arg: caption_plus_key(update.effective_user.id, context), ROUTE_SESSION),
+    "fresh_session": (cb_fresh_session, ROUTE_SESSION),
+    "erase_all": (cb_erase_all, ROUTE_SESSION),
+    "erase_all_session": (cb_erase_all_session, ROUTE_SESSION),
+    "back_to_manage_post": (cb_back_to_manage_post, ROUTE_SESSION),
+    "delete_apk_post": (cb_delete_apk_post, ROUTE_SESSION),
+    "delete_apk_#": (cb_delete_apk, ROUTE_SESSION)
+}
+
+CALLBACK_METRICS = {}
+
+def parse_callback_data(data: str) -> tuple:
+    return route_lookup(CALLBACK_ROUTES, data)
+
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    action, arg = parse_callback_data(query.data or "")
+    started = time.perf_counter()
+    failed = False
+
+    try:
+        if action is None:
+            log_event("callbacks", "warning", "Unknown action", data=query.data, user_id=user_id)
+            await query.answer("⚠️ Unknown action.", show_alert=True)
             return
 
-        if data == "delete_apk_post":
-            apk_posts = USER_STATE.get(user_id, {}).get("apk_posts", [])
-            filenames = USER_STATE.get(user_id, {}).get("last_post_session", {}).get("filenames", [])
-            preview_id = USER_STATE.get(user_id, {}).get("preview_message_id")
-        
-            if not preview_id:
-                await context.bot.send_message(chat_id=user_id, text="⚠️ Preview message not found.")
-                return
-        
-            if not apk_posts or not filenames:
-                await context.bot.send_message(chat_id=user_id, text="⚠️ No uploaded APKs to delete.")
-                return
-        
-            from html import escape
-            keyboard = []
-            for idx, name in enumerate(filenames):
-                short_name = name if len(name) <= 20 else f"{name[:17]}..."
-                short_name = escape(short_name)
-                keyboard.append([InlineKeyboardButton(f"🗑️ Delete {short_name}", callback_data=f"delete_apk_{idx+1}")])
-        
-            keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_manage_post")])
-        
-            try:
-                await context.bot.edit_message_text(
-                    chat_id=user_id,
-                    message_id=preview_id,
-                    text="🗂 <b>Select the APK to delete by name:</b>",
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-            except BadRequest as e:
-                if "message to edit not found" in str(e).lower():
-                    USER_STATE[user_id]["preview_message_id"] = None  # clean state
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text="⚠️ The previous preview message could not be edited (it may have been deleted).\nStarting fresh..."
-                    )
-                else:
-                    raise
-        
-        
-        elif data.startswith("delete_apk_"):
-            apk_number = int(data.split("_")[-1])
-            state = USER_STATE.setdefault(user_id, {})
-            session = state.setdefault("last_post_session", {})
-            apk_posts = state.get("apk_posts", [])
-            filenames = session.get("filenames", [])
-            channel_id = USER_DATA.get(str(user_id), {}).get("channel")
-        
-            if not apk_posts or not filenames or apk_number > len(apk_posts):
-                await query.edit_message_text("⚠️ No uploaded APKs to delete.")
-                return
-        
-            msg_id = apk_posts[apk_number - 1]
-            filename = filenames[apk_number - 1]
-        
-            try:
-                await context.bot.delete_message(chat_id=channel_id, message_id=msg_id)
-            except Exception as e:
-                print(f"[Delete Failed] {e}")
-        
-            # Remove specific item
-            apk_posts[apk_number - 1] = None
-            filenames[apk_number - 1] = None
-        
-            apk_posts = [m for m in apk_posts if m]
-            filenames = [f for f in filenames if f]
-        
-            state["apk_posts"] = apk_posts
-            session["filenames"] = filenames
-        
-            if not apk_posts:
-                # Collect deleted names before clearing
-                deleted_names = [name for name in session.get("filenames", []) if name]
-            
-                # Reset session
-                state.update({
-                    "session_files": [],
-                    "session_filenames": [],
-                    "saved_key": None,
-                    "apk_posts": [],
-                    "last_apk_time": None,
-                    "waiting_key": False,
-                    "preview_message_id": None
-                })
-                session.clear()
-            
-                # Build formatted deleted file list
-                name_list = "\n".join([f"• 🗑️ <code>{name}</code>" for name in deleted_names]) or "—"
-            
-                await query.edit_message_text(
-                    text=(
-                        "<b>✅ ALL APKs DELETED SUCCESSFULLY!</b>\n"
-                        "<blockquote>\n"
-                        "🧾 <b>Files Removed:</b>\n"
-                        f"{name_list}\n"
-                        "━━━━━━━━━━━━━━━━━━━\n"
-                        "🧹 Session has been reset.\n"
-                        "You can now upload new APKs freely.\n"
-                        "</blockquote>"
-                    ),
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("Clear Cache 🔖", callback_data="erase_all_session")]
-                    ])
-                )
-                return
-        
-            # Updated delete menu
-            from html import escape
-            keyboard = []
-            for idx, name in enumerate(filenames):
-                if not name:
-                    continue
-                short = name if len(name) <= 20 else f"{name[:17]}..."
-                short = escape(short)
-                keyboard.append([InlineKeyboardButton(f"🗑️ Delete {short}", callback_data=f"delete_apk_{idx+1}")])
-            keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back_to_manage_post")])
-        
-            await query.edit_message_text(
-                text=(
-                    "✅ <b>APK Deleted:</b> <code>{filename}</code>\n"
-                    "<blockquote>"
-                    "🗂 <b>Select another APK below to delete:</b>\n"
-                    "Tap the filename button to remove it from the channel.\n"
-                    "</blockquote>"
-                ).format(filename=filename),
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+        handler, access = CALLBACK_ROUTES[action]
+
+        if access == ROUTE_SETTINGS and not is_authorized(user_id):
+            await query.answer("🚫 Unauthorized", show_alert=True)
             return
-        
-        if data == "method2_back_fullmenu":
-            preview_message_id = USER_STATE.get(user_id, {}).get("preview_message_id")
-            key = USER_STATE.get(user_id, {}).get("saved_key", "")
-            session_files = USER_STATE.get(user_id, {}).get("session_files", [])
-        
-            if not preview_message_id or not key or not session_files:
-                await query.edit_message_text(
-                    text="⚠️ *Session expired or not found!*",
-                    parse_mode="Markdown"
-                )
-                return
-        
-            try:
-                text = (
-                    "<pre>=== METHOD 2 MENU ===</pre>\n\n"
-                    "Choose what you want to do next:"
-                )
-            
-                await context.bot.edit_message_text(
-                    chat_id=user_id,
-                    message_id=preview_message_id,
-                    text=text,
-                    parse_mode="HTML",
-                    reply_markup=build_method2_buttons(user_id)
-                )
-            
-            except Exception as e:
-                print(f"Error going back to Full Menu: {e}")
-    
-        if data.startswith("auto") and data.endswith("_menu"):
-            setup_num = data[4]  # auto1 → "1", auto2 → "2", auto3 → "3"
-        
-            keyboard = [
-                [
-                    InlineKeyboardButton("📡 Set Source", callback_data=f"setsource{setup_num}"),
-                    InlineKeyboardButton("🎯 Set Destination", callback_data=f"setdest{setup_num}")
-                ],
-                [
-                    InlineKeyboardButton("✍️ Set Caption", callback_data=f"setdestcaption{setup_num}")
-                ],
-                [
-                    InlineKeyboardButton("🤖 Automated", callback_data=f"automated{setup_num}"),
-                    InlineKeyboardButton("🧠 Key Manual", callback_data=f"manual{setup_num}")
-                ],
-                [
-                    InlineKeyboardButton("📌 Quote Key", callback_data=f"quote{setup_num}"),
-                    InlineKeyboardButton("🔤 Mono Key", callback_data=f"mono{setup_num}")
-                ],
-                [
-                    InlineKeyboardButton("✅ On", callback_data=f"on{setup_num}"),
-                    InlineKeyboardButton("⛔ Off", callback_data=f"off{setup_num}")
-                ],
-                [
-                    InlineKeyboardButton("👁️ View Setup", callback_data=f"viewsetup{setup_num}"),
-                    InlineKeyboardButton("🧹 Reset Setup", callback_data=f"resetsetup{setup_num}")
-                ],
-                [
-                    InlineKeyboardButton("🔙 Back to Auto Menu", callback_data="method_3")
-                ]
-            ]
-        
+        if access == ROUTE_OWNER and user_id != OWNER_ID:
+            await query.answer("🚫 Unauthorized", show_alert=True)
+            return
+
+        # Immediately answer callback to avoid Telegram timeout
+        try:
+            await query.answer()
+        except:
+            await query.message.reply_text("⏳ Session expired or invalid. ❌")
+            return
+
+        # Owner routes also write to the owner's USER_STATE entry
+        if access in (ROUTE_SESSION, ROUTE_OWNER) and user_id not in USER_STATE:
             await query.edit_message_text(
-                text=f"⚙️ <b>Auto {setup_num} Config</b>\nSelect an option to configure:",
-                parse_mode="HTML",  
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                "⏳ *Session expired or invalid!* ❌\nPlease restart using /start.",
+                parse_mode="Markdown"
             )
             return
-        
-        if query.data == "method2_confirm_apks":
-            task = state.get("countdown_task")
-            if task and not task.done():
-                task.cancel()
-        
-            if state.get("countdown_msg_id"):
-                try:
-                    await context.bot.delete_message(chat_id=user_id, message_id=state["countdown_msg_id"])
-                except:
-                    pass
-                state["countdown_msg_id"] = None
-        
-            state["waiting_key"] = True
-            state["countdown_task"] = None
-        
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=(
-                    "<pre>"
-                    "▌ 𝐌𝐄𝐓𝐇𝐎𝐃 𝟐 𝐒𝐘𝐒𝐓𝐄𝐌 ▌\n"
-                    "▶ Send your Key Now\n"
-                    "▶ Used for all Mods , Loaders\n"
-                    "────────────────────"
-                    "</pre>"
-                ),
-                parse_mode="HTML"
-            )
-        
-        elif query.data == "method2_cancel_session":
-            task = state.get("countdown_task")
-            if task and not task.done():
-                task.cancel()
-    
-            if state.get("countdown_msg_id"):
-                try:
-                    await context.bot.delete_message(chat_id=user_id, message_id=state["countdown_msg_id"])
-                except:
-                    pass
-                state["countdown_msg_id"] = None
-    
-            state.update({
-                "session_files": [],
-                "session_filenames": [],
-                "saved_key": None,
-                "waiting_key": False,
-                "key_prompt_sent": False,
-                "countdown_task": None,
-                "progress_message_id": None,
-                "last_apk_time": None,
-                "quote_applied": False,
-                "mono_applied": False,
-                "key_mode": "normal",
-                "preview_message_id": None,
-                "apk_posts": [],
-                "last_post_link": None,
-                "last_post_session": {}
-            })
-    
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="❌ <b>Session cancelled. All APKs cleared.</b>",
-                parse_mode="HTML"
-            )
+
+        await handler(update, context, arg)
+
+    except Exception as e:
+        failed = True
+        await notify_owner_on_error(context.bot, e, source=f"callback:{action or 'unknown'}")
+
+    finally:
+        record_latency(CALLBACK_METRICS, action or "unknown", (time.perf_counter() - started) * 1000, failed)
+
+# === BROADCAST DELIVERY ===
+# A confirmed broadcast becomes a job holding the users still to reach. The job
+# is persisted, so a restart carries on with the remaining users instead of
+# dropping the broadcast or sending it twice.
+BROADCAST_JOB = {}
+BROADCAST_SAVE_EVERY = 10
+BROADCAST_STATUS_LABELS = {"sent": "✅ Active", "blocked": "❌ Blocked", "error": "⚠️ Error", "unconfirmed": "❔ Unconfirmed"}
+
+def broadcast_job_from(msg, buttons_raw) -> dict:
+    if msg.text:
+        kind, file_id = "text", None
+    elif msg.photo:
+        kind, file_id = "photo", msg.photo[-1].file_id
+    elif msg.document:
+        kind, file_id = "document", msg.document.file_id
+    elif msg.video:
+        kind, file_id = "video", msg.video.file_id
+    else:
+        return None
+
+    return {
+        "kind": kind,
+        "text": msg.text,
+        "file_id": file_id,
+        "caption": msg.caption,
+        "buttons_raw": buttons_raw,
+        "pending": [int(uid) for uid in USER_DATA.keys() if int(uid) != OWNER_ID],
+        "sent": [],
+        "failed": []
+    }
+
+async def _broadcast_one(bot, job: dict, uid: int, keyboard):
+    kind = job["kind"]
+    if kind == "text":
+        await bot.send_message(chat_id=uid, text=job["text"], parse_mode="HTML", reply_markup=keyboard)
+    elif kind == "photo":
+        await bot.send_photo(chat_id=uid, photo=job["file_id"], caption=job["caption"], parse_mode="HTML", reply_markup=keyboard)
+    elif kind == "document":
+        await bot.send_document(chat_id=uid, document=job["file_id"], caption=job["caption"], parse_mode="HTML", reply_markup=keyboard)
+    elif kind == "video":
+        await bot.send_video(chat_id=uid, video=job["file_id"], caption=job["caption"], parse_mode="HTML", reply_markup=keyboard)
+
+def _broadcast_user_line(uid, status: str) -> str:
+    uname = USER_DATA.get(str(uid), {}).get("username", "—")
+    return (
+        f"👤 User: {uid}\n"
+        f"├─ 🧬 Username: @{uname if uname and uname != '—' else 'N/A'}\n"
+        f"└─ 🩺 Status: {BROADCAST_STATUS_LABELS[status]}"
+    )
+
+async def run_broadcast(bot):
+    job = BROADCAST_JOB
+    if not job:
+        return
+
+    keyboard = parse_buttons_grid_2x2(job["buttons_raw"]) if job.get("buttons_raw") else None
+    finished = True
+    try:
+        while job["pending"]:
+            # Leaves pending before the send, so a resumed job never sends it twice
+            uid = job["pending"].pop(0)
+            try:
+                await _broadcast_one(bot, job, uid, keyboard)
+                job["sent"].append(uid)
+                BROADCAST_STATS["sent"] += 1
+            except asyncio.CancelledError:
+                # It may already have been delivered
+                job["failed"].append([uid, "unconfirmed"])
+                raise
+            except Forbidden:
+                job["failed"].append([uid, "blocked"])
+                BROADCAST_STATS["failed"] += 1
+            except Exception:
+                job["failed"].append([uid, "error"])
+                BROADCAST_STATS["failed"] += 1
+
+            # Checkpoint progress so a hard kill resends to at most this many users
+            if (len(job["sent"]) + len(job["failed"])) % BROADCAST_SAVE_EVERY == 0:
+                save_state()
+
+            await asyncio.sleep(0.05)  # Throttle delay to prevent Timeouts
+
+        save_state()
+
+        sent_users = [_broadcast_user_line(uid, "sent") for uid in job["sent"]]
+        failed_users = [_broadcast_user_line(uid, status) for uid, status in job["failed"]]
+
+        # Summary report
+        now = datetime.now(ZoneInfo("Asia/Kolkata"))
+        date_str = now.strftime("%d-%m-%Y")
+        time_str = now.strftime("%I:%M %p")
+
+        summary = (
+            "<pre>█ SYSTEM STATUS █\n"
+            f"✔ SENT    : {len(job['sent'])}\n"
+            f"✖ FAILED  : {len(job['failed'])}\n"
+            f"☰ TOTAL   : {len(job['sent']) + len(job['failed'])}\n"
+            f"⏱ TIME    : {time_str}\n"
+            f"📅 DATE    : {date_str}\n"
+            "</pre>"
+            "<code>✔ SYNC COMPLETE — NO ERRORS</code>\n\n"
+        )
+
+        if sent_users:
+            summary += "━━━━━━━━━━━━━━━━━━━━━━━━\n✅ DELIVERED USERS\n"
+            for user in sent_users[:5]:
+                summary += f"<blockquote>{user}</blockquote>\n"
+            if len(sent_users) > 5:
+                summary += f"<i>...and {len(sent_users) - 5} more.</i>\n"
+
+        if failed_users:
+            summary += "━━━━━━━━━━━━━━━━━━━━━━━━\n❌ FAILED USERS\n"
+            for user in failed_users[:5]:
+                summary += f"<blockquote>{user}</blockquote>\n"
+            if len(failed_users) > 5:
+                summary += f"<i>...and {len(failed_users) - 5} more.</i>\n"
+
+        summary += "━━━━━━━━━━━━━━━━━━━━━━━━"
+
+        await bot.send_message(
+            chat_id=OWNER_ID,
+            text=summary,
+            parse_mode="HTML",
+            disable_web_page_preview=True
+        )
+
+    except asyncio.CancelledError:
+        # Restart or shutdown: the remaining users stay queued in state.json
+        finished = False
+        raise
 
     except Exception as e:
-        await notify_owner_on_error(context.bot, e, source="handle_callback")
+        await notify_owner_on_error(bot, e, source="run_broadcast")
+
+    finally:
+        if finished:
+            BROADCAST_JOB.clear()
+            save_state()
+
+def resume_broadcast(application: Application):
+    if BROADCAST_JOB:
+        log_event("broadcast", "info", "Resuming broadcast", pending=len(BROADCAST_JOB["pending"]))
+        spawn_task("broadcast", run_broadcast(application.bot))
 
 async def send_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
         session = BROADCAST_SESSION.get(user_id)
+        job = broadcast_job_from(session["message"], session.get("buttons_raw")) if session and session.get("message") else None
 
-        if not session or "message" not in session:
+        if not job:
             await update.callback_query.edit_message_text(
                 "⚠️ No message found to broadcast.",
                 parse_mode="Markdown"
             )
             return
 
-        msg = session["message"]
-        buttons_raw = session.get("buttons_raw")
-        keyboard = parse_buttons_grid_2x2(buttons_raw) if buttons_raw else None
-
-        user_ids = [int(uid) for uid in USER_DATA.keys() if int(uid) != OWNER_ID]
-        total = len(user_ids)
-        sent = 0
-        failed = 0
-        sent_users = []
-        failed_users = []
+        if BROADCAST_JOB:
+            await update.callback_query.answer("⏳ Another broadcast is still running.", show_alert=True)
+            return
 
         # Delete the preview message before starting broadcast
         try:
@@ -4682,102 +5880,423 @@ async def send_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             pass
 
-        # Loop through users and send
-        for uid in user_ids:
-            user_info = USER_DATA.get(str(uid), {})
-            uname = user_info.get("username", "—")
+        BROADCAST_SESSION.pop(user_id, None)
+        BROADCAST_JOB.update(job)
+        save_state()
+        # Runs outside the owner's actor lock so their other updates keep flowing
+        spawn_task("broadcast", run_broadcast(context.bot))
+
+    except Exception as e:
+        await notify_owner_on_error(context.bot, e, source="send_broadcast")
 
-            try:
-                if msg.text:
-                    await context.bot.send_message(
-                        chat_id=uid, text=msg.text, parse_mode="HTML", reply_markup=keyboard
-                    )
-                elif msg.photo:
-                    await context.bot.send_photo(
-                        chat_id=uid, photo=msg.photo[-1].file_id,
-                        caption=msg.caption, parse_mode="HTML", reply_markup=keyboard
-                    )
-                elif msg.document:
-                    await context.bot.send_document(
-                        chat_id=uid, document=msg.document.file_id,
-                        caption=msg.caption, parse_mode="HTML", reply_markup=keyboard
-                    )
-                elif msg.video:
-                    await context.bot.send_video(
-                        chat_id=uid, video=msg.video.file_id,
-                        caption=msg.caption, parse_mode="HTML", reply_markup=keyboard
-                    )
-                else:
-                    continue
-
-                sent += 1
-                sent_users.append(
-                    f"👤 User: {uid}\n"
-                    f"├─ 🧬 Username: @{uname if uname != '—' else 'N/A'}\n"
-                    f"└─ 🩺 Status: ✅ Active"
-                )
+# === AUTO 1-3 PIPELINE ===
+AUTO_SIZE_LIMITS_MB = {1: (1, 50), 2: (80, 2048)}
+
+def auto_size_ok(setup_number, file_size) -> bool:
+    limits = AUTO_SIZE_LIMITS_MB.get(setup_number)
+    if not limits:
+        return True
+    size_mb = (file_size or 0) / (1024 * 1024)
+    return limits[0] <= size_mb <= limits[1]
+
+async def auto_publish(bot, setup, doc, caption, entities) -> tuple:
+    # Shared by live channel posts and /backfill: key -> dedup -> caption -> publish
+    key = extract_key(caption, entities, key_rules_for(setup))
+    record_key_sample(caption, entities, key)
+    if not key:
+        return "no_key", None, None
+
+    dest_channel = setup.get("dest_channel", "")
+    if dedup_is_duplicate(doc.file_unique_id, dest_channel, key):
+        return "duplicate", key, None
+
+    dest_caption = setup.get("dest_caption", "")
+    if "Key -" not in dest_caption:
+        dest_caption += "\nKey -"
+    final_caption = render_caption(dest_caption, key, "quote" if setup.get("style") == "quote" else "mono")
+
+    sent_msg = (await publish_documents(
+        bot,
+        dest_channel,
+        [(doc.file_id, final_caption)],
+        disable_notification=True
+    ))[0]
+
+    setup["completed_count"] = setup.get("completed_count", 0) + 1
+    dedup_remember(doc.file_unique_id, dest_channel, key)
+    save_config()
+    # Persist the dedup entry now; a resumed hold must see this post as done
+    save_state()
+    return "posted", key, sent_msg
+
+# === BACKFILL ===
+# Jobs live in state.json keyed by setup number; "next" is the first id that
+# has not been fully handled yet, so a restart resumes from there. Only ids
+# Telegram reports as missing are skipped. Any other error stops the window at
+# that id, which is retried; after BACKFILL_RETRIES failures in a row the job
+# stops and tells the owner where.
+BACKFILL_CONCURRENCY = 4
+BACKFILL_RETRIES = 3
+BACKFILL_RETRY_DELAY = 5
+BACKFILL_JOBS = {}
+BACKFILL_TASKS = {}
+
+async def _backfill_fetch(bot, source, message_id):
+    # Bots cannot read history, so copy the post into the scratch chat to see it
+    try:
+        copy = await bot.forward_message(
+            chat_id=SCRATCH_CHAT_ID,
+            from_chat_id=source,
+            message_id=message_id,
+            disable_notification=True
+        )
+    except BadRequest as e:
+        if is_message_missing(e):
+            return None
+        raise
+    await _delete_probe_copies(bot, [copy.message_id])
+    return copy
+
+async def _backfill_one(bot, setup_number, setup, job, message):
+    doc = message.document if message else None
+    if not doc or not (doc.file_name or "").lower().endswith(".apk"):
+        job["ignored"] += 1
+        return
+    if not auto_size_ok(setup_number, doc.file_size):
+        job["ignored"] += 1
+        return
 
-            except Forbidden:
-                failed += 1
-                failed_users.append(
-                    f"👤 User: {uid}\n"
-                    f"├─ 🧬 Username: @{uname if uname != '—' else 'N/A'}\n"
-                    f"└─ 🩺 Status: ❌ Blocked"
+    outcome, _, _ = await auto_publish(bot, setup, doc, message.caption or "", message.caption_entities)
+    job["posted" if outcome == "posted" else "skipped"] += 1
+
+def _backfill_progress(setup_number, job, done=False, error=None) -> str:
+    total = job["to"] - job["from"] + 1
+    handled = min(job["next"], job["to"] + 1) - job["from"]
+    title = "✅ Backfill Completed" if done else "📥 Backfill Running..."
+    if error is not None:
+        title = f"⚠️ Backfill Stopped at {job['next']}"
+    return (
+        f"<b>{title}</b>\n"
+        f"├─ ⚙️ Setup : <code>Auto {setup_number}</code>\n"
+        f"├─ 🔢 Range : <code>{job['from']}–{job['to']}</code> ({handled}/{total})\n"
+        f"├─ ✅ Posted : <code>{job['posted']}</code>\n"
+        f"├─ ♻️ Skipped : <code>{job['skipped']}</code>\n"
+        f"├─ 🚫 Ignored : <code>{job['ignored']}</code>\n"
+        f"└─ ❌ Failed attempts : <code>{job['failed']}</code>"
+        + (f"\n\n<code>{escape(str(error))}</code>\nResume with <code>/backfill {setup_number} {job['next']} {job['to']}</code>" if error is not None else "")
+    )
+
+async def run_backfill(bot, setup_number: int):
+    job = BACKFILL_JOBS.get(str(setup_number))
+    if not job:
+        return
+    setup = AUTO_SETUP[f"setup{setup_number}"]
+    finished = True
+
+    try:
+        if not job.get("status_msg_id"):
+            status_msg = await bot.send_message(OWNER_ID, _backfill_progress(setup_number, job), parse_mode="HTML")
+            job["status_msg_id"] = status_msg.message_id
+
+        retries = 0
+
+        while job["next"] <= job["to"]:
+            window = list(range(job["next"], min(job["next"] + BACKFILL_CONCURRENCY, job["to"] + 1)))
+
+            # Fetch concurrently, publish in id order so the destination keeps the source order
+            messages = await asyncio.gather(*(
+                _backfill_fetch(bot, job["source"], mid) for mid in window
+            ), return_exceptions=True)
+            error = None
+            for mid, message in zip(window, messages):
+                if isinstance(message, Exception):
+                    error = message
+                    break
+                try:
+                    await _backfill_one(bot, setup_number, setup, job, message)
+                except Exception as e:
+                    error = e
+                    break
+                job["next"] = mid + 1
+
+            if error is None:
+                retries = 0
+            else:
+                # The checkpoint stays on the failed id
+                job["failed"] += 1
+                retries += 1
+                log_event("backfill", "warning", "Backfill id failed", setup=setup_number, message_id=job["next"], attempt=retries, error=str(error))
+            save_state()
+
+            if retries > BACKFILL_RETRIES:
+                await bot.send_message(OWNER_ID, _backfill_progress(setup_number, job, error=error), parse_mode="HTML")
+                return
+            if error is not None:
+                await asyncio.sleep(error.retry_after if isinstance(error, RetryAfter) else BACKFILL_RETRY_DELAY * retries)
+
+            try:
+                await bot.edit_message_text(
+                    chat_id=OWNER_ID,
+                    message_id=job["status_msg_id"],
+                    text=_backfill_progress(setup_number, job),
+                    parse_mode="HTML"
                 )
             except Exception:
-                failed += 1
-                failed_users.append(
-                    f"👤 User: {uid}\n"
-                    f"├─ 🧬 Username: @{uname if uname != '—' else 'N/A'}\n"
-                    f"└─ 🩺 Status: ⚠️ Error"
+                pass
+
+        await bot.edit_message_text(
+            chat_id=OWNER_ID,
+            message_id=job["status_msg_id"],
+            text=_backfill_progress(setup_number, job, done=True),
+            parse_mode="HTML"
+        )
+
+    except asyncio.CancelledError:
+        # Shutdown or /backfill stop: the checkpoint stays in state.json
+        finished = False
+        raise
+
+    except Exception as e:
+        await notify_owner_on_error(bot, e, source="run_backfill")
+
+    finally:
+        BACKFILL_TASKS.pop(str(setup_number), None)
+        if finished:
+            BACKFILL_JOBS.pop(str(setup_number), None)
+            save_state()
+
+def start_backfill_task(bot, setup_number):
+    task = asyncio.create_task(run_backfill(bot, setup_number))
+    BACKFILL_TASKS[str(setup_number)] = task
+    return task
+
+def resume_backfills(application: Application):
+    for setup_number in list(BACKFILL_JOBS):
+        if setup_number not in BACKFILL_TASKS:
+            log_event("backfill", "info", "Resuming backfill", setup=setup_number, next=BACKFILL_JOBS[setup_number]["next"])
+            start_backfill_task(application.bot, int(setup_number))
+
+async def backfill_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if update.effective_user.id != OWNER_ID:
+            return
+
+        args = context.args or []
+
+        if len(args) == 2 and args[0].lower() == "stop":
+            task = BACKFILL_TASKS.get(args[1])
+            if task:
+                task.cancel()
+            BACKFILL_JOBS.pop(args[1], None)
+            save_state()
+            await update.message.reply_text(f"🛑 Backfill for Auto {escape(args[1])} stopped.")
+            return
+
+        if len(args) != 3 or args[0] not in ("1", "2", "3") or not args[1].isdigit() or not args[2].isdigit():
+            running = "\n".join(
+                f"• Auto {n}: <code>{job['next']}/{job['to']}</code>" for n, job in BACKFILL_JOBS.items()
+            ) or "• None"
+            await update.message.reply_text(
+                "📥 <b>Backfill</b>\n"
+                f"{running}\n\n"
+                "<b>Usage:</b> <code>/backfill &lt;1-3&gt; &lt;from_id&gt; &lt;to_id&gt;</code>\n"
+                "<code>/backfill stop &lt;1-3&gt;</code>",
+                parse_mode="HTML"
+            )
+            return
+
+        setup_number = args[0]
+        first, last = sorted((int(args[1]), int(args[2])))
+        setup = AUTO_SETUP[f"setup{setup_number}"]
+
+        if not setup.get("source_channel") or not setup.get("dest_channel"):
+            await update.message.reply_text(f"❌ Auto {setup_number} needs a source and destination channel first.")
+            return
+        if not SCRATCH_CHAT_ID:
+            # Every id in the range is forwarded there to be read, APK or not
+            await update.message.reply_text(
+                "❌ Set a scratch chat first: <code>/setscratch &lt;chat_id&gt;</code> with a private group or channel only the bot uses.",
+                parse_mode="HTML"
+            )
+            return
+        if setup_number in BACKFILL_TASKS:
+            await update.message.reply_text(f"⚠️ A backfill for Auto {setup_number} is already running.")
+            return
+
+        BACKFILL_JOBS[setup_number] = {
+            "source": setup["source_channel"],
+            "from": first,
+            "to": last,
+            "next": first,
+            "posted": 0,
+            "skipped": 0,
+            "ignored": 0,
+            "failed": 0,
+            "status_msg_id": None
+        }
+        save_state()
+        start_backfill_task(context.bot, int(setup_number))
+
+    except Exception as e:
+        await notify_owner_on_error(context.bot, e, source="backfill_command")
+
+# === AUTO 1-3 HOLDS ===
+# A matched post waits AUTO_HOLD_SECONDS before it is mirrored so a post the
+# source deletes quickly is never published. Holds are persisted and resumed
+# after a restart from where their countdown was.
+AUTO_HOLD_SECONDS = 20
+AUTO_HOLDS = {}
+
+def open_auto_hold(setup_number, message, source_name) -> str:
+    hold_id = f"{message.chat_id}:{message.message_id}"
+    AUTO_HOLDS[hold_id] = {
+        "setup": setup_number,
+        "source_chat_id": message.chat_id,
+        "message_id": message.message_id,
+        "source_name": str(source_name),
+        "document": message.document.to_dict(),
+        "caption": message.caption or "",
+        "entities": [entity.to_dict() for entity in message.caption_entities],
+        "opened_at": time.time(),
+        "status_msg_id": None
+    }
+    save_state()
+    return hold_id
+
+def _hold_bar(elapsed: int) -> str:
+    return "▰" * elapsed + "▱" * (AUTO_HOLD_SECONDS - elapsed)
+
+async def run_auto_hold(bot, hold_id: str):
+    hold = AUTO_HOLDS.get(hold_id)
+    if not hold:
+        return
+
+    setup_number = hold["setup"]
+    finished = True
+    try:
+        elapsed = min(int(time.time() - hold["opened_at"]), AUTO_HOLD_SECONDS)
+
+        if hold["status_msg_id"] is None:
+            countdown_msg = await bot.send_message(
+                chat_id=OWNER_ID,
+                text=f"⏳ *Auto {setup_number} - Waiting...*\n`[{_hold_bar(elapsed)}] ({elapsed}/{AUTO_HOLD_SECONDS})`",
+                parse_mode="Markdown"
+            )
+            hold["status_msg_id"] = countdown_msg.message_id
+        status_msg_id = hold["status_msg_id"]
+
+        # Countdown loop with progress bar
+        for elapsed in range(elapsed + 1, AUTO_HOLD_SECONDS + 1):
+            await asyncio.sleep(1)
+            try:
+                await bot.edit_message_text(
+                    chat_id=OWNER_ID,
+                    message_id=status_msg_id,
+                    text=f"⏳ *Auto {setup_number} - Waiting...*\n`[{_hold_bar(elapsed)}] ({elapsed}/{AUTO_HOLD_SECONDS})`",
+                    parse_mode="Markdown"
                 )
+            except:
+                pass
 
-            await asyncio.sleep(0.05)  # Throttle delay to prevent Timeouts
+        # Check if source message still exists
+        message_id = hold["message_id"]
+        status = await verify_messages_exist(bot, hold["source_chat_id"], [message_id])
+        if status.get(message_id):
+            log_event("auto", "debug", "Source message still exists after hold", setup=setup_number, hold=hold_id)
+        else:
+            await bot.edit_message_text(
+                chat_id=OWNER_ID,
+                message_id=status_msg_id,
+                text=f"❌ *Auto {setup_number} Declined*\n➔ *Message Deleted during {AUTO_HOLD_SECONDS}s wait.*",
+                parse_mode="Markdown"
+            )
+            log_event("auto", "info", "Source message deleted during hold; skipped", setup=setup_number, hold=hold_id)
+            return
 
-        # Summary report
-        now = datetime.now(ZoneInfo("Asia/Kolkata"))
-        date_str = now.strftime("%d-%m-%Y")
-        time_str = now.strftime("%I:%M %p")
+        matched_setup = AUTO_SETUP.get(f"setup{setup_number}", {})
+        dest_channel = matched_setup.get("dest_channel", "")
+        doc = Document.de_json(hold["document"], bot)
 
-        summary = (
-            "<pre>█ SYSTEM STATUS █\n"
-            f"✔ SENT    : {sent}\n"
-            f"✖ FAILED  : {failed}\n"
-            f"☰ TOTAL   : {sent + failed}\n"
-            f"⏱ TIME    : {time_str}\n"
-            f"📅 DATE    : {date_str}\n"
-            "</pre>"
-            "<code>✔ SYNC COMPLETE — NO ERRORS</code>\n\n"
-        )
+        # Extract key, dedup, caption and publish
+        try:
+            outcome, key, sent_msg = await auto_publish(
+                bot, matched_setup, doc, hold["caption"], hold["entities"]
+            )
+        except Exception as e:
+            error_message = traceback.format_exc()
+            await bot.edit_message_text(
+                chat_id=OWNER_ID,
+                message_id=status_msg_id,
+                text=f"❌ *Error Sending APK!*\n\n`{error_message}`",
+                parse_mode="MarkdownV2"
+            )
+            log_event("auto", "error", "Error while sending document", setup=setup_number, error=str(e), traceback=error_message)
+            return
+
+        if outcome == "no_key":
+            await bot.edit_message_text(
+                chat_id=OWNER_ID,
+                message_id=status_msg_id,
+                text=f"❌ *Auto {setup_number} Declined*\n➔ *Key not extracted.*",
+                parse_mode="Markdown"
+            )
+            log_event("auto", "info", "Key missing; skipped", setup=setup_number, hold=hold_id)
+            return
+
+        if outcome == "duplicate":
+            await bot.edit_message_text(
+                chat_id=OWNER_ID,
+                message_id=status_msg_id,
+                text=f"♻️ *Auto {setup_number} Skipped*\n➔ *Duplicate APK already posted.*",
+                parse_mode="Markdown"
+            )
+            log_event("auto", "info", "Duplicate APK; skipped", setup=setup_number, hold=hold_id)
+            return
 
-        if sent_users:
-            summary += "━━━━━━━━━━━━━━━━━━━━━━━━\n✅ DELIVERED USERS\n"
-            for user in sent_users[:5]:
-                summary += f"<blockquote>{user}</blockquote>\n"
-            if len(sent_users) > 5:
-                summary += f"<i>...and {len(sent_users) - 5} more.</i>\n"
+        post_link = build_post_link(dest_channel, sent_msg.message_id)
 
-        if failed_users:
-            summary += "━━━━━━━━━━━━━━━━━━━━━━━━\n❌ FAILED USERS\n"
-            for user in failed_users[:5]:
-                summary += f"<blockquote>{user}</blockquote>\n"
-            if len(failed_users) > 5:
-                summary += f"<i>...and {len(failed_users) - 5} more.</i>\n"
+        def escape(text):
+            return re.sub(r'([_\*~`>\#+\-=|{}.!])', r'\\\1', str(text))
 
-        summary += "━━━━━━━━━━━━━━━━━━━━━━━━"
+        source = escape(hold["source_name"])
+        dest = escape(dest_channel)
+        key_escape = escape(key)
+        post_link_escape = escape(post_link)
 
-        await context.bot.send_message(
+        # Final success message
+        await bot.edit_message_text(
             chat_id=OWNER_ID,
-            text=summary,
-            parse_mode="HTML",
+            message_id=status_msg_id,
+            text=(
+                f"✅ *Auto {setup_number} Completed*\n"
+                f"├─ 👤 Source : {source}\n"
+                f"├─ 🎯 Destination : {dest}\n"
+                f"├─ 📡 Key : `{key_escape}`\n"
+                f"└─ 🔗 Post Link : [Click Here]({post_link_escape})"
+            ),
+            parse_mode="MarkdownV2",
             disable_web_page_preview=True
         )
 
-        # Cleanup session
-        BROADCAST_SESSION.pop(user_id, None)
+        log_event("auto", "info", "Published and notified owner", setup=setup_number, hold=hold_id, message_id=sent_msg.message_id)
+
+    except asyncio.CancelledError:
+        # Shutdown or restart: the hold stays in state.json and resumes
+        finished = False
+        raise
 
     except Exception as e:
-        await notify_owner_on_error(context.bot, e, source="send_broadcast")
+        await notify_owner_on_error(bot, e, source="run_auto_hold")
+
+    finally:
+        if finished:
+            AUTO_HOLDS.pop(hold_id, None)
+            save_state()
+
+def resume_auto_holds(application: Application):
+    for hold_id in list(AUTO_HOLDS):
+        log_event("auto", "info", "Resuming hold", hold=hold_id)
+        spawn_task(f"hold:{hold_id}", run_auto_hold(application.bot, hold_id))
 
 async def auto_handle_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -4790,19 +6309,16 @@ async def auto_handle_channel_post(update: Update, context: ContextTypes.DEFAULT
         doc = message.document
         caption = message.caption or ""
     
-        print(f"✅ Received channel post from {source_username or chat_id}")
+        log_event("auto", "debug", "Received channel post", source=source_username or chat_id)
     
         if not doc:
-            print("❌ No document attached.")
+            log_event("auto", "debug", "No document attached")
             return
     
         if not doc.file_name.endswith(".apk"):
-            print("❌ Not an APK file. Ignoring.")
+            log_event("auto", "debug", "Not an APK file; ignoring")
             return
     
-        file_size = doc.file_size
-        file_size_mb = file_size / (1024 * 1024)
-    
         matched_setup = None
         setup_number = None
     
@@ -4829,7 +6345,7 @@ async def auto_handle_channel_post(update: Update, context: ContextTypes.DEFAULT
                 text="⚠️ *Alert!*\n➔ *No matching Auto Setup found for this APK!*\n⛔ *Processing Declined.*",
                 parse_mode="Markdown"
             )
-            print("❌ No matching setup found. Message sent to owner.")
+            log_event("auto", "info", "No matching setup; owner notified", source=chat_id)
             return
     
         if not matched_setup.get("enabled", False):
@@ -4838,177 +6354,25 @@ async def auto_handle_channel_post(update: Update, context: ContextTypes.DEFAULT
                 text=f"⚠️ *Alert!*\n➔ *Auto {setup_number} is currently OFF!*\n⛔ *Processing Declined.*",
                 parse_mode="Markdown"
             )
-            print(f"❌ Auto {setup_number} is OFF. Message sent to owner.")
+            log_event("auto", "info", "Setup is off; owner notified", setup=setup_number)
             return
     
-        print(f"✅ Matched to Setup {setup_number}")
+        log_event("auto", "debug", "Matched to setup", setup=setup_number)
     
         # Size filter
-        if setup_number == 1 and not (1 <= file_size_mb <= 50):
-            await context.bot.send_message(
-                chat_id=OWNER_ID,
-                text=f"⚠️ *Alert!*\n➔ *APK Size not matched for Auto {setup_number}*\n⛔ *Processing Declined.*",
-                parse_mode="Markdown"
-            )
-            print("❌ Size not matched. Message sent to owner.")
-            return
-    
-        if setup_number == 2 and not (80 <= file_size_mb <= 2048):
+        if not auto_size_ok(setup_number, doc.file_size):
             await context.bot.send_message(
                 chat_id=OWNER_ID,
                 text=f"⚠️ *Alert!*\n➔ *APK Size not matched for Auto {setup_number}*\n⛔ *Processing Declined.*",
                 parse_mode="Markdown"
             )
-            print("❌ Size not matched. Message sent to owner.")
-            return
-    
-        # Save for later deletion check
-        source_chat_id = message.chat_id
-        message_id = message.message_id
-    
-        # Initial waiting message with full bar
-        countdown_msg = await context.bot.send_message(
-            chat_id=OWNER_ID,
-            text=f"⏳ *Auto {setup_number} - Waiting...*\n`[▰▰▰▰▰▰▰▰▰▰▱▱▱▱▱▱▱▱▱▱] (0/20)`",
-            parse_mode="Markdown"
-        )
-    
-        # Countdown loop with progress bar
-        for elapsed in range(1, 21):
-            await asyncio.sleep(1)
-    
-            # Visual bar
-            filled = "▰" * elapsed
-            empty = "▱" * (20 - elapsed)
-            bar = filled + empty
-    
-            try:
-                await context.bot.edit_message_text(
-                    chat_id=OWNER_ID,
-                    message_id=countdown_msg.message_id,
-                    text=f"⏳ *Auto {setup_number} - Waiting...*\n`[{bar}] ({elapsed}/20)`",
-                    parse_mode="Markdown"
-                )
-            except:
-                pass
-    
-        # Check if source message still exists
-        try:
-            await context.bot.forward_message(chat_id=OWNER_ID, from_chat_id=source_chat_id, message_id=message_id)
-            print("✅ Message exists after 20s.")
-        except Exception as e:
-            await context.bot.edit_message_text(
-                chat_id=OWNER_ID,
-                message_id=countdown_msg.message_id,
-                text=f"❌ *Auto {setup_number} Declined*\n➔ *Message Deleted during 20s wait.*",
-                parse_mode="Markdown"
-            )
-            print("❌ Message deleted during delay. Skipped.")
-            return
-    
-        # Now Extract Key
-        key_mode = matched_setup.get("key_mode", "auto")
-        style = matched_setup.get("style", "mono")
-        dest_caption = matched_setup.get("dest_caption", "")
-        dest_channel = matched_setup.get("dest_channel", "")
-    
-        key = None
-    
-        if key_mode == "auto":
-            # Step 1: Try "Key -" pattern in caption text
-            match = re.search(r'Key\s*-\s*(\S+)', caption)
-            if match:
-                key = match.group(1)
-        
-            # Step 2: If not found, check for 'code' style entity (One Tap Copy)
-            if not key and message.caption_entities:
-                for entity in message.caption_entities:
-                    if entity.type == "code":
-                        offset = entity.offset
-                        length = entity.length
-                        key = caption[offset:offset + length]
-                        break  # Stop after first match
-        
-        elif key_mode == "manual":
-            match = re.search(r'Key\s*-\s*(\S+)', caption)
-            if match:
-                key = match.group(1)
-    
-        if not key:
-            await context.bot.edit_message_text(
-                chat_id=OWNER_ID,
-                message_id=countdown_msg.message_id,
-                text=f"❌ *Auto {setup_number} Declined*\n➔ *Key not extracted.*",
-                parse_mode="Markdown"
-            )
-            print("❌ Key missing. Skipped.")
+            log_event("auto", "info", "Size not matched; owner notified", setup=setup_number)
             return
     
-        # Prepare Destination Caption
-        if "Key -" not in dest_caption:
-            dest_caption += "\nKey -"
-    
-        if style == "quote":
-            final_caption = dest_caption.replace("Key -", f"<blockquote>Key - <code>{key}</code></blockquote>")
-        else:  # mono
-            final_caption = dest_caption.replace("Key -", f"Key - <code>{key}</code>")
-    
-        # Send document
-        try:
-            sent_msg = await context.bot.send_document(
-                chat_id=dest_channel,
-                document=doc.file_id,
-                caption=final_caption,
-                parse_mode="HTML",
-                disable_notification=True
-            )
-    
-            matched_setup["completed_count"] += 1
-            save_config()
-    
-            # Post link generator
-            if str(dest_channel).startswith("@"):
-                post_link = f"https://t.me/{dest_channel.strip('@')}/{sent_msg.message_id}"
-            elif str(dest_channel).startswith("-100"):
-                post_link = f"https://t.me/c/{str(dest_channel)[4:]}/{sent_msg.message_id}"
-            else:
-                post_link = "Unknown"
-    
-            def escape(text):
-                return re.sub(r'([_\*~`>\#+\-=|{}.!])', r'\\\1', str(text))
-    
-            source_name = source_username if source_username else chat_id
-            source = escape(source_name)
-            dest = escape(dest_channel)
-            key_escape = escape(key)
-            post_link_escape = escape(post_link)
-    
-            # Final success message
-            await context.bot.edit_message_text(
-                chat_id=OWNER_ID,
-                message_id=countdown_msg.message_id,
-                text=(
-                    f"✅ *Auto {setup_number} Completed*\n"
-                    f"├─ 👤 Source : {source}\n"
-                    f"├─ 🎯 Destination : {dest}\n"
-                    f"├─ 📡 Key : `{key_escape}`\n"
-                    f"└─ 🔗 Post Link : [Click Here]({post_link_escape})"
-                ),
-                parse_mode="MarkdownV2",
-                disable_web_page_preview=True
-            )
-    
-            print("✅ Successfully forwarded and notified owner.")
-    
-        except Exception as e:
-            error_message = traceback.format_exc()
-            await context.bot.edit_message_text(
-                chat_id=OWNER_ID,
-                message_id=countdown_msg.message_id,
-                text=f"❌ *Error Sending APK!*\n\n`{error_message}`",
-                parse_mode="MarkdownV2"
-            )
-            print("❌ Error while sending document:\n", error_message)
+        # Held in state.json so a restart mid-countdown picks it back up
+        hold_id = open_auto_hold(setup_number, message, source_username or chat_id)
+        # The hold runs for AUTO_HOLD_SECONDS; keep it off the channel's actor lock
+        spawn_task(f"hold:{hold_id}", run_auto_hold(context.bot, hold_id))
 
     except Exception as e:
         await notify_owner_on_error(context.bot, e, source="auto_handle_channel_post")
@@ -5029,72 +6393,117 @@ async def auto4_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
     
         caption = message.caption or ""
     
-        AUTO4_STATE["pending_apks"].append({
+        batch = auto4_open_batch(context)
+        batch["apks"].append({
             "file_id": doc.file_id,
+            "file_unique_id": doc.file_unique_id,
             "caption": caption,
             "message_id": message.message_id,
             "chat_id": chat_id,
             "timestamp": time.time(),
             "caption_entities": message.caption_entities and [e.to_dict() for e in message.caption_entities]
         })
-    
-        if not AUTO4_STATE["timer"]:
-            AUTO4_STATE["waiting_since"] = time.time()
-            AUTO4_STATE["timer"] = asyncio.create_task(process_auto4_delayed(context))
+        save_state()
 
     except Exception as e:
         await notify_owner_on_error(context.bot, e, source="auto4_message_handler")
 
-async def process_auto4_delayed(context: ContextTypes.DEFAULT_TYPE):
+def auto4_open_batch(context: ContextTypes.DEFAULT_TYPE) -> dict:
+    batch = AUTO4_STATE["batches"].get(AUTO4_STATE.get("open_batch"))
+    if batch and not batch.get("sealed"):
+        return batch
+
+    # Previous window is sealed (or none yet): open a new independent batch
+    batch_id = str(AUTO4_STATE["next_batch_id"])
+    AUTO4_STATE["next_batch_id"] += 1
+    batch = {
+        "id": batch_id,
+        "apks": [],
+        "opened_at": time.time(),
+        "sealed": False
+    }
+    AUTO4_STATE["batches"][batch_id] = batch
+    AUTO4_STATE["open_batch"] = batch_id
+    AUTO4_TASKS[batch_id] = asyncio.create_task(process_auto4_delayed(context, batch_id))
+    return batch
+
+def auto4_seal_batch(batch_id: str):
+    batch = AUTO4_STATE["batches"].get(batch_id)
+    if batch:
+        batch["sealed"] = True
+    if AUTO4_STATE.get("open_batch") == batch_id:
+        AUTO4_STATE["open_batch"] = None
+
+def resume_auto4_batches(application: Application):
+    # Batches restored from state.json continue from where their window was
+    context = CallbackContext(application)
+    for batch_id in list(AUTO4_STATE["batches"]):
+        task = AUTO4_TASKS.get(batch_id)
+        if task and not task.done():
+            continue
+        AUTO4_TASKS[batch_id] = asyncio.create_task(process_auto4_delayed(context, batch_id))
+
+async def process_auto4_delayed(context: ContextTypes.DEFAULT_TYPE, batch_id: str):
+    batch = AUTO4_STATE["batches"].get(batch_id)
+    if not batch:
+        return
+
+    finished = True
     try:
-        countdown_msg = await context.bot.send_message(
-            OWNER_ID,
-            "<b>⏳ Auto 4 - Waiting...</b>\n"
-            "<code>[▰▰▰▰▰▰▰▰▰▰▱▱▱▱▱▱▱▱▱▱] (0/20)</code>",
-            parse_mode="HTML"
-        )
+        start = min(int(time.time() - batch["opened_at"]), AUTO4_WINDOW)
 
-        for elapsed in range(1, 21):
-            await asyncio.sleep(1)
+        if start < AUTO4_WINDOW:
+            countdown_msg = await context.bot.send_message(
+                OWNER_ID,
+                f"<b>⏳ Auto 4 - Batch #{batch_id} Waiting...</b>\n"
+                f"<code>[▰▰▰▰▰▰▰▰▰▰▱▱▱▱▱▱▱▱▱▱] ({start}/{AUTO4_WINDOW})</code>",
+                parse_mode="HTML"
+            )
 
-            filled = "▰" * elapsed
-            empty = "▱" * (20 - elapsed)
-            bar = filled + empty
+            for elapsed in range(start + 1, AUTO4_WINDOW + 1):
+                await asyncio.sleep(1)
 
-            try:
-                await context.bot.edit_message_text(
-                    chat_id=OWNER_ID,
-                    message_id=countdown_msg.message_id,
-                    text=(
-                        "<b>⏳ Auto 4 - Waiting...</b>\n"
-                        f"<code>[{bar}] ({elapsed}/20)</code>"
-                    ),
-                    parse_mode="HTML"
-                )
-            except Exception:
-                pass
+                filled = "▰" * elapsed
+                empty = "▱" * (AUTO4_WINDOW - elapsed)
+                bar = filled + empty
+
+                try:
+                    await context.bot.edit_message_text(
+                        chat_id=OWNER_ID,
+                        message_id=countdown_msg.message_id,
+                        text=(
+                            f"<b>⏳ Auto 4 - Batch #{batch_id} Waiting...</b>\n"
+                            f"<code>[{bar}] ({elapsed}/{AUTO4_WINDOW})</code>"
+                        ),
+                        parse_mode="HTML"
+                    )
+                except Exception:
+                    pass
+        else:
+            countdown_msg = await context.bot.send_message(
+                OWNER_ID,
+                f"<b>⏳ Auto 4 - Resuming Batch #{batch_id}...</b>",
+                parse_mode="HTML"
+            )
+
+        # Window closed: later arrivals go to a fresh batch
+        auto4_seal_batch(batch_id)
+        save_state()
 
         await asyncio.sleep(1)
 
         source_channel = AUTO_SETUP["setup4"]["source_channel"]
-        valid_apks = []
-
-        for apk in AUTO4_STATE["pending_apks"]:
-            try:
-                await context.bot.forward_message(
-                    chat_id=OWNER_ID,
-                    from_chat_id=source_channel,
-                    message_id=apk["message_id"]
-                )
-                valid_apks.append(apk)
-            except Exception:
-                pass
+        pending_apks = list(batch["apks"])
+        status = await verify_messages_exist(
+            context.bot, source_channel, [apk["message_id"] for apk in pending_apks]
+        )
+        valid_apks = [apk for apk in pending_apks if status.get(apk["message_id"])]
 
         if not valid_apks:
             await context.bot.edit_message_text(
                 chat_id=OWNER_ID,
                 message_id=countdown_msg.message_id,
-                text="❌ <b>Auto 4: All APKs deleted. Declined.</b>",
+                text=f"❌ <b>Auto 4 Batch #{batch_id}: All APKs deleted. Declined.</b>",
                 parse_mode="HTML"
             )
             return
@@ -5104,19 +6513,12 @@ async def process_auto4_delayed(context: ContextTypes.DEFAULT_TYPE):
 
         # Key extraction
         await asyncio.sleep(3 if setup_type == "Setup 2" else 0)
+        # Auto 4 has always taken "Key -" then a code entity; key_mode is an
+        # Auto 1-3 setting, so only an explicit key_rules list changes this
+        rules = AUTO_SETUP["setup4"].get("key_rules") or DEFAULT_KEY_RULES
         for apk in (valid_apks[::-1] if setup_type == "Setup 2" else valid_apks):
-            caption = apk["caption"]
-            match = re.search(r'Key\s*-\s*(\S+)', caption)
-            if match:
-                key = match.group(1)
-                break
-            if "caption_entities" in apk:
-                for entity in apk["caption_entities"]:
-                    if entity["type"] == "code":
-                        offset = entity["offset"]
-                        length = entity["length"]
-                        key = caption[offset:offset + length]
-                        break
+            key = extract_key(apk["caption"], apk.get("caption_entities"), rules)
+            record_key_sample(apk["caption"], apk.get("caption_entities"), key)
             if key:
                 break
 
@@ -5130,16 +6532,21 @@ async def process_auto4_delayed(context: ContextTypes.DEFAULT_TYPE):
                 parse_mode="HTML"
             )
 
+    except asyncio.CancelledError:
+        # Shutdown: keep the batch persisted so it resumes on the next start
+        finished = False
+        raise
+
     except Exception as e:
         await notify_owner_on_error(context.bot, e, source="process_auto4_delayed")
-        
+
     finally:
-        AUTO4_STATE.update({
-            "pending_apks": [],
-            "timer": None,
-            "setup_mode": 1,
-            "waiting_since": None
-        })
+        AUTO4_TASKS.pop(batch_id, None)
+        if AUTO4_STATE.get("open_batch") == batch_id:
+            AUTO4_STATE["open_batch"] = None
+        if finished:
+            AUTO4_STATE["batches"].pop(batch_id, None)
+            save_state()
     
 async def send_auto4_apks(apks, key, context: ContextTypes.DEFAULT_TYPE, countdown_msg, setup_type):
     try:
@@ -5157,28 +6564,42 @@ async def send_auto4_apks(apks, key, context: ContextTypes.DEFAULT_TYPE, countdo
             )
             return
     
-        post_link = "Unavailable"
-        success_count = 0
+        # Skip APKs already posted to this destination with the same key
+        apks = [apk for apk in apks if not dedup_is_duplicate(apk.get("file_unique_id"), dest_channel, key)]
+        if not apks:
+            await context.bot.edit_message_text(
+                chat_id=OWNER_ID,
+                message_id=countdown_msg.message_id,
+                text="♻️ <b>Auto 4: All APKs were already posted. Skipped.</b>",
+                parse_mode="HTML"
+            )
+            return
     
+        if style == "quote":
+            caption_final = render_caption(caption_template, key, "quote", "key_line")
+        else:
+            caption_final = render_caption(caption_template, key, "mono")
+
+        # Whole batch as one album; the link points at its first message
+        try:
+            sent = await publish_documents(
+                context.bot,
+                dest_channel,
+                [(apk["file_id"], caption_final) for apk in apks]
+            )
+        except Exception as e:
+            await context.bot.edit_message_text(
+                chat_id=OWNER_ID,
+                message_id=countdown_msg.message_id,
+                text=f"❌ <b>Auto 4: Failed to send batch.</b>\n<code>{escape(str(e))}</code>",
+                parse_mode="HTML"
+            )
+            return
+
         for apk in apks:
-            if style == "quote":
-                caption_final = f"<blockquote>Key - <code>{key}</code></blockquote>"
-            else:
-                caption_final = caption_template.replace("Key -", f"Key - <code>{key}</code>")
-    
-            try:
-                msg = await context.bot.send_document(
-                    chat_id=dest_channel,
-                    document=apk["file_id"],
-                    caption=caption_final,
-                    parse_mode="HTML"
-                )
-                if post_link == "Unavailable":
-                    post_link = f"https://t.me/c/{str(dest_channel).lstrip('-100')}/{msg.message_id}"
-                success_count += 1
-            except Exception as e:
-                await context.bot.send_message(OWNER_ID, f"❌ Failed to send APK: <code>{e}</code>", parse_mode="HTML")
-    
+            dedup_remember(apk.get("file_unique_id"), dest_channel, key)
+        post_link = build_post_link(dest_channel, sent[0].message_id) if sent else "Unknown"
+
         AUTO_SETUP["setup4"]["completed_count"] += 1
         save_config()
     
@@ -5204,6 +6625,11 @@ async def send_auto4_apks(apks, key, context: ContextTypes.DEFAULT_TYPE, countdo
 async def unified_auto_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = str(update.effective_chat.id)
 
+    # An edit proves the post still exists; never re-run the pipeline for it
+    if update.edited_channel_post:
+        mark_message_alive(chat_id, update.edited_channel_post.message_id)
+        return
+
     # AUTO 4
     setup4 = AUTO_SETUP.get("setup4", {})
     if setup4.get("enabled") and chat_id == str(setup4.get("source_channel", "")):
@@ -5217,48 +6643,505 @@ async def unified_auto_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             await auto_handle_channel_post(update, context)
             return
 
-    print(f"[AUTO] Skipped: {chat_id} not in any setup")
+    log_event("auto", "debug", "Skipped: not in any setup", chat_id=chat_id)
+
+# === ERROR DIGEST ===
+# Errors are grouped by (source, exception type, innermost frame). The first
+# error after a quiet spell is sent at once; anything after it is collected
+# and sent as one digest per ERROR_DIGEST_WINDOW, with a count per group and
+# the traceback of its first occurrence. A window with no errors ends the
+# digest, so the next error is again reported immediately.
+ERROR_DIGEST_WINDOW = 30
+ERROR_DIGEST_LIMIT = 3800
+ERROR_GROUPS = {}
+ERROR_DIGEST = {"task": None, "bot": None}
+ERROR_STATS = {"errors": 0, "digests": 0}
+
+def error_fingerprint(exception: Exception, source: str) -> tuple:
+    frames = traceback.extract_tb(exception.__traceback__)
+    where = f"{os.path.basename(frames[-1].filename)}:{frames[-1].name}:{frames[-1].lineno}" if frames else "—"
+    return source, type(exception).__name__, where
 
 async def notify_owner_on_error(bot, exception: Exception, source: str = "Unknown"):
-    global LAST_ERROR_TIME
-    now = time.time()
+    run = HANDLER_RUN.get()
+    if run is not None:
+        run["failed"] = True
+    ERROR_STATS["errors"] += 1
+
+    key = error_fingerprint(exception, source)
+    group = ERROR_GROUPS.get(key)
+    if group is None:
+        # Only the first occurrence in a window pays for formatting a traceback
+        tb_full = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+        group = ERROR_GROUPS[key] = {
+            "count": 0,
+            "message": str(exception),
+            "traceback": tb_full.strip().splitlines()[-25:],  # last 25 lines of traceback
+            "first": datetime.now()
+        }
+    group["count"] += 1
+    ERROR_DIGEST["bot"] = bot
 
-    if now - LAST_ERROR_TIME < ERROR_COOLDOWN:
-        return  # Avoid spamming alerts
+    task = ERROR_DIGEST["task"]
+    if task is None or task.done():
+        ERROR_DIGEST["task"] = spawn_task("error_digest", error_digest_window())
+        await send_error_digest()
 
-    LAST_ERROR_TIME = now
+async def error_digest_window():
+    while True:
+        await asyncio.sleep(ERROR_DIGEST_WINDOW)
+        if not ERROR_GROUPS:
+            return
+        await send_error_digest()
 
-    tb_full = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
-    tb_trimmed = "\n".join(tb_full.strip().splitlines()[-25:])  # last 25 lines of traceback
+def format_error_digest(groups: dict) -> str:
+    if len(groups) == 1:
+        (source, _, _), group = next(iter(groups.items()))
+        if group["count"] == 1:
+            return (
+                f"⚠️ <b>[BOT ERROR]</b>\n"
+                f"<b>📍 Source:</b> <code>{escape(source)}</code>\n"
+                f"<b>📌 Error:</b> <code>{escape(group['message'])}</code>\n"
+                f"<b>🕒 Time:</b> <code>{group['first'].strftime('%Y-%m-%d %H:%M:%S')}</code>\n\n"
+                f"<b>📄 Traceback:</b>\n<pre>{escape(chr(10).join(group['traceback']))}</pre>"
+            )
 
+    total = sum(group["count"] for group in groups.values())
     msg = (
-        f"⚠️ <b>[BOT ERROR]</b>\n"
-        f"<b>📍 Source:</b> <code>{source}</code>\n"
-        f"<b>📌 Error:</b> <code>{str(exception)}</code>\n"
-        f"<b>🕒 Time:</b> <code>{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</code>\n\n"
-        f"<b>📄 Traceback:</b>\n<pre>{tb_trimmed}</pre>"
+        f"⚠️ <b>[BOT ERRORS]</b> {total} errors of {len(groups)} kinds in the last {ERROR_DIGEST_WINDOW}s\n"
+        f"━━━━━━━━━━━━━━━━━━━━"
     )
+    ranked = sorted(groups.items(), key=lambda item: item[1]["count"], reverse=True)
+    for index, ((source, error_type, where), group) in enumerate(ranked):
+        entry = (
+            f"\n<b>×{group['count']}</b> <code>{escape(source)}</code> — <code>{escape(error_type)}</code>\n"
+            f"📍 <code>{escape(where)}</code> | 🕒 <code>{group['first'].strftime('%H:%M:%S')}</code>\n"
+            f"📌 <code>{escape(group['message'][:200])}</code>"
+        )
+        trace = f"\n<pre>{escape(chr(10).join(group['traceback'][-10:]))}</pre>"
+        if len(msg) + len(entry) + len(trace) <= ERROR_DIGEST_LIMIT:
+            msg += entry + trace
+        elif len(msg) + len(entry) <= ERROR_DIGEST_LIMIT:
+            msg += entry
+        else:
+            msg += f"\n<i>...and {len(ranked) - index} more kinds.</i>"
+            break
+    return msg
+
+async def send_error_digest():
+    groups = dict(ERROR_GROUPS)
+    ERROR_GROUPS.clear()
+    if not groups:
+        return
+    ERROR_STATS["digests"] += 1
+    bot = ERROR_DIGEST["bot"]
 
     try:
-        await bot.send_message(chat_id=OWNER_ID, text=msg, parse_mode="HTML", disable_web_page_preview=True)
+        await bot.send_message(chat_id=OWNER_ID, text=format_error_digest(groups), parse_mode="HTML", disable_web_page_preview=True)
     except Exception as notify_error:
-        print(f"[Notify Error] Owner ku msg anupala: {notify_error}")
+        log_event("errors", "error", "Could not deliver error alert", error=str(notify_error))
         try:
             await bot.send_message(chat_id=OWNER_ID, text="⚠️ Bot crashed, but traceback could not be delivered.", parse_mode="HTML")
         except:
             pass
 
+# === WEBHOOK SERVER ===
+# With WEBHOOK_URL set (the public base URL, e.g. the Railway domain) the bot
+# takes updates by webhook instead of long polling. Telegram POSTs each update
+# to WEBHOOK_URL + WEBHOOK_PATH with WEBHOOK_SECRET in the secret-token header;
+# the small HTTP/1.1 server below answers it and GET /healthz on PORT.
+# GET /metrics serves Prometheus text on its own listener, started when
+# METRICS_PORT is set in either mode. It binds METRICS_HOST (127.0.0.1 by
+# default) and, with METRICS_TOKEN set, wants "Authorization: Bearer <token>".
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()[:32]
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("PORT", "8080"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_SERVER = {"server": None}
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_IDLE_TIMEOUT = 75
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large"}
+WEBHOOK_STATS = {"received": 0, "rejected": 0, "last_update": None}
+
+async def http_webhook(app, headers: dict, body: bytes) -> tuple:
+    if not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET):
+        WEBHOOK_STATS["rejected"] += 1
+        return 403, "text/plain", b"forbidden"
+
+    try:
+        update = Update.de_json(json.loads(body), app.bot)
+    except Exception as e:
+        log_event("webhook", "warning", "Bad update payload", error=str(e))
+        return 400, "text/plain", b"bad update"
+
+    await app.update_queue.put(update)
+    WEBHOOK_STATS["received"] += 1
+    WEBHOOK_STATS["last_update"] = time.time()
+    return 200, "text/plain", b"ok"
+
+async def http_health(app, headers: dict, body: bytes) -> tuple:
+    payload = {
+        "status": "ok",
+        "mode": "webhook" if WEBHOOK_URL else "polling",
+        "uptime": int(time.time() - START_TIME),
+        "updates": WEBHOOK_STATS["received"],
+        "queue": app.update_queue.qsize()
+    }
+    return 200, "application/json", json.dumps(payload).encode()
+
+def _prom_metric(lines: list, name: str, kind: str, help_text: str, samples):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in samples:
+        label_str = ",".join(f'{key}="{val}"' for key, val in labels.items())
+        lines.append(f"{name}{{{label_str}}} {value:g}" if label_str else f"{name} {value:g}")
+
+def _prom_histogram(lines: list, name: str, help_text: str, label: str, table: dict):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for key, hist in list(table.items()):
+        cumulative = 0
+        for bound, hits in zip(METRIC_BUCKETS_MS, hist["buckets"]):
+            cumulative += hits
+            lines.append(f'{name}_bucket{{{label}="{key}",le="{bound / 1000:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{label}="{key}",le="+Inf"}} {hist["count"]}')
+        lines.append(f'{name}_sum{{{label}="{key}"}} {hist["total_ms"] / 1000:g}')
+        lines.append(f'{name}_count{{{label}="{key}"}} {hist["count"]}')
+
+def render_prometheus(app) -> str:
+    lines = []
+    setups = sorted(AUTO_SETUP.items())
+    _prom_metric(lines, "apkbot_setup_posts_total", "counter", "Posts published per auto setup.",
+                 [({"setup": name}, s.get("completed_count", 0)) for name, s in setups])
+    _prom_metric(lines, "apkbot_setup_processed_total", "counter", "APKs processed per auto setup.",
+                 [({"setup": name}, s.get("processed_count", s.get("completed_count", 0))) for name, s in setups])
+
+    per_method = {}
+    for state in list(USER_STATE.values()):
+        for field, value in state.items():
+            if field.startswith("alltime_") and isinstance(value, int):
+                method, _, unit = field[len("alltime_"):].rpartition("_")
+                per_method[(method, unit)] = per_method.get((method, unit), 0) + value
+    _prom_metric(lines, "apkbot_method_apks_total", "counter", "APKs posted per upload method.",
+                 [({"method": method}, total) for (method, unit), total in sorted(per_method.items()) if unit == "apks"])
+    _prom_metric(lines, "apkbot_method_keys_total", "counter", "Keys posted per upload method.",
+                 [({"method": method}, total) for (method, unit), total in sorted(per_method.items()) if unit == "keys"])
+
+    _prom_metric(lines, "apkbot_broadcast_deliveries_total", "counter", "Broadcast messages by result.",
+                 [({"result": result}, count) for result, count in BROADCAST_STATS.items()])
+    _prom_metric(lines, "apkbot_api_calls_total", "counter", "Bot API calls by method.",
+                 [({"method": name}, hist["count"]) for name, hist in sorted(API_METRICS.items())])
+    _prom_metric(lines, "apkbot_api_errors_total", "counter", "Failed Bot API calls by method.",
+                 [({"method": name}, hist["errors"]) for name, hist in sorted(API_METRICS.items())])
+    _prom_metric(lines, "apkbot_flood_waits_total", "counter", "RetryAfter responses from the Bot API.",
+                 [({}, API_STATS["flood_waits"])])
+    _prom_metric(lines, "apkbot_flood_wait_seconds_total", "counter", "Seconds Telegram asked us to wait.",
+                 [({}, API_STATS["flood_wait_s"])])
+    _prom_metric(lines, "apkbot_api_retries_total", "counter", "Bot API calls retried after RetryAfter.",
+                 [({}, API_STATS["retries"])])
+    _prom_metric(lines, "apkbot_api_dropped_total", "counter", "Bot API calls given up after RetryAfter.",
+                 [({}, API_STATS["dropped"])])
+    _prom_metric(lines, "apkbot_api_coalesced_total", "counter", "Edits skipped for a newer edit of the same message.",
+                 [({}, API_STATS["coalesced"])])
+    _prom_metric(lines, "apkbot_api_throttle_seconds_total", "counter", "Seconds spent waiting on API pacing.",
+                 [({}, API_STATS["throttled_s"])])
+
+    queues = {
+        "updates": app.update_queue.qsize(),
+        "actors": sum(entry[1] - 1 for entry in ACTOR_LOCKS.values()),
+        "broadcast": len(BROADCAST_JOB["pending"]) if BROADCAST_JOB else 0,
+        "auto_holds": len(AUTO_HOLDS),
+        "auto4_batches": len(AUTO4_STATE.get("batches", {}))
+    }
+    _prom_metric(lines, "apkbot_errors_total", "counter", "Errors passed to the owner error digest.",
+                 [({}, ERROR_STATS["errors"])])
+    _prom_metric(lines, "apkbot_error_digests_total", "counter", "Error digests sent to the owner.",
+                 [({}, ERROR_STATS["digests"])])
+    _prom_metric(lines, "apkbot_queue_depth", "gauge", "Work waiting to be processed.",
+                 [({"queue": name}, depth) for name, depth in queues.items()])
+    _prom_metric(lines, "apkbot_loop_lag_seconds", "gauge", "Latest event loop lag sample.",
+                 [({}, LOOP_LAG_MS[-1] / 1000 if LOOP_LAG_MS else 0)])
+    _prom_metric(lines, "apkbot_uptime_seconds", "gauge", "Seconds since the process started.",
+                 [({}, int(time.time() - START_TIME))])
+
+    _prom_histogram(lines, "apkbot_persist_seconds", "Time spent writing state files.", "file", PERSIST_METRICS)
+    _prom_histogram(lines, "apkbot_api_seconds", "Bot API call latency.", "method", API_METRICS)
+    _prom_histogram(lines, "apkbot_handler_seconds", "Update handler latency.", "handler", HANDLER_METRICS)
+    return "\n".join(lines) + "\n"
+
+async def http_metrics(app, headers: dict, body: bytes) -> tuple:
+    if METRICS_TOKEN and not hmac.compare_digest(headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return 403, "text/plain", b"forbidden"
+    return 200, "text/plain; version=0.0.4; charset=utf-8", render_prometheus(app).encode()
+
+WEBHOOK_ROUTES = {
+    ("POST", WEBHOOK_PATH): http_webhook,
+    ("GET", "/healthz"): http_health
+}
+
+METRICS_ROUTES = {
+    ("GET", "/metrics"): http_metrics,
+    ("GET", "/healthz"): http_health
+}
+
+def _http_response(status: int, content_type: str, payload: bytes, keep_alive: bool) -> bytes:
+    head = (
+        f"HTTP/1.1 {status} {HTTP_STATUS.get(status, 'OK')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(payload)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode("latin-1") + payload
+
+async def _http_serve(app, routes: dict, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # Telegram keeps webhook connections open, so serve requests until the peer closes
+    try:
+        while True:
+            request_line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+            if not request_line:
+                break
+            try:
+                method, target, version = request_line.decode("latin-1").split()
+            except ValueError:
+                writer.write(_http_response(400, "text/plain", b"bad request", False))
+                break
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get("content-length") or 0)
+            if length > HTTP_MAX_BODY:
+                writer.write(_http_response(413, "text/plain", b"too large", False))
+                break
+            body = await reader.readexactly(length) if length else b""
+
+            route = routes.get((method, target.split("?", 1)[0]))
+            if route:
+                status, content_type, payload = await route(app, headers, body)
+            else:
+                status, content_type, payload = 404, "text/plain", b"not found"
+
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            writer.write(_http_response(status, content_type, payload, keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as e:
+        log_event("http", "error", "Request failed", error=str(e))
+    finally:
+        writer.close()
+
+async def start_http_server(app, host: str, port: int, routes: dict):
+    return await asyncio.start_server(lambda reader, writer: _http_serve(app, routes, reader, writer), host, port)
+
+async def start_metrics_server(app: Application):
+    await stop_metrics_server()
+    METRICS_SERVER["server"] = await start_http_server(app, METRICS_HOST, METRICS_PORT, METRICS_ROUTES)
+    log_event("metrics", "info", "Serving /metrics", host=METRICS_HOST, port=METRICS_PORT, token=bool(METRICS_TOKEN))
+
+async def stop_metrics_server():
+    server = METRICS_SERVER["server"]
+    METRICS_SERVER["server"] = None
+    if server:
+        server.close()
+        await server.wait_closed()
+
+async def run_webhook(app: Application):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    server = await start_http_server(app, HTTP_HOST, HTTP_PORT, WEBHOOK_ROUTES)
+    initialized = False
+    try:
+        # Mirrors run_polling: post_init after initialize, post_shutdown after shutdown
+        async with app:
+            if app.post_init:
+                await app.post_init(app)
+            initialized = True
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+            await app.start()
+            log_event("webhook", "info", "Listening", host=HTTP_HOST, port=HTTP_PORT, path=WEBHOOK_PATH)
+            try:
+                await stop.wait()
+            finally:
+                await app.stop()
+    finally:
+        server.close()
+        await server.wait_closed()
+        if initialized and app.post_shutdown:
+            await app.post_shutdown(app)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.remove_signal_handler(sig)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+# === SUPERVISOR ===
+# main() runs inside one long-lived event loop. When it dies, the supervisor
+# cancels what was in flight (holds, batches, backfills and broadcasts keep
+# their progress in state.json), flushes state, drops objects bound to the old
+# run and calls main() again in the same process. State and caches stay in
+# memory and post_init picks the persisted work back up.
+BACKGROUND_TASKS = {}
+RESTART_STATS = {"restarts": 0, "last_crash": None, "interrupted": [], "recovery_ms": 0.0}
+RESTART_FAST_CRASH = 60
+
+def spawn_task(name: str, coro) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    BACKGROUND_TASKS[name] = task
+    task.add_done_callback(lambda done: BACKGROUND_TASKS.pop(name, None) if BACKGROUND_TASKS.get(name) is done else None)
+    return task
+
+def pending_work() -> list:
+    work = [f"Auto {hold['setup']} hold {hold_id}" for hold_id, hold in AUTO_HOLDS.items()]
+    work += [f"Auto 4 batch #{batch_id}" for batch_id in AUTO4_STATE["batches"]]
+    work += [f"Backfill Auto {setup_number}" for setup_number in BACKFILL_JOBS]
+    if BROADCAST_JOB:
+        work.append(f"Broadcast ({len(BROADCAST_JOB['pending'])} users left)")
+    work += [f"Method 2 countdown {uid}" for uid, state in USER_STATE.items() if state.get("countdown_task")]
+    return work
+
+def stop_background_work(loop: asyncio.AbstractEventLoop) -> int:
+    pending = [task for task in asyncio.all_tasks(loop) if not task.done()]
+    for task in pending:
+        task.cancel()
+    if pending:
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    return len(pending)
+
+def reset_runtime():
+    global state_lock, STATE_READY
+    # Locks and tasks from the previous run are tied to its tasks; start clean
+    state_lock = asyncio.Lock()
+    was_ready = STATE_READY.is_set()
+    STATE_READY = asyncio.Event()
+    if was_ready:
+        STATE_READY.set()
+    VERIFY_SLOTS["semaphore"] = None
+    ACTOR_LOCKS.clear()
+    AUTO4_TASKS.clear()
+    BACKFILL_TASKS.clear()
+    BACKGROUND_TASKS.clear()
+    for state in USER_STATE.values():
+        if state.get("countdown_task"):
+            # The countdown is gone; keep accepting the key by text
+            state["countdown_task"] = None
+            state["waiting_key"] = not state.get("saved_key")
+
+def run_supervised():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    fast_crashes = 0
+
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                main()
+                break  # Stopped by SIGINT/SIGTERM
+
+            except Exception as e:
+                crashed = time.monotonic()
+                log_event("system", "error", "Main loop crashed; restarting", error=str(e))
+
+                interrupted = pending_work()
+                cancelled = stop_background_work(loop)
+                save_state()
+                reset_runtime()
+                log_event("system", "info", "Cancelled tasks for restart", cancelled=cancelled, pending_jobs=len(interrupted))
+
+                try:
+                    from telegram import Bot
+                    loop.run_until_complete(notify_owner_on_error(Bot(BOT_TOKEN), e, source="[MAIN LOOP]"))
+                except Exception as notify_error:
+                    log_event("errors", "error", "Could not deliver crash alert", error=str(notify_error))
+
+                # Restart at once, backing off only while it keeps dying right after start
+                fast_crashes = fast_crashes + 1 if crashed - started < RESTART_FAST_CRASH else 0
+                delay = min(5 * fast_crashes, 60)
+                if delay:
+                    log_event("system", "info", "Restarting after backoff", delay=delay)
+                    time.sleep(delay)
+
+                RESTART_STATS["restarts"] += 1
+                RESTART_STATS["last_crash"] = time.time()
+                RESTART_STATS["interrupted"] = interrupted
+                RESTART_STATS["recovery_ms"] = (time.monotonic() - crashed) * 1000
+    finally:
+        stop_background_work(loop)
+        save_state()
+        loop.close()
+
+async def finish_startup(app: Application):
+    # After an in-process restart the state is already in memory
+    if not STATE_READY.is_set():
+        await load_state_async()
+    mark_startup("state_ready")
+
+    spawn_task("autosave", autosave_task())
+    spawn_task("loop_lag", monitor_loop_lag())
+    start_loop_watchdog(app)
+    spawn_task("stat_reports", schedule_stat_reports(app))
+    await warn_missing_scratch_chat(app.bot)
+    resume_auto_holds(app)
+    resume_auto4_batches(app)
+    resume_backfills(app)
+    resume_broadcast(app)
+
 async def post_init(app: Application):
-    asyncio.create_task(autosave_task())
-    asyncio.create_task(schedule_stat_reports(app))
+    # Polling starts as soon as this returns; state loads alongside it
+    mark_startup("initialized")
+    spawn_task("startup", finish_startup(app))
+    if METRICS_PORT:
+        await start_metrics_server(app)
+
+async def post_shutdown(app: Application):
+    stop_loop_watchdog()
+    await stop_metrics_server()
 
 def main():
-    print("[BOT] Starting application...")
+    log_event("bot", "info", "Starting application", mode="webhook" if WEBHOOK_URL else "polling")
 
     if not BOT_TOKEN:
         raise ValueError("BOT_TOKEN is not set. Please check your configuration.")
 
-    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    builder = (
+        Application.builder()
+        .bot(BotApiClient(
+            token=BOT_TOKEN,
+            request=build_http_request(HTTP_CLIENT["pool_size"]),
+            get_updates_request=build_http_request(HTTP_CLIENT["updates_pool_size"])
+        ))
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if WEBHOOK_URL:
+        # Updates arrive over HTTP, so no getUpdates poller
+        builder = builder.updater(None)
+    app = builder.build()
 
     # --- COMMAND HANDLERS ---
     app.add_handler(CommandHandler("start", start))
@@ -5280,12 +7163,12 @@ def main():
     app.add_handler(CommandHandler("testday", test_daily))
     app.add_handler(CommandHandler("testweek", test_weekly))
     app.add_handler(CommandHandler("testmonth", test_monthly))
+    app.add_handler(CommandHandler("keyrules", key_rules_command))
+    app.add_handler(CommandHandler("backfill", backfill_command))
+    app.add_handler(CommandHandler("setscratch", scratch_chat_command))
     
     # --- CALLBACK QUERY HANDLERS ---
-    app.add_handler(CallbackQueryHandler(
-        handle_settings_callback,
-        pattern=r"^(view_users|view_autosetup|viewsetup[1-4]|backup_config|force_reset|confirm_reset|settings_back|bot_admin_link|backup_restore|cancel_restore|confirm_restore|add_user|remove_user|reset_settings_panel)$"
-    ))
+    # Every button goes through the table-driven router
     app.add_handler(CallbackQueryHandler(handle_callback))
 
     # --- MESSAGE HANDLERS ---
@@ -5314,23 +7197,20 @@ def main():
         handle_text
     ))
 
+    # Concurrent across users, ordered per user/channel
+    instrument_handlers(app)
+    serialize_handlers(app)
+    mark_startup("app_built")
+
     # --- RUN THE BOT ---
-    app.run_polling()
+    # The loop belongs to the supervisor, which reuses it across restarts
+    if WEBHOOK_URL:
+        asyncio.get_event_loop().run_until_complete(run_webhook(app))
+    else:
+        app.run_polling(close_loop=False)
+
+mark_startup("imported")
 
 # --- RESTART LOGIC ON CRASH ---
 if __name__ == "__main__":
-    while True:
-        try:
-            main()
-        except Exception as e:
-            error_head = "[MAIN LOOP]"
-            print(f"[CRITICAL ERROR] Restarting Bot...\n{e}\n")
-            try:
-                from telegram import Bot
-                bot = Bot(BOT_TOKEN)
-                asyncio.run(notify_owner_on_error(bot, e, source=error_head))
-            except Exception as notify_error:
-                print(f"[Notify Error] Owner ku alert anupala: {notify_error}")
-            print("[SYSTEM] Restarting bot in 5 seconds...")
-            time.sleep(5)
-            os.execl(sys.executable, sys.executable, *sys.argv)
\ No newline at end of file
+    run_supervised()
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# main.py reads these at import; run pytest from the repository root so it
+# finds config.json the same way the bot does
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.gettempdir(), "apkbot-test.jsonl"))
+os.environ.setdefault("LOG_STDOUT_LEVEL", "ERROR")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
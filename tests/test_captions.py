@@ -0,0 +1,48 @@
+import main
+
+TEMPLATE = "🔥 New Mod\nKey -\nJoin @example_channel"
+
+
+def test_spread_puts_key_line_on_every_apk_and_full_caption_last():
+    captions = main.render_session_captions(TEMPLATE, "ABC", "quote", 3, "spread")
+    key_line = "<blockquote>Key - <code>ABC</code></blockquote>"
+    assert captions[:2] == [key_line, key_line]
+    assert captions[2] == f"🔥 New Mod\n{key_line}\nJoin @example_channel"
+
+
+def test_single_apk_gets_only_the_full_caption():
+    assert main.render_session_captions(TEMPLATE, "K1", "mono", 1, "spread") == [
+        "🔥 New Mod\nKey - <code>K1</code>\nJoin @example_channel"
+    ]
+
+
+def test_last_only_layouts_leave_other_apks_without_caption():
+    assert main.render_session_captions(TEMPLATE, "K", "normal", 3, "last_full") == [
+        None, None, "🔥 New Mod\nKey - K\nJoin @example_channel"
+    ]
+    assert main.render_session_captions(TEMPLATE, "K", "mono", 2, "last_key") == [None, "Key - <code>K</code>"]
+    assert main.render_session_captions(TEMPLATE, "K", "quote", 2, "last_bare") == [
+        None, "<blockquote><code>K</code></blockquote>"
+    ]
+
+
+def test_key_top_puts_key_above_caption_without_placeholder():
+    caption, = main.render_session_captions(TEMPLATE, "K", "mono", 1, "last_top")
+    assert caption == "<code>K</code>\n🔥 New Mod\n\nJoin @example_channel"
+
+
+def test_template_without_placeholder_is_posted_unchanged():
+    assert main.render_caption("Just a caption", "K", "mono") == "Just a caption"
+
+
+def test_unknown_style_falls_back_to_normal():
+    assert main.render_caption(TEMPLATE, "K", "fancy") == "🔥 New Mod\nKey - K\nJoin @example_channel"
+
+
+def test_compiled_templates_are_cached_and_bounded(monkeypatch):
+    monkeypatch.setattr(main, "CAPTION_CACHE", {})
+    monkeypatch.setattr(main, "CAPTION_CACHE_MAX", 2)
+    for template in ("a Key - b", "c Key - d", "e Key - f"):
+        main.compile_caption(template)
+    assert list(main.CAPTION_CACHE) == ["c Key - d", "e Key - f"]
+    assert main.compile_caption("e Key - f") is main.CAPTION_CACHE["e Key - f"]
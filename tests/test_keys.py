@@ -0,0 +1,54 @@
+from telegram import MessageEntity
+
+import main
+
+
+def test_label_pattern_wins_over_code_entity():
+    caption = "Key - ABC123 `OTHER`"
+    entities = [{"type": "code", "offset": 14, "length": 5}]
+    assert main.extract_key(caption, entities) == "ABC123"
+
+
+def test_code_entity_offsets_are_utf16():
+    # Each emoji is two UTF-16 code units, so the key starts at 13, not 11
+    caption = "🚀 Loader 👉 QWERTY-778"
+    assert main.extract_key(caption, [{"type": "code", "offset": 13, "length": 10}]) == "QWERTY-778"
+
+
+def test_telegram_entity_objects_are_accepted():
+    entity = MessageEntity(type=MessageEntity.CODE, offset=6, length=4)
+    assert main.extract_key("Copy: ZX99 now", [entity]) == "ZX99"
+
+
+def test_optional_rules():
+    assert main.extract_key("Password: hidden42", None, ["label_line"]) == "hidden42"
+    spoiler = [{"type": "spoiler", "offset": 10, "length": 8}]
+    assert main.extract_key("Password: hidden42", spoiler, ["spoiler"]) == "hidden42"
+    assert main.extract_key("Password: hidden42", spoiler) is None
+
+
+def test_no_caption_or_no_match():
+    assert main.extract_key("", []) is None
+    assert main.extract_key(None) is None
+    assert main.extract_key("No key in this post", []) is None
+
+
+def test_unknown_rule_names_are_ignored():
+    assert main.extract_key("Key - ABC", None, ["nope", "regex"]) == "ABC"
+
+
+def test_setup_rules():
+    code_only = "Tap to copy: XYZ"
+    entities = [{"type": "code", "offset": 13, "length": 3}]
+    assert main.key_rules_for({"key_mode": "auto"}) == main.DEFAULT_KEY_RULES
+    assert main.extract_key(code_only, entities, main.key_rules_for({"key_mode": "manual"})) is None
+    assert main.key_rules_for({"key_mode": "manual", "key_rules": ["code"]}) == ["code"]
+
+
+def test_key_samples_do_not_keep_the_caption(monkeypatch):
+    monkeypatch.setattr(main, "KEY_CORPUS", [])
+    main.record_key_sample("Secret post\nKey - ABC", [], "ABC")
+    sample, = main.KEY_CORPUS
+    assert "Secret post" not in repr(sample)
+    assert "ABC" not in repr(sample)
+    assert "regex" in sample["rules"]
@@ -0,0 +1,46 @@
+import pytest
+
+import main
+
+USER = 12345
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(main, "RATE_LIMITS", {"callback": {"rate": 1.0, "burst": 3}})
+    monkeypatch.setattr(main, "RATE_BUCKETS", {})
+    monkeypatch.setattr(main, "RATE_STATS", {"allowed": 0, "dropped": 0, "last_prune": 0.0})
+
+
+def test_burst_then_drop():
+    results = [main.rate_limit_take("callback", USER, 1000.0) for _ in range(5)]
+    assert results == [True, True, True, False, False]
+    assert main.RATE_STATS["allowed"] == 3
+    assert main.RATE_STATS["dropped"] == 2
+
+
+def test_tokens_refill_at_rate():
+    for _ in range(3):
+        main.rate_limit_take("callback", USER, 1000.0)
+    assert not main.rate_limit_take("callback", USER, 1000.5)
+    assert main.rate_limit_take("callback", USER, 1001.6)
+    assert not main.rate_limit_take("callback", USER, 1001.7)
+
+
+def test_users_have_separate_buckets():
+    for _ in range(3):
+        main.rate_limit_take("callback", USER, 1000.0)
+    assert main.rate_limit_take("callback", USER + 1, 1000.0)
+
+
+def test_owner_and_unlimited_kinds_always_pass():
+    assert all(main.rate_limit_take("callback", main.OWNER_ID, 1000.0) for _ in range(10))
+    assert all(main.rate_limit_take("upload", USER, 1000.0) for _ in range(10))
+    assert main.RATE_BUCKETS == {}
+
+
+def test_full_buckets_are_pruned():
+    main.rate_limit_take("callback", USER, 1000.0)
+    main.rate_limit_take("callback", USER + 1, 1000.0 + main.RATE_PRUNE_INTERVAL)
+    assert ("callback", USER) not in main.RATE_BUCKETS
+    assert ("callback", USER + 1) in main.RATE_BUCKETS
@@ -0,0 +1,119 @@
+import asyncio
+import json
+
+import main
+
+
+class FakeApp:
+    def __init__(self):
+        self.update_queue = asyncio.Queue()
+        self.bot = None
+
+
+class Client:
+    # Speaks just enough HTTP/1.1 to drive one keep-alive connection
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+
+    async def request(self, method, path, body=b"", headers=None):
+        head = f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        self.writer.write(head.encode() + b"\r\n" + body)
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":")[1])
+        return status, await self.reader.readexactly(length)
+
+
+def serve(routes, scenario):
+    async def run():
+        app = FakeApp()
+        server = await main.start_http_server(app, "127.0.0.1", 0, routes)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            return await scenario(Client(reader, writer), app)
+        finally:
+            writer.close()
+            server.close()
+            await server.wait_closed()
+    return asyncio.run(run())
+
+
+def update_body(update_id):
+    return json.dumps({
+        "update_id": update_id,
+        "message": {"message_id": 1, "date": 0, "chat": {"id": 5, "type": "private"}, "text": "hi"}
+    }).encode()
+
+
+SECRET = {"X-Telegram-Bot-Api-Secret-Token": main.WEBHOOK_SECRET}
+
+
+def test_updates_are_parsed_and_queued_over_one_connection():
+    async def scenario(client, app):
+        first = await client.request("POST", main.WEBHOOK_PATH, update_body(1), SECRET)
+        second = await client.request("POST", main.WEBHOOK_PATH, update_body(2), SECRET)
+        updates = [app.update_queue.get_nowait() for _ in range(app.update_queue.qsize())]
+        return first, second, updates
+
+    first, second, updates = serve(main.WEBHOOK_ROUTES, scenario)
+    assert first == second == (200, b"ok")
+    assert [update.update_id for update in updates] == [1, 2]
+    assert updates[0].message.text == "hi"
+
+
+def test_wrong_secret_is_rejected():
+    async def scenario(client, app):
+        response = await client.request("POST", main.WEBHOOK_PATH, update_body(1), {"X-Telegram-Bot-Api-Secret-Token": "nope"})
+        return response, app.update_queue.qsize()
+
+    assert serve(main.WEBHOOK_ROUTES, scenario) == ((403, b"forbidden"), 0)
+
+
+def test_bad_payload_and_unknown_routes():
+    async def scenario(client, app):
+        return [
+            await client.request("POST", main.WEBHOOK_PATH, b"{not json", SECRET),
+            await client.request("GET", "/metrics"),
+            await client.request("GET", "/nope"),
+        ]
+
+    assert [status for status, _ in serve(main.WEBHOOK_ROUTES, scenario)] == [400, 404, 404]
+
+
+def test_oversized_body_is_refused_before_reading_it():
+    async def scenario(client, app):
+        client.writer.write(
+            f"POST {main.WEBHOOK_PATH} HTTP/1.1\r\nContent-Length: {main.HTTP_MAX_BODY + 1}\r\n\r\n".encode()
+        )
+        return (await client.reader.readline()).split()[1]
+
+    assert serve(main.WEBHOOK_ROUTES, scenario) == b"413"
+
+
+def test_health_reports_mode_and_queue():
+    async def scenario(client, app):
+        return await client.request("GET", "/healthz?probe=1")
+
+    status, body = serve(main.WEBHOOK_ROUTES, scenario)
+    assert status == 200
+    assert json.loads(body)["queue"] == 0
+
+
+def test_metrics_listener_does_not_accept_updates(monkeypatch):
+    monkeypatch.setattr(main, "METRICS_TOKEN", "t0ken")
+
+    async def scenario(client, app):
+        return [
+            (await client.request("POST", main.WEBHOOK_PATH, update_body(1), SECRET))[0],
+            (await client.request("GET", "/metrics"))[0],
+            (await client.request("GET", "/metrics", headers={"Authorization": "Bearer t0ken"}))[0],
+        ]
+
+    assert serve(main.METRICS_ROUTES, scenario) == [404, 403, 200]